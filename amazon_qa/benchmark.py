@@ -0,0 +1,199 @@
+"""Micro-benchmarks for the amazon qa dataset script.
+
+These run on synthetic data on the local machine, and do not need the
+amazon qa files or a Beam runner.
+
+Usage:
+
+To compare the parse throughput of `create_data.parse_literal` with
+`ast.literal_eval`, on synthetic lines in the format of the amazon qa files:
+
+    python -m amazon_qa.benchmark parse --num_lines 100000
+
+To compare the batched `create_data._create_tuples` with the previous
+implementation, which handled one QA object at a time:
+
+    python -m amazon_qa.benchmark tuples --num_lines 100000
+"""
+
+import ast
+import random
+import time
+
+import click
+
+from amazon_qa import create_data
+
+
+@click.group()
+def _cli():
+    """Micro-benchmarks for the amazon qa dataset script."""
+    pass
+
+
+def _synthetic_text(rng, num_words, quote_rate):
+    """Creates a question or answer.
+
+    About `quote_rate` of the words have quotes, which the string
+    representation has to escape, or quote with double quotes.
+    """
+    words = ["the", "product", "is", "a", "great", "fits", "1/2", "inch",
+             "caf\xe9", "’", "battery", "?", "does", "this", "work", "with"]
+    quoted_words = ["it's", "\"size\"", "doesn't", "6'"]
+    return " ".join(
+        rng.choice(quoted_words) if rng.random() < quote_rate
+        else rng.choice(words)
+        for _ in range(num_words))
+
+
+def _synthetic_lines(num_lines, quote_rate, seed):
+    """Creates lines in both formats of the amazon qa files.
+
+    Like the files, each line is the string representation of a python
+    dictionary.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for i in range(num_lines):
+        asin = "B{:09d}".format(i)
+        if rng.random() < 0.5:
+            qa_object = {
+                "questionType": "yes/no",
+                "asin": asin,
+                "answerTime": "Dec 27, 2013",
+                "unixTime": 1388131200,
+                "question": _synthetic_text(
+                    rng, rng.randint(4, 30), quote_rate),
+                "answerType": "Y",
+                "answer": _synthetic_text(
+                    rng, rng.randint(4, 60), quote_rate),
+            }
+        else:
+            qa_object = {
+                "asin": asin,
+                "questions": [
+                    {
+                        "questionType": "open-ended",
+                        "askerID": "A{}".format(rng.randint(0, 10 ** 6)),
+                        "questionTime": "July 31, 2014",
+                        "questionText": _synthetic_text(
+                            rng, rng.randint(4, 30), quote_rate),
+                        "answers": [
+                            {
+                                "answererID": "A{}".format(
+                                    rng.randint(0, 10 ** 6)),
+                                "answerTime": "August 1, 2014",
+                                "helpful": [rng.randint(0, 5), 5],
+                                "answerText": _synthetic_text(
+                                    rng, rng.randint(4, 60), quote_rate),
+                            }
+                            for _ in range(rng.randint(1, 4))
+                        ],
+                    }
+                    for _ in range(rng.randint(1, 3))
+                ],
+            }
+        lines.append(repr(qa_object))
+    return lines
+
+
+@_cli.command(name="parse")
+@click.option("--num_lines", type=int, default=100000)
+@click.option("--quote_rate", type=float, default=0.01)
+@click.option("--seed", type=int, default=0)
+def _parse(num_lines, quote_rate, seed):
+    """Compare the parse throughput of parse_literal and ast.literal_eval."""
+    lines = _synthetic_lines(num_lines, quote_rate, seed)
+    num_bytes = sum(len(line.encode("utf-8")) for line in lines)
+    num_fallbacks = 0
+    for line in lines:
+        try:
+            create_data._literal_to_json(line)
+        except ValueError:
+            num_fallbacks += 1
+    num_quoted = sum('"' in line or "\\" in line for line in lines)
+    print("{} lines, {:.1f} MB, {} with escapes or double quotes, {} fall "
+          "back to ast.literal_eval".format(
+              len(lines), num_bytes / 1e6, num_quoted, num_fallbacks))
+
+    print("%-16s %10s %14s %10s" % (
+        "parser", "time (s)", "lines (k/s)", "MB/s"))
+    for name, fn in [("literal_eval", ast.literal_eval),
+                     ("parse_literal", create_data.parse_literal)]:
+        start = time.time()
+        for line in lines:
+            fn(line)
+        elapsed = time.time() - start
+        print("%-16s %10.3f %14.1f %10.1f" % (
+            name, elapsed, len(lines) / elapsed / 1000,
+            num_bytes / elapsed / 1e6))
+
+
+def _legacy_create_tuples(qa_object, min_words, max_words):
+    """The previous `_create_tuples`, which splits every text into words."""
+    if "question" in qa_object:
+        question = qa_object['question']
+        answer = qa_object['answer']
+        product_id = qa_object['asin']
+        if (_legacy_should_skip(question, min_words, max_words)
+                or _legacy_should_skip(answer, min_words, max_words)):
+            return
+        yield (product_id, question, answer)
+
+    elif "questions" in qa_object:
+        product_id = qa_object['asin']
+        for question_obj in qa_object['questions']:
+            question = question_obj['questionText']
+            if _legacy_should_skip(question, min_words, max_words):
+                continue
+            for answer_obj in question_obj['answers']:
+                answer = answer_obj['answerText']
+                if _legacy_should_skip(answer, min_words, max_words):
+                    continue
+                yield (product_id, question, answer)
+
+
+def _legacy_should_skip(text, min_words, max_words):
+    num_words = len(text.split(" "))
+    return num_words < min_words or num_words > max_words
+
+
+@_cli.command(name="tuples")
+@click.option("--num_lines", type=int, default=100000)
+@click.option("--batch_size", type=int, default=create_data._MAX_BATCH_SIZE)
+@click.option("--min_words", type=int, default=4)
+@click.option("--max_words", type=int, default=59)
+@click.option("--seed", type=int, default=0)
+def _tuples(num_lines, batch_size, min_words, max_words, seed):
+    """Compare creating QA tuples one object at a time and in batches."""
+    qa_objects = [
+        create_data.parse_literal(line)
+        for line in _synthetic_lines(num_lines, quote_rate=0.01, seed=seed)]
+    batches = [qa_objects[i:i + batch_size]
+               for i in range(0, len(qa_objects), batch_size)]
+
+    def _legacy():
+        return [qa_tuple for qa_object in qa_objects
+                for qa_tuple in _legacy_create_tuples(
+                    qa_object, min_words, max_words)]
+
+    def _batched():
+        return [qa_tuple for batch in batches
+                for qa_tuple in create_data._create_tuples(
+                    batch, min_words, max_words)]
+
+    qa_tuples = _legacy()
+    assert qa_tuples == _batched()
+    print("{} objects, {} tuples".format(len(qa_objects), len(qa_tuples)))
+
+    print("%-10s %10s %16s" % ("engine", "time (s)", "objects (k/s)"))
+    for name, fn in [("legacy", _legacy), ("batched", _batched)]:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print("%-10s %10.3f %16.1f" % (
+            name, elapsed, len(qa_objects) / elapsed / 1000))
+
+
+if __name__ == "__main__":
+    _cli()
@@ -10,18 +10,47 @@ import hashlib
 import json
 import logging
 import os
-import uuid
+import re
+import time
+import zlib
+from collections import defaultdict
 from functools import partial
 
 import apache_beam as beam
+import numpy as np
 import tensorflow as tf
 from apache_beam import pvalue
+from apache_beam.io import filebasedsource
+from apache_beam.io.filesystem import CompressionTypes
 from apache_beam.io.textio import ReadFromText, WriteToText
 from apache_beam.io.tfrecordio import WriteToTFRecord
+from apache_beam.metrics import Metrics
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
 
+from tools import near_dedup, shuffle
+
 _TF_FORMAT = "TF"
 _JSON_FORMAT = "JSON"
+_MIN_BATCH_SIZE = 100
+_MAX_BATCH_SIZE = 1000
+_READ_BYTES_COUNTER_PREFIX = "read_bytes:"
+_READ_USECS_COUNTER_PREFIX = "read_usecs:"
+
+# The start of a gzip member header: the magic number and deflate method.
+_GZIP_MAGIC = b"\x1f\x8b\x08"
+_GZIP_READ_SIZE = 2 ** 20
+_GZIP_CHECK_SIZE = 2 ** 10
+
+# The string literals and constants of a python literal. Everything between
+# them is left unchanged when converting it to JSON.
+_LITERAL_TOKEN_RE = re.compile(
+    r"""'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*"|"""
+    r"""\b(?:True|False|None)\b""")
+_JSON_CONSTANTS = {"True": "true", "False": "false", "None": "null"}
+# Escapes other than those which mean the same in python and JSON strings,
+# and \' which is converted to '.
+_UNSUPPORTED_ESCAPE_RE = re.compile(r"""\\[^\\'"nrtbf]""")
+_STRING_ESCAPE_RE = re.compile(r'\\.|"')
 
 
 def _parse_args(argv=None):
@@ -83,37 +112,354 @@ def _parse_args(argv=None):
         type=_positive_int,
         help="The number of shards for the train set.",
     )
-    return parser.parse_known_args(argv)
+    parser.add_argument(
+        "--splittable_gzip",
+        action="store_true",
+        help="Read the files as gzip files with many members, such as those "
+             "written by tools/blockgzip.py, in parallel byte ranges. The "
+             "read throughput of each file is logged.",
+    )
+    parser.add_argument(
+        "--near_dedup_threshold",
+        default=0, type=float,
+        help="If positive, also remove QA pairs whose question and answer "
+             "both have about this Jaccard similarity to those of another "
+             "pair, ignoring case and punctuation. Near duplicates are found "
+             "with MinHash LSH.",
+    )
+    shuffle.add_arguments(parser)
+    parser.add_argument(
+        "--grouped_answers",
+        action="store_true",
+        help="Write an example per question of each product, with a "
+             "repeated 'responses' feature of its answers, rather than an "
+             "example per answer. "
+             "Use `flatten_grouped_example` or `flatten_grouped_tf_example` "
+             "to read them as (context, response) examples.",
+    )
+    args, pipeline_args = parser.parse_known_args(argv)
+    if args.grouped_answers and args.near_dedup_threshold > 0:
+        parser.error(
+            "--grouped_answers can not be used with --near_dedup_threshold.")
+    return args, pipeline_args
+
+
+class _UnsupportedLiteralError(ValueError):
+    """Raised for a literal which `_literal_to_json` can not convert."""
+    pass
+
+
+def _escape_json_string_char(match):
+    """Converts an escape or quote of a python string to JSON."""
+    text = match.group(0)
+    if text == "\\'":
+        return "'"
+    if text == '"':
+        return '\\"'
+    return text
+
+
+def _literal_token_to_json(match):
+    """Converts a string literal or constant of a python literal to JSON."""
+    token = match.group(0)
+    if token in _JSON_CONSTANTS:
+        return _JSON_CONSTANTS[token]
+    content = token[1:-1]
+    if "\\" not in content:
+        # The common case, which needs no escapes converting.
+        if token[0] == '"':
+            return token
+        return '"' + content.replace('"', '\\"') + '"'
+    if _UNSUPPORTED_ESCAPE_RE.search(content):
+        raise _UnsupportedLiteralError(token)
+    return '"' + _STRING_ESCAPE_RE.sub(_escape_json_string_char, content) + '"'
+
+
+def _literal_to_json(line):
+    """Converts the string representation of a python object to JSON.
+
+    Only handles the dict, list, str, number and constant literals of the
+    amazon qa files. Other literals are not valid JSON once converted, or
+    raise a ValueError.
+    """
+    if ('"' not in line and "\\" not in line and "True" not in line
+            and "False" not in line and "None" not in line):
+        # Every quote delimits a single-quoted string without escapes, so
+        # the strings only need double quotes.
+        return line.replace("'", '"')
+    return _LITERAL_TOKEN_RE.sub(_literal_token_to_json, line)
 
 
-def _create_tuples(qa_object, min_words, max_words):
-    """Creates (product_id, question, answer) tuples."""
-    if "question" in qa_object:
-        question = qa_object['question']
-        answer = qa_object['answer']
-        product_id = qa_object['asin']
-        if (_should_skip(question, min_words, max_words)
-                or _should_skip(answer, min_words, max_words)):
+def _reject_json_constant(constant):
+    """Rejects NaN and Infinity, which are not python literals."""
+    raise _UnsupportedLiteralError(constant)
+
+
+def parse_literal(line):
+    """Parses the string representation of a python object.
+
+    This is equivalent to `ast.literal_eval`, but converts the line to JSON
+    and parses it with `json.loads`, which is several times faster. Lines
+    using python literals which JSON does not have, such as tuples or
+    \\x escapes, fall back to `ast.literal_eval`.
+    """
+    try:
+        return json.loads(
+            _literal_to_json(line), strict=False,
+            parse_constant=_reject_json_constant)
+    except ValueError:
+        return ast.literal_eval(line)
+
+
+def _next_gzip_member(f, offset):
+    """Returns the offset of the first gzip member at or after offset, or None.
+
+    A match of the magic number is only accepted if the start of a gzip
+    member can be decompressed from it.
+    """
+    f.seek(offset)
+    buffered = b""
+    buffered_offset = offset
+    while True:
+        data = f.read(_GZIP_READ_SIZE)
+        buffered += data
+        search_from = 0
+        while True:
+            index = buffered.find(_GZIP_MAGIC, search_from)
+            if index == -1:
+                break
+            if _is_gzip_member(f, buffered_offset + index):
+                return buffered_offset + index
+            search_from = index + 1
+        if not data:
+            return None
+        # Keep a partial magic number at the end of the buffer.
+        keep = min(len(_GZIP_MAGIC) - 1, len(buffered))
+        buffered_offset += len(buffered) - keep
+        buffered = buffered[-keep:]
+        f.seek(buffered_offset + len(buffered))
+
+
+def _is_gzip_member(f, offset):
+    """Whether a gzip member can be decompressed from offset."""
+    f.seek(offset)
+    data = f.read(_GZIP_CHECK_SIZE)
+    try:
+        zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    except zlib.error:
+        return False
+    return True
+
+
+def _iter_gzip_chunks(f, offset):
+    """Yields (member offset, decompressed bytes) of members from offset."""
+    decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_offset = offset
+    read_offset = offset
+    f.seek(offset)
+    while True:
+        data = f.read(_GZIP_READ_SIZE)
+        if not data:
             return
-        yield (product_id, question, answer)
-
-    elif "questions" in qa_object:
-        product_id = qa_object['asin']
-        for question_obj in qa_object['questions']:
-            question = question_obj['questionText']
-            if _should_skip(question, min_words, max_words):
-                continue
-            for answer_obj in question_obj['answers']:
-                answer = answer_obj['answerText']
-                if _should_skip(answer, min_words, max_words):
+        while data:
+            chunk = decompressobj.decompress(data)
+            if chunk:
+                yield member_offset, chunk
+            if not decompressobj.eof:
+                read_offset += len(data)
+                break
+            # The member has ended, and the rest of the data is the next one.
+            unused_data = decompressobj.unused_data
+            read_offset += len(data) - len(unused_data)
+            member_offset = read_offset
+            decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = unused_data
+
+
+class _BlockGzipSource(filebasedsource.FileBasedSource):
+    """Reads lines from gzip files with many members, in parallel.
+
+    A gzip file can be a concatenation of gzip members, which is still read
+    by `gunzip` or `ReadFromText` as a single file. The files are split by
+    compressed byte ranges, and each range reads the members which start in
+    it, so ranges find the next member with `_next_gzip_member`. A line
+    which spans a member boundary is read with the earlier member, by
+    reading the next member up to its first newline, and is skipped when
+    reading the later member.
+
+    A file compressed by `gzip` is a single member, so is only read by the
+    range holding its start. The compressed bytes read from each file, and
+    the time spent reading them, are counted in counters named by the file.
+    """
+
+    def __init__(self, file_pattern, min_bundle_size=0):
+        super(_BlockGzipSource, self).__init__(
+            file_pattern,
+            min_bundle_size=min_bundle_size,
+            compression_type=CompressionTypes.UNCOMPRESSED,
+            splittable=True,
+        )
+
+    def read_records(self, file_name, range_tracker):
+        read_bytes = Metrics.counter(
+            self.__class__, _READ_BYTES_COUNTER_PREFIX + file_name)
+        read_usecs = Metrics.counter(
+            self.__class__, _READ_USECS_COUNTER_PREFIX + file_name)
+        with self.open_file(file_name) as f:
+            member_start = _next_gzip_member(f, range_tracker.start_position())
+            if (member_start is None
+                    or not range_tracker.try_claim(member_start)):
+                return
+            lines = self._read_lines(f, member_start, range_tracker)
+            while True:
+                # Only time the reads, not the processing of the lines.
+                start = time.time()
+                chunk_lines = next(lines, None)
+                read_usecs.inc(int(1e6 * (time.time() - start)))
+                if chunk_lines is None:
+                    break
+                for line in chunk_lines:
+                    yield line.decode("utf-8")
+            read_bytes.inc(f.tell() - member_start)
+
+    def _read_lines(self, f, member_start, range_tracker):
+        """Yields lists of the lines of each chunk read from member_start."""
+        # Lines at the start of all but the first member begin in an earlier
+        # member, which reads them.
+        skipping = member_start != _next_gzip_member(f, 0)
+        finishing = False
+        claimed_member = member_start
+        pending = b""
+        for member_offset, chunk in _iter_gzip_chunks(f, member_start):
+            if member_offset != claimed_member:
+                claimed_member = member_offset
+                finishing = (
+                    finishing or not range_tracker.try_claim(member_offset))
+            if skipping:
+                newline = chunk.find(b"\n")
+                if newline == -1:
                     continue
-                yield (product_id, question, answer)
+                if finishing:
+                    # The next line starts in a member of another range.
+                    return
+                chunk = chunk[newline + 1:]
+                skipping = False
+            if finishing:
+                # Only read the line which spans into the member.
+                newline = chunk.find(b"\n")
+                if newline == -1:
+                    pending += chunk
+                    continue
+                yield [pending + chunk[:newline]]
+                return
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            yield lines
+        if pending and not skipping:
+            yield [pending]
+
+
+def _log_read_throughput(result):
+    """Logs the read throughput of each file read by `_BlockGzipSource`."""
+    counts = defaultdict(int)
+    for counter in result.metrics().query()['counters']:
+        name = counter.key.metric.name
+        for prefix in [_READ_BYTES_COUNTER_PREFIX, _READ_USECS_COUNTER_PREFIX]:
+            if name.startswith(prefix):
+                counts[name[len(prefix):], prefix] += counter.result
+    for file_name in sorted({file_name for file_name, _ in counts}):
+        read_bytes = counts[file_name, _READ_BYTES_COUNTER_PREFIX]
+        read_secs = counts[file_name, _READ_USECS_COUNTER_PREFIX] / 1e6
+        logging.info(
+            "Read %i compressed bytes of %s in %.2f worker seconds, "
+            "%.1f MB/s.", read_bytes, file_name, read_secs,
+            read_bytes / 1e6 / max(read_secs, 1e-3))
+
+
+def _qa_columns(qa_objects):
+    """Flattens a batch of QA objects into columns.
+
+    Returns (product_ids, questions, answers, answer_questions), where the
+    product ids and questions have an entry per question, and the answers
+    have an entry per answer, with the index of its question in
+    answer_questions.
+    """
+    product_ids = []
+    questions = []
+    answers = []
+    answer_questions = []
+    for qa_object in qa_objects:
+        if "question" in qa_object:
+            answers.append(qa_object['answer'])
+            answer_questions.append(len(questions))
+            questions.append(qa_object['question'])
+            product_ids.append(qa_object['asin'])
+
+        elif "questions" in qa_object:
+            for question_obj in qa_object['questions']:
+                for answer_obj in question_obj['answers']:
+                    answers.append(answer_obj['answerText'])
+                    answer_questions.append(len(questions))
+                questions.append(question_obj['questionText'])
+                product_ids.append(qa_object['asin'])
+    return product_ids, questions, answers, answer_questions
+
+
+def _word_counts(texts):
+    """Estimates the number of words of each text, as a numpy array.
+
+    This counts the spaces, which is the length of `text.split(" ")` without
+    building the list.
+    """
+    return np.fromiter(
+        (text.count(" ") for text in texts), dtype=np.int64,
+        count=len(texts)) + 1
+
 
+def _create_tuples(qa_objects, min_words, max_words):
+    """Creates (product_id, question, answer) tuples from a batch of objects.
 
-def _should_skip(text, min_words, max_words):
-    # Estimate the number of words by splitting on spaces.
-    num_words = len(text.split(" "))
-    return num_words < min_words or num_words > max_words
+    Questions and answers with too few or too many words are skipped, and so
+    are all the answers of a skipped question.
+    """
+    product_ids, questions, answers, answer_questions = _qa_columns(
+        qa_objects)
+    question_words = _word_counts(questions)
+    answer_words = _word_counts(answers)
+    keep_questions = (
+        (question_words >= min_words) & (question_words <= max_words))
+    keep_answers = (
+        (answer_words >= min_words) & (answer_words <= max_words)
+        & keep_questions[np.array(answer_questions, dtype=np.int64)])
+    for answer_index in np.flatnonzero(keep_answers).tolist():
+        question_index = answer_questions[answer_index]
+        yield (product_ids[question_index], questions[question_index],
+               answers[answer_index])
+
+
+def _qa_fingerprint(qa_tuple):
+    """Keys a (product_id, question, answer) tuple by a hash of its QA."""
+    md5 = hashlib.md5()
+    md5.update(json.dumps(qa_tuple[1:]).encode("utf-8"))
+    return md5.digest(), qa_tuple
+
+
+def _remove_duplicates(qa_tuples):
+    """Keeps the smallest tuple of each (question, answer) pair.
+
+    Tuples are keyed by a 128 bit fingerprint of the pair, rather than the
+    texts, and combined with min, which the runner lifts before the shuffle.
+    So each worker only shuffles one tuple per fingerprint, and no worker
+    holds all the duplicates of a pair in memory.
+    """
+    qa_tuples |= "key by QA fingerprint" >> beam.Map(_qa_fingerprint)
+    qa_tuples |= "remove duplicates" >> beam.CombinePerKey(min)
+    return qa_tuples | "get deduplicated tuples" >> beam.Values()
+
+
+def _qa_texts(qa_tuple):
+    """Returns the question and answer, for near duplicate removal."""
+    return qa_tuple[1:]
 
 
 def _create_example(product_id, question, answer):
@@ -125,24 +471,115 @@ def _create_example(product_id, question, answer):
     }
 
 
-def _shuffle_examples(examples):
-    examples |= "add random key" >> beam.Map(
-        lambda example: (uuid.uuid4(), example)
-    )
-    examples |= "group by key" >> beam.GroupByKey()
-    examples |= "get shuffled values" >> beam.FlatMap(lambda t: t[1])
-    return examples
+def _question_fingerprint(qa_tuple):
+    """Keys a (product_id, question, answer) tuple by its product and question.
+
+    The same question asked about different products is grouped separately,
+    so each group keeps its product id and train/test split.
+    """
+    md5 = hashlib.md5()
+    md5.update(json.dumps(qa_tuple[:2]).encode("utf-8"))
+    return md5.digest(), qa_tuple
+
+
+class _GroupAnswersFn(beam.CombineFn):
+    """Combines the tuples of a question into (product_id, question, answers).
+
+    The tuples all have the same product id and question, which are only
+    held once. Each answer is kept once, and the answers are sorted.
+    """
+
+    def create_accumulator(self):
+        return None, None, set()
+
+    def add_input(self, accumulator, qa_tuple):
+        _, _, answers = accumulator
+        product_id, question, answer = qa_tuple
+        answers.add(answer)
+        return product_id, question, answers
+
+    def merge_accumulators(self, accumulators):
+        merged_product_id, merged_question, merged_answers = None, None, set()
+        for product_id, question, answers in accumulators:
+            if question is not None:
+                merged_product_id, merged_question = product_id, question
+            merged_answers |= answers
+        return merged_product_id, merged_question, merged_answers
+
+    def extract_output(self, accumulator):
+        product_id, question, answers = accumulator
+        return product_id, question, sorted(answers)
+
+
+def _group_answers(qa_tuples):
+    """Groups the QA tuples by product and question, removing duplicates.
+
+    This replaces `_remove_duplicates` for the grouped layout. The combiner
+    is lifted before the shuffle, so each worker shuffles a question once
+    with its unique answers.
+    """
+    qa_tuples |= "key by question fingerprint" >> beam.Map(
+        _question_fingerprint)
+    qa_tuples |= "group answers" >> beam.CombinePerKey(_GroupAnswersFn())
+    return qa_tuples | "get grouped answers" >> beam.Values()
+
+
+def _create_grouped_example(product_id, question, answers):
+    """Create an example dictionary for a question and its answers."""
+    return {
+        'product_id': product_id,
+        'context': question,
+        'responses': answers,
+    }
+
+
+def flatten_grouped_example(example):
+    """Yields the (context, response) examples of a grouped example.
+
+    The example is a dictionary, as written by --grouped_answers
+    --dataset_format JSON.
+    """
+    for response in example['responses']:
+        flat_example = {
+            feature_name: feature_value
+            for feature_name, feature_value in example.items()
+            if feature_name != 'responses'
+        }
+        flat_example['response'] = response
+        yield flat_example
+
+
+def flatten_grouped_tf_example(serialized_example):
+    """Yields the serialized (context, response) examples of a grouped example.
+
+    The example is a serialized tensorflow example, as written by
+    --grouped_answers --dataset_format TF.
+    """
+    example = tf.train.Example()
+    example.ParseFromString(serialized_example)
+    responses = list(example.features.feature['responses'].bytes_list.value)
+    del example.features.feature['responses']
+    for response in responses:
+        flat_example = tf.train.Example()
+        flat_example.CopyFrom(example)
+        flat_example.features.feature['response'].bytes_list.value.append(
+            response)
+        yield flat_example.SerializeToString()
 
 
 def _features_to_serialized_tf_example(features):
     """Convert a string dict to a serialized TF example.
 
-    The dictionary maps feature names (strings) to feature values (strings).
+    The dictionary maps feature names (strings) to feature values (strings),
+    or lists of feature values for repeated features.
     """
     example = tf.train.Example()
     for feature_name, feature_value in features.items():
-        example.features.feature[feature_name].bytes_list.value.append(
-            feature_value.encode("utf-8"))
+        feature_values = (
+            feature_value if isinstance(feature_value, list)
+            else [feature_value])
+        example.features.feature[feature_name].bytes_list.value.extend(
+            value.encode("utf-8") for value in feature_values)
     return example.SerializeToString()
 
 
@@ -187,27 +624,45 @@ def run(argv=None):
     pipeline_options.view_as(SetupOptions).save_main_session = True
     p = beam.Pipeline(options=pipeline_options)
 
-    lines = p | "read qa files" >> ReadFromText(args.file_pattern)
+    if args.splittable_gzip:
+        lines = p | "read qa files" >> beam.io.Read(
+            _BlockGzipSource(args.file_pattern))
+    else:
+        lines = p | "read qa files" >> ReadFromText(args.file_pattern)
 
     # The lines are not JSON, but the string representation of python
-    # dictionary objects. Parse them with ast.literal_eval.
-    json_objects = lines | "parsing dictionaries" >> beam.Map(ast.literal_eval)
+    # dictionary objects. Parse them with `parse_literal`, a faster
+    # ast.literal_eval.
+    json_objects = lines | "parsing dictionaries" >> beam.Map(parse_literal)
+    json_objects |= "batch dictionaries" >> beam.BatchElements(
+        min_batch_size=_MIN_BATCH_SIZE, max_batch_size=_MAX_BATCH_SIZE)
     qa_tuples = json_objects | "create tuples" >> beam.FlatMap(
         partial(
             _create_tuples,
             min_words=args.min_words, max_words=args.max_words)
     )
 
-    # Remove duplicate examples.
-    qa_tuples |= "key by QA" >> beam.Map(lambda v: (v[1:], v))
-    qa_tuples |= "group duplicates" >> beam.GroupByKey()
-    qa_tuples |= "remove duplicates" >> beam.Map(lambda v: sorted(v[1])[0])
-
-    # Create the examples.
-    examples = qa_tuples | "create examples" >> beam.Map(
-        lambda args: _create_example(*args)
+    if args.grouped_answers:
+        # Create an example per question.
+        qa_groups = _group_answers(qa_tuples)
+        examples = qa_groups | "create grouped examples" >> beam.Map(
+            lambda args: _create_grouped_example(*args)
+        )
+    else:
+        qa_tuples = _remove_duplicates(qa_tuples)
+        if args.near_dedup_threshold > 0:
+            qa_tuples = near_dedup.remove_near_duplicates(
+                qa_tuples, _qa_texts, args.near_dedup_threshold)
+
+        # Create the examples.
+        examples = qa_tuples | "create examples" >> beam.Map(
+            lambda args: _create_example(*args)
+        )
+    examples |= "shuffle examples" >> shuffle.shuffle(
+        shuffle_mode=args.shuffle_mode,
+        shuffle_seed=args.shuffle_seed,
+        shuffle_buffer_size=args.shuffle_buffer_size,
     )
-    examples = _shuffle_examples(examples)
 
     examples |= "split train and test" >> beam.ParDo(
         _TrainTestSplitFn(args.train_split)
@@ -239,6 +694,11 @@ def run(argv=None):
 
     result = p.run()
     result.wait_until_finish()
+    shuffle.log_shuffle_bytes(result, args.shuffle_mode)
+    if args.near_dedup_threshold > 0:
+        near_dedup.log_near_duplicates(result)
+    if args.splittable_gzip:
+        _log_read_throughput(result)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 """Tests for create_data.py."""
 
+import ast
+import gzip
 import json
 import shutil
 import tempfile
@@ -7,7 +9,11 @@ import unittest
 from glob import glob
 from os import path
 
+import apache_beam as beam
 import tensorflow as tf
+from apache_beam.io import source_test_utils
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
 
 from amazon_qa import create_data
 
@@ -210,5 +216,233 @@ class CreateDataPipelineTest(unittest.TestCase):
         return examples
 
 
+class BlockGzipSourceTest(unittest.TestCase):
+    """Test `create_data._BlockGzipSource`."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._lines = [
+            str(dict(qa_object, asin=str(i)))
+            for i in range(20) for qa_object in _TEST_DATA]
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write_gzip(self, member_size):
+        """Writes the lines as gzip members of member_size bytes each.
+
+        The members do not end at line boundaries.
+        """
+        data = "".join(line + "\n" for line in self._lines).encode("utf-8")
+        file_name = path.join(self._temp_dir, "input.json.gz")
+        with open(file_name, "wb") as f:
+            for i in range(0, len(data), member_size):
+                f.write(gzip.compress(data[i:i + member_size]))
+        return file_name
+
+    def test_read(self):
+        for member_size in [10 ** 6, 1000, 37]:
+            source = create_data._BlockGzipSource(
+                self._write_gzip(member_size))
+            self.assertEqual(
+                self._lines, source_test_utils.read_from_source(source))
+
+    def test_splits(self):
+        source = create_data._BlockGzipSource(self._write_gzip(37))
+        splits = list(source.split(desired_bundle_size=100))
+        self.assertGreater(len(splits), 10)
+        source_test_utils.assert_sources_equal_reference_source(
+            (source, None, None),
+            [(split.source, split.start_position, split.stop_position)
+             for split in splits])
+
+    def test_split_at_fraction(self):
+        source = create_data._BlockGzipSource(self._write_gzip(500))
+        source_test_utils.assert_split_at_fraction_exhaustive(source)
+
+    def test_next_gzip_member(self):
+        file_name = self._write_gzip(1000)
+        with open(file_name, "rb") as f:
+            self.assertEqual(0, create_data._next_gzip_member(f, 0))
+            second_member = create_data._next_gzip_member(f, 1)
+            self.assertGreater(second_member, 1)
+            f.seek(second_member)
+            self.assertEqual(
+                create_data._GZIP_MAGIC,
+                f.read(len(create_data._GZIP_MAGIC)))
+            f.seek(0, 2)
+            self.assertIsNone(create_data._next_gzip_member(f, f.tell()))
+
+
+class CreateTuplesTest(unittest.TestCase):
+    """Test `create_data._create_tuples`."""
+
+    def test_create_tuples(self):
+        self.assertEqual(
+            [
+                ("3", "A A A", "B B B"),
+                ("4", "A A A", "B B B"),
+                ("1", "C C C", "D D D"),
+                ("1", "C C C", "E E E"),
+                ("1", "F F F", "G G G"),
+                ("2", "H H H", "I I I"),
+            ],
+            list(create_data._create_tuples(
+                _TEST_DATA, min_words=3, max_words=5)))
+
+    def test_skipped_question(self):
+        qa_objects = [{
+            'asin': "1",
+            'questions': [
+                {'questionText': "A", 'answers': [{'answerText': "B B B"}]},
+                {'questionText': "C C C", 'answers': []},
+                {'questionText': "D D D",
+                 'answers': [{'answerText': "E E E"}]},
+            ],
+        }]
+        self.assertEqual(
+            [("1", "D D D", "E E E")],
+            list(create_data._create_tuples(
+                qa_objects, min_words=3, max_words=5)))
+        self.assertEqual(
+            [], list(create_data._create_tuples(
+                [], min_words=3, max_words=5)))
+
+    def test_word_counts(self):
+        self.assertEqual(
+            [len(text.split(" ")) for text in ["", "a", "a b", " a  b "]],
+            create_data._word_counts(["", "a", "a b", " a  b "]).tolist())
+
+
+class RemoveDuplicatesTest(unittest.TestCase):
+    """Test `create_data._remove_duplicates`."""
+
+    def test_remove_duplicates(self):
+        with TestPipeline() as p:
+            qa_tuples = create_data._remove_duplicates(p | beam.Create([
+                ("4", "A A A", "B B B"),
+                ("3", "A A A", "B B B"),
+                ("5", "A A A", "B B B"),
+                ("3", "A A A", "C C C"),
+                ("3", "A A", "A B B B"),
+            ]))
+            assert_that(qa_tuples, equal_to([
+                ("3", "A A A", "B B B"),
+                ("3", "A A A", "C C C"),
+                ("3", "A A", "A B B B"),
+            ]))
+
+
+class GroupAnswersTest(unittest.TestCase):
+    """Test the grouped answers layout."""
+
+    def test_group_answers(self):
+        with TestPipeline() as p:
+            qa_groups = create_data._group_answers(p | beam.Create([
+                ("3", "A A A", "C C C"),
+                ("3", "A A A", "B B B"),
+                ("3", "A A A", "B B B"),
+                ("6", "D D D", "E E E"),
+            ]))
+            assert_that(qa_groups, equal_to([
+                ("3", "A A A", ["B B B", "C C C"]),
+                ("6", "D D D", ["E E E"]),
+            ]))
+
+    def test_group_answers_by_product(self):
+        # The same question about different products is not merged, so each
+        # product keeps its train/test split.
+        with TestPipeline() as p:
+            qa_groups = create_data._group_answers(p | beam.Create([
+                ("4", "A A A", "B B B"),
+                ("3", "A A A", "B B B"),
+                ("3", "A A A", "C C C"),
+            ]))
+            assert_that(qa_groups, equal_to([
+                ("3", "A A A", ["B B B", "C C C"]),
+                ("4", "A A A", ["B B B"]),
+            ]))
+
+    def test_group_answers_combine_fn(self):
+        combine_fn = create_data._GroupAnswersFn()
+        accumulators = []
+        for qa_tuples in [[("2", "A", "B"), ("2", "A", "C")],
+                          [("2", "A", "B")], []]:
+            accumulator = combine_fn.create_accumulator()
+            for qa_tuple in qa_tuples:
+                accumulator = combine_fn.add_input(accumulator, qa_tuple)
+            accumulators.append(accumulator)
+        self.assertEqual(
+            ("2", "A", ["B", "C"]),
+            combine_fn.extract_output(
+                combine_fn.merge_accumulators(accumulators)))
+
+    def test_flatten_grouped_example(self):
+        example = create_data._create_grouped_example(
+            "1", "A A A", ["B B B", "C C C"])
+        self.assertEqual(
+            [create_data._create_example("1", "A A A", "B B B"),
+             create_data._create_example("1", "A A A", "C C C")],
+            list(create_data.flatten_grouped_example(example)))
+
+    def test_flatten_grouped_tf_example(self):
+        serialized_example = create_data._features_to_serialized_tf_example(
+            create_data._create_grouped_example(
+                "1", "A A A", ["B B B", "C C C"]))
+        self.assertEqual(
+            [create_data._features_to_serialized_tf_example(
+                create_data._create_example("1", "A A A", response))
+             for response in ["B B B", "C C C"]],
+            list(create_data.flatten_grouped_tf_example(serialized_example)))
+
+    def test_grouped_answers_not_with_near_dedup(self):
+        with self.assertRaises(SystemExit):
+            create_data._parse_args([
+                "--file_pattern=input*",
+                "--output_dir=output",
+                "--grouped_answers",
+                "--near_dedup_threshold=0.8",
+            ])
+
+
+class ParseLiteralTest(unittest.TestCase):
+    """Test `create_data.parse_literal` against ast.literal_eval."""
+
+    _LINES = [
+        str(_TEST_DATA[0]),
+        str(_TEST_DATA[3]),
+        str({'question': "It's 6' long", 'answer': 'A "big" one',
+             'unixTime': 1388131200, 'helpful': [0, -1.5]}),
+        str({'question': "It's a \"big\" one\\\n\t", 'answer': None,
+             'isTrue': True, 'isFalse': False}),
+        str({'question': "caf\xe9 \u2019 None True", 'answer': ''}),
+        "{'question': 'A \\x41 \\u00e9'}",
+        "{'question': u'unicode prefix'}",
+        "{'tuple': (1, 2), 1: 'non string key'}",
+        "{'implicit': 'string ' 'concatenation'}",
+        "[1.5e3, -0, 0x10]",
+    ]
+
+    def test_parse_literal(self):
+        for line in self._LINES:
+            self.assertEqual(
+                repr(ast.literal_eval(line)),
+                repr(create_data.parse_literal(line)))
+
+    def test_parse_literal_errors(self):
+        for line in ["", "{'a': NaN}", "{'a': Infinity}", "{'a': b}",
+                     "{'a': 'unterminated}"]:
+            with self.assertRaises((ValueError, SyntaxError)):
+                create_data.parse_literal(line)
+
+    def test_literal_to_json(self):
+        self.assertEqual(
+            '{"question": "It\'s \\"big\\"", "answer": null}',
+            create_data._literal_to_json(
+                str({'question': 'It\'s "big"', 'answer': None})))
+        with self.assertRaises(ValueError):
+            create_data._literal_to_json("{'question': '\\x41'}")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,90 @@
+"""Micro-benchmarks for the opensubtitles dataset script.
+
+These run on synthetic data on the local machine, and do not need the
+OpenSubtitles files or a Beam runner.
+
+Usage:
+
+To compare the throughput of preprocessing a line at a time, with
+`create_data._preprocess_line`, and a chunk of lines at a time, with
+`create_data._preprocess_lines`, on a synthetic subtitle corpus:
+
+    python -m opensubtitles.benchmark preprocess --num_lines 1000000
+"""
+
+import io
+import random
+import time
+
+import click
+
+from opensubtitles import create_data
+
+
+@click.group()
+def _cli():
+    """Micro-benchmarks for the opensubtitles dataset script."""
+    pass
+
+
+def _synthetic_line(rng):
+    """Creates a subtitle line, with some speaker names and sound events."""
+    words = ["I", "don't", "know", "what", "you", "mean", "caf\xe9", "okay",
+             "we", "have", "to", "go", "now", "Dr.", "Palmer", "it's"]
+    line = " ".join(
+        rng.choice(words) for _ in range(rng.randint(1, 12)))
+    line += rng.choice([".", "?", "!", "...", ""])
+    if rng.random() < 0.1:
+        line = rng.choice(["JOHN: ", "c3po: ", "MAN: "]) + line
+    if rng.random() < 0.1:
+        line = rng.choice(["[door closes] ", "(laughing) "]) + line
+    if rng.random() < 0.2:
+        line = "- " + line
+    return line
+
+
+def _synthetic_corpus(num_lines, empty_rate, seed):
+    """Creates the bytes of a file with one subtitle line per line."""
+    rng = random.Random(seed)
+    return "".join(
+        "\n" if rng.random() < empty_rate
+        else _synthetic_line(rng) + "\n"
+        for _ in range(num_lines)).encode("utf-8")
+
+
+@_cli.command(name="preprocess")
+@click.option("--num_lines", type=int, default=1000000)
+@click.option("--empty_rate", type=float, default=0.05)
+@click.option("--chunk_size", type=int, default=create_data._READ_CHUNK_SIZE)
+@click.option("--seed", type=int, default=0)
+def _preprocess(num_lines, empty_rate, chunk_size, seed):
+    """Compare preprocessing a line at a time and a chunk at a time."""
+    data = _synthetic_corpus(num_lines, empty_rate, seed)
+    create_data._READ_CHUNK_SIZE = chunk_size
+
+    def _by_line():
+        return [create_data._preprocess_line(line)
+                for line in io.BytesIO(data)]
+
+    def _by_chunk():
+        return [line for chunk in create_data._read_chunks(io.BytesIO(data))
+                for line in create_data._preprocess_lines(chunk)]
+
+    lines = _by_line()
+    assert lines == _by_chunk()
+    print("{} lines, {:.1f} MB, {} empty after preprocessing".format(
+        len(lines), len(data) / 1e6, lines.count("")))
+
+    print("%-10s %10s %14s %10s" % (
+        "engine", "time (s)", "lines (k/s)", "MB/s"))
+    for name, fn in [("line", _by_line), ("chunk", _by_chunk)]:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print("%-10s %10.3f %14.1f %10.1f" % (
+            name, elapsed, len(lines) / elapsed / 1000,
+            len(data) / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    _cli()
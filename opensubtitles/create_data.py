@@ -10,20 +10,39 @@ import json
 import logging
 import os
 import re
-import uuid
-from functools import partial
 from os import path
 
 import apache_beam as beam
 import tensorflow as tf
 from apache_beam import pvalue
+from apache_beam.io.filesystem import CompressionTypes
 from apache_beam.io.filesystems import FileSystems
+from apache_beam.io.restriction_trackers import (OffsetRange,
+                                                 OffsetRestrictionTracker)
 from apache_beam.io.textio import WriteToText
 from apache_beam.io.tfrecordio import WriteToTFRecord
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
+from apache_beam.transforms.core import RestrictionProvider
+
+from tools import shuffle
 
 _TF_FORMAT = "TF"
 _JSON_FORMAT = "JSON"
+_READ_SPLIT_SIZE = 64 * 2 ** 20
+_LOOKBACK_READ_SIZE = 2 ** 14
+_READ_CHUNK_SIZE = 2 ** 20
+
+# The speaker name and bracket patterns of `_preprocess_line` as one pattern,
+# for buffers of many lines. Every match starts with one of a set of
+# characters, which lets the regex engine skip quickly to the next candidate,
+# and the lookbehinds then check which pattern it starts. Line starts are
+# matched at the preceding line break, and no match continues past the end
+# of a line.
+_CLEAN_RE = re.compile(
+    r"[\n.!?(\[]"
+    r"(?:(?<=\n)\w+:"
+    r"|(?<=[.!?])[^\S\n]\w+:"
+    r"|(?<=[(\[])[^\n\])]*[\])])")
 
 
 def _parse_args(argv=None):
@@ -45,7 +64,7 @@ def _parse_args(argv=None):
              "one sentence per line.")
     parser.add_argument(
         "--num_extra_contexts",
-        default=10,
+        default=10, type=int,
         help="The maximum number of extra contexts in an example.")
     parser.add_argument(
         "--min_length",
@@ -78,6 +97,7 @@ def _parse_args(argv=None):
         "--num_shards_train", default=1000,
         type=_positive_int,
         help="The number of shards for the train set.")
+    shuffle.add_arguments(parser)
 
     return parser.parse_known_args(argv)
 
@@ -115,6 +135,11 @@ def create_example(previous_lines, line, file_id):
 
 
 def _preprocess_line(line):
+    """Preprocesses a single line.
+
+    This is the definition of the preprocessing. The files are read with
+    `_preprocess_lines`, which does the same for many lines at once.
+    """
     line = line.decode("utf-8")
 
     # Remove the first word if it is followed by colon (speaker names)
@@ -130,12 +155,58 @@ def _preprocess_line(line):
     return line
 
 
+def _keep_line_break(match):
+    """Removes a match of `_CLEAN_RE`, except a line break it starts with."""
+    return "\n" if match.group().startswith("\n") else ""
+
+
+def _preprocess_lines(data):
+    """Preprocesses a buffer of whole lines, like `_preprocess_line`.
+
+    This decodes the buffer and removes the speaker names and brackets of
+    all its lines with a single regex pass, then splits it into lines.
+    Returns a list with the preprocessed text of each line of the buffer.
+    """
+    # The line break before the first line lets it match as a line start.
+    text = _CLEAN_RE.sub(_keep_line_break, "\n" + data.decode("utf-8"))
+    lines = [line.strip(" -") for line in text.split("\n")[1:]]
+    if not data or data.endswith(b"\n"):
+        # There is no line after the last line break.
+        lines.pop()
+    return lines
+
+
+def _read_chunks(f):
+    """Yields chunks of about `_READ_CHUNK_SIZE` bytes of whole lines."""
+    while True:
+        chunk = f.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        if not chunk.endswith(b"\n"):
+            chunk += f.readline()
+        yield chunk
+
+
 def _create_examples_from_file(file_name, min_length, max_length,
                                num_extra_contexts):
     _, file_id = path.split(file_name)
-    previous_lines = []
-    for line in FileSystems.open(file_name, "application/octet-stream"):
-        line = _preprocess_line(line)
+    with FileSystems.open(file_name, "application/octet-stream") as f:
+        lines = (line for chunk in _read_chunks(f)
+                 for line in _preprocess_lines(chunk))
+        for example in _create_examples_from_lines(
+                lines, file_id, min_length, max_length, num_extra_contexts):
+            yield example
+
+
+def _create_examples_from_lines(lines, file_id, min_length, max_length,
+                                num_extra_contexts, previous_lines=None):
+    """Creates examples from the preprocessed lines of a file.
+
+    `previous_lines` are the preprocessed lines before `lines` in the file,
+    which are used as the contexts of the first examples.
+    """
+    previous_lines = list(previous_lines or [])
+    for line in lines:
         if not line:
             continue
 
@@ -158,6 +229,117 @@ def _create_examples_from_file(file_name, min_length, max_length,
             del previous_lines[0]
 
 
+def _is_compressed(file_name):
+    """Whether a file is compressed, and so can only be read in order."""
+    return (CompressionTypes.detect_compression_type(file_name)
+            != CompressionTypes.UNCOMPRESSED)
+
+
+class _CreateExamplesFn(beam.DoFn, RestrictionProvider):
+    """Creates examples from byte ranges of the sentence files.
+
+    A range reads the lines which start in it, after looking back for the
+    last `num_extra_contexts + 1` non-empty lines before them. These are the
+    contexts that reading the whole file in order would have, so the examples
+    are the same as those of `_create_examples_from_file`.
+
+    Compressed files can not be read from an offset, so their restriction is
+    the single position 0, and they are read in order by one worker.
+    """
+
+    def __init__(self, min_length, max_length, num_extra_contexts,
+                 split_size=_READ_SPLIT_SIZE):
+        super(_CreateExamplesFn, self).__init__()
+        self._min_length = min_length
+        self._max_length = max_length
+        self._num_extra_contexts = num_extra_contexts
+        self._split_size = split_size
+
+    def initial_restriction(self, file_name):
+        if _is_compressed(file_name):
+            return OffsetRange(0, 1)
+        metadata = FileSystems.match([file_name])[0].metadata_list[0]
+        return OffsetRange(0, metadata.size_in_bytes)
+
+    def create_tracker(self, restriction):
+        return OffsetRestrictionTracker(restriction)
+
+    def split(self, file_name, restriction):
+        return restriction.split(self._split_size)
+
+    def restriction_size(self, file_name, restriction):
+        return restriction.size()
+
+    def process(self, file_name, tracker=beam.DoFn.RestrictionParam()):
+        if _is_compressed(file_name):
+            if tracker.try_claim(0):
+                for example in _create_examples_from_file(
+                        file_name, self._min_length, self._max_length,
+                        self._num_extra_contexts):
+                    yield example
+            return
+
+        _, file_id = path.split(file_name)
+        start = tracker.current_restriction().start
+        with FileSystems.open(
+                file_name, "application/octet-stream",
+                compression_type=CompressionTypes.UNCOMPRESSED) as f:
+            position = _next_line_start(f, start)
+            previous_lines = _previous_lines(
+                f, position, self._num_extra_contexts + 1)
+            f.seek(position)
+            for example in _create_examples_from_lines(
+                    _claim_lines(f, position, tracker), file_id,
+                    self._min_length, self._max_length,
+                    self._num_extra_contexts, previous_lines):
+                yield example
+
+
+def _next_line_start(f, position):
+    """Returns the offset of the first line starting at or after position."""
+    if position == 0:
+        return 0
+    f.seek(position - 1)
+    return position - 1 + len(f.readline())
+
+
+def _previous_lines(f, end, num_lines):
+    """Returns the last non-empty preprocessed lines before the offset `end`.
+
+    `end` is the start of a line. This reads back from `end` in windows of
+    doubling size, until it finds `num_lines` lines or reaches the start of
+    the file.
+    """
+    read_size = _LOOKBACK_READ_SIZE
+    while True:
+        window_start = _next_line_start(f, max(0, end - read_size))
+        f.seek(window_start)
+        lines = [line for line in _preprocess_lines(
+            f.read(end - window_start)) if line]
+        if len(lines) >= num_lines or window_start == 0:
+            return lines[-num_lines:]
+        read_size *= 2
+
+
+def _claim_lines(f, position, tracker):
+    """Yields the preprocessed lines of f from position, while the tracker
+    claims them.
+
+    The lines are preprocessed a chunk at a time, and each line is claimed
+    at its offset in the file.
+    """
+    for chunk in _read_chunks(f):
+        line_start = 0
+        for line in _preprocess_lines(chunk):
+            if not tracker.try_claim(position + line_start):
+                return
+            yield line
+            line_start = chunk.find(b"\n", line_start) + 1 or len(chunk)
+        position += len(chunk)
+    # Claims the end of the file, which finishes the restriction.
+    tracker.try_claim(position)
+
+
 def _features_to_serialized_tf_example(features):
     """Convert a string dict to a serialized TF example.
 
@@ -170,14 +352,6 @@ def _features_to_serialized_tf_example(features):
     return example.SerializeToString()
 
 
-def _shuffle_examples(examples):
-    examples |= ("add random key" >> beam.Map(
-        lambda example: (uuid.uuid4(), example)))
-    examples |= ("group by key" >> beam.GroupByKey())
-    examples |= ("get shuffled values" >> beam.FlatMap(lambda t: t[1]))
-    return examples
-
-
 class _TrainTestSplitFn(beam.DoFn):
     """Splits an input PCollection of examples into train and test.
 
@@ -228,14 +402,18 @@ def run(argv=None):
                  len(sentence_files), args.sentence_files)
     assert len(sentence_files) > 0
     sentence_files = p | beam.Create(sentence_files)
-    examples = sentence_files | "create examples" >> beam.FlatMap(
-        partial(_create_examples_from_file,
-                min_length=args.min_length,
-                max_length=args.max_length,
-                num_extra_contexts=args.num_extra_contexts)
+    examples = sentence_files | "create examples" >> beam.ParDo(
+        _CreateExamplesFn(
+            min_length=args.min_length,
+            max_length=args.max_length,
+            num_extra_contexts=args.num_extra_contexts)
     )
 
-    examples = _shuffle_examples(examples)
+    examples |= "shuffle examples" >> shuffle.shuffle(
+        shuffle_mode=args.shuffle_mode,
+        shuffle_seed=args.shuffle_seed,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+    )
 
     examples |= "split train and test" >> beam.ParDo(
         _TrainTestSplitFn(args.train_split)).with_outputs(
@@ -267,6 +445,7 @@ def run(argv=None):
 
     result = p.run()
     result.wait_until_finish()
+    shuffle.log_shuffle_bytes(result, args.shuffle_mode)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
 """Tests for create_data.py."""
 
+import gzip
+import io
 import json
+import random
 import shutil
 import tempfile
 import unittest
 from glob import glob
 from os import path
 
+import apache_beam as beam
 import tensorflow as tf
+from apache_beam.io.restriction_trackers import OffsetRange
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
 
 # from . import create_data
 import create_data
@@ -110,7 +117,8 @@ class CreateDataPipelineTest(unittest.TestCase):
         features = create_data.create_example(previous_lines, line, file_id)
         example = tf.train.Example()
         for feature_name, feature_value in features.items():
-            example.features.feature[feature_name].bytes_list.value.append(feature_value.encode("utf-8"))
+            example.features.feature[feature_name].bytes_list.value.append(
+                feature_value.encode("utf-8"))
         return example
 
     def _read_examples(self, pattern):
@@ -193,5 +201,134 @@ class CreateDataPipelineTest(unittest.TestCase):
         return examples
 
 
+class PreprocessLinesTest(unittest.TestCase):
+    """Test preprocessing buffers of lines."""
+
+    def _preprocess_each_line(self, data):
+        return [create_data._preprocess_line(line)
+                for line in io.BytesIO(data)]
+
+    def test_preprocess_lines(self):
+        data = "\n".join([
+            "matt: AAAA",
+            "BBBB. joe: CCCC",
+            "DDDD.\tjoe: EEEE (sighs) - ",
+            "[music] - FFFF",
+            "GGGG.",
+            "bob: HHHH [",
+            "IIII) caf\xe9",
+            "",
+        ]).encode("utf-8")
+        self.assertEqual(
+            ["AAAA", "BBBB CCCC", "DDDD EEEE", "FFFF", "GGGG.", "HHHH [",
+             "IIII) caf\xe9"],
+            create_data._preprocess_lines(data))
+        self.assertEqual(
+            self._preprocess_each_line(data),
+            create_data._preprocess_lines(data))
+
+    def test_no_trailing_line_break(self):
+        self.assertEqual(
+            ["AAAA", "BBBB"], create_data._preprocess_lines(b"AAAA\nBBBB"))
+        self.assertEqual([], create_data._preprocess_lines(b""))
+        self.assertEqual([""], create_data._preprocess_lines(b"\n"))
+
+    def test_random_lines(self):
+        rng = random.Random(0)
+        pieces = ["a", "b c", ":", ".", "!", "?", " ", "\t", "\r", "-",
+                  "(", ")", "[", "]", "\n", "bob:", ". ", "\xe9", "\x85"]
+        for _ in range(2000):
+            data = "".join(
+                rng.choice(pieces)
+                for _ in range(rng.randint(0, 20))).encode("utf-8")
+            self.assertEqual(
+                self._preprocess_each_line(data),
+                create_data._preprocess_lines(data), data)
+
+
+class CreateExamplesFnTest(unittest.TestCase):
+    """Test reading the sentence files in byte ranges."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._file_name = path.join(self._temp_dir, "lines.txt")
+        with open(self._file_name, "w") as f:
+            f.write(_TRAIN_FILE + "\n" + _TEST_FILE + "EEEE\n\n(FFFF)\nGGGG")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _create_examples_fn(self, split_size=8):
+        return create_data._CreateExamplesFn(
+            min_length=4, max_length=5, num_extra_contexts=2,
+            split_size=split_size)
+
+    def _expected_examples(self, file_name):
+        return list(create_data._create_examples_from_file(
+            file_name, min_length=4, max_length=5, num_extra_contexts=2))
+
+    def _read_range(self, create_examples_fn, file_name, restriction):
+        tracker = create_examples_fn.create_tracker(restriction)
+        examples = list(create_examples_fn.process(file_name, tracker))
+        tracker.check_done()
+        return examples
+
+    def test_splits(self):
+        create_examples_fn = self._create_examples_fn()
+        restrictions = list(create_examples_fn.split(
+            self._file_name,
+            create_examples_fn.initial_restriction(self._file_name)))
+        self.assertGreater(len(restrictions), 1)
+        examples = []
+        for restriction in restrictions:
+            examples.extend(self._read_range(
+                create_examples_fn, self._file_name, restriction))
+        expected_examples = self._expected_examples(self._file_name)
+        self.assertGreater(len(expected_examples), 4)
+        self.assertEqual(expected_examples, examples)
+
+    def test_all_split_positions(self):
+        create_examples_fn = self._create_examples_fn()
+        restriction = create_examples_fn.initial_restriction(self._file_name)
+        expected_examples = self._expected_examples(self._file_name)
+        for position in range(restriction.start, restriction.stop + 1):
+            examples = (
+                self._read_range(
+                    create_examples_fn, self._file_name,
+                    OffsetRange(restriction.start, position))
+                + self._read_range(
+                    create_examples_fn, self._file_name,
+                    OffsetRange(position, restriction.stop)))
+            self.assertEqual(expected_examples, examples, position)
+
+    def test_lookback(self):
+        # The lookback has to read back several windows.
+        create_data._LOOKBACK_READ_SIZE, read_size = (
+            2, create_data._LOOKBACK_READ_SIZE)
+        try:
+            self.test_splits()
+        finally:
+            create_data._LOOKBACK_READ_SIZE = read_size
+
+    def test_compressed(self):
+        file_name = path.join(self._temp_dir, "lines.txt.gz")
+        with open(self._file_name, "rb") as f, gzip.open(file_name, "wb") as g:
+            g.write(f.read())
+        create_examples_fn = self._create_examples_fn()
+        restriction = create_examples_fn.initial_restriction(file_name)
+        self.assertEqual([restriction], list(
+            create_examples_fn.split(file_name, restriction)))
+        self.assertEqual(
+            self._expected_examples(file_name),
+            self._read_range(create_examples_fn, file_name, restriction))
+
+    def test_pipeline(self):
+        with TestPipeline() as p:
+            examples = p | beam.Create([self._file_name]) | beam.ParDo(
+                self._create_examples_fn())
+            assert_that(examples, equal_to(
+                self._expected_examples(self._file_name)))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,364 @@
+"""Micro-benchmarks for the reddit dataset scripts.
+
+These run on synthetic data on the local machine, and do not need a
+BigQuery table or a Beam runner.
+
+Usage:
+
+To compare the path engine in create_data.py with the previous
+implementation, on synthetic wide and deep threads:
+
+    python -m reddit.benchmark paths --num_comments 100000
+
+To compare `create_data.trim` with the previous implementation, on
+comment bodies with a log-normal length distribution:
+
+    python -m reddit.benchmark trim --num_bodies 100000
+
+To compare the size and speed of the comment coders with pickling the
+comments, which is what Beam did before they were registered:
+
+    python -m reddit.benchmark coder --num_comments 100000
+
+To compare the size of the path examples written by create_data_v2.py with
+the TREE format, on the test threads and synthetic threads:
+
+    python -m reddit.benchmark tree_size
+
+To compare the number of language detector calls per thread in
+create_data_v2.py, with detection per path and per comment:
+
+    python -m reddit.benchmark lang_calls --num_comments 1000
+"""
+
+import json
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from unittest import mock
+
+import apache_beam as beam
+import click
+
+from reddit import create_data, create_data_v2
+
+
+@click.group()
+def _cli():
+    """Micro-benchmarks for the reddit dataset scripts."""
+    pass
+
+
+def _legacy_linear_paths(id_to_comment, parent_depth):
+    """The previous `linear_paths`, which copies a list for every comment."""
+    paths = []
+    seen_ids = set()
+    id_to_children = defaultdict(list)
+    for comment_id, comment in id_to_comment.items():
+        id_to_children[comment.parent_id].append(comment_id)
+        if comment.parent_id not in id_to_comment:
+            paths.append([comment_id])
+            seen_ids.add(comment_id)
+
+    while paths:
+        new_paths = []
+        for path in paths:
+            last_id = path[-1]
+            for child_id in id_to_children[last_id]:
+                if child_id in seen_ids:
+                    continue
+                seen_ids.add(child_id)
+                new_path = path[-parent_depth:] + [child_id]
+                new_paths.append(new_path)
+                yield new_path
+        paths = new_paths
+
+
+def _consume_legacy_windows(id_to_comment, parent_depth):
+    """Reads every window the way the previous `create_examples` did."""
+    for linear_path in _legacy_linear_paths(id_to_comment, parent_depth):
+        id_to_comment[linear_path[-1]]
+        id_to_comment[linear_path[-2]]
+        for i in range(parent_depth - 1):
+            try:
+                id_to_comment[linear_path[-3 - i]]
+            except IndexError:
+                break
+
+
+def _consume_windows(id_to_comment, parent_depth):
+    """Reads every window the way `create_data.create_examples` does."""
+    for response_id, context_id, extra_context_ids in (
+            create_data.linear_path_windows(id_to_comment, parent_depth)):
+        id_to_comment[response_id]
+        id_to_comment[context_id]
+        for context_i in extra_context_ids:
+            id_to_comment[context_i]
+
+
+def _synthetic_thread(shape, num_comments):
+    """Creates an `id_to_comment` dict for a synthetic thread.
+
+    Shapes:
+        wide: every comment is a reply to the submission.
+        deep: a single chain of replies.
+        bushy: every comment has three replies.
+    """
+    def _parent_id(i):
+        if shape == "wide" or i == 0:
+            return "submission"
+        if shape == "deep":
+            return str(i - 1)
+        assert shape == "bushy"
+        return str((i - 1) // 3)
+
+    return {
+        str(i): create_data.Comment(
+            id=str(i),
+            thread_id="submission",
+            parent_id=_parent_id(i),
+            body="body",
+            body_is_trimmed=False,
+            author="author",
+            subreddit="subreddit",
+        )
+        for i in range(num_comments)
+    }
+
+
+def _measure(fn, *args):
+    """Returns the time in seconds and peak traced memory in bytes of fn."""
+    tracemalloc.start()
+    start = time.time()
+    fn(*args)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+@_cli.command(name="paths")
+@click.option("--num_comments", type=int, default=100000)
+@click.option("--parent_depth", type=int, default=10)
+def _paths(num_comments, parent_depth):
+    """Compare the path engines on synthetic wide, deep and bushy threads."""
+    print("%-6s %-8s %10s %12s" % ("shape", "engine", "time (s)", "peak (MB)"))
+    for shape in ["wide", "deep", "bushy"]:
+        id_to_comment = _synthetic_thread(shape, num_comments)
+        for name, fn in [("legacy", _consume_legacy_windows),
+                         ("windows", _consume_windows)]:
+            elapsed, peak = _measure(fn, id_to_comment, parent_depth)
+            print("%-6s %-8s %10.3f %12.2f" % (
+                shape, name, elapsed, peak / 1e6))
+
+
+def _legacy_trim(text, max_length):
+    """The previous `trim`, which removes one character at a time."""
+    if len(text) <= max_length:
+        return text
+
+    text = text[:max_length + 1]
+    while len(text) > 1 and (text[-1].isalnum() == text[-2].isalnum()):
+        text = text[:-1]
+
+    return text[:-1]
+
+
+def _synthetic_bodies(num_bodies, median_length, seed):
+    """Creates comment bodies with log-normally distributed lengths.
+
+    Most reddit comments are short, but there is a long tail up to the
+    10000 character limit, which is where trimming is expensive.
+    """
+    rng = random.Random(seed)
+    words = ["the", "reddit", "comment", "is", "a", "longer", "word", "1234",
+             "...", "!", "(link)", "http://example.com/a/b?c=d"]
+    bodies = []
+    for _ in range(num_bodies):
+        length = min(10000, int(rng.lognormvariate(0, 1.2) * median_length))
+        body = []
+        body_length = 0
+        while body_length < length:
+            word = rng.choice(words)
+            body.append(word)
+            body_length += len(word) + 1
+        bodies.append(" ".join(body)[:length])
+    return bodies
+
+
+@_cli.command(name="trim")
+@click.option("--num_bodies", type=int, default=100000)
+@click.option("--median_length", type=int, default=100)
+@click.option("--max_length", type=int, default=127)
+@click.option("--seed", type=int, default=0)
+def _trim(num_bodies, median_length, max_length, seed):
+    """Compare the trim implementations on synthetic comment bodies."""
+    bodies = _synthetic_bodies(num_bodies, median_length, seed)
+    num_trimmed = sum(len(body) > max_length for body in bodies)
+    print("{} bodies, {} longer than {} characters".format(
+        len(bodies), num_trimmed, max_length))
+
+    def _trim_each(fn):
+        return [fn(body, max_length) for body in bodies]
+
+    legacy = _trim_each(_legacy_trim)
+    assert legacy == create_data.trim_batch(bodies, max_length)
+
+    print("%-10s %10s" % ("engine", "time (s)"))
+    for name, fn in [
+            ("legacy", lambda: _trim_each(_legacy_trim)),
+            ("trim", lambda: _trim_each(create_data.trim)),
+            ("batch", lambda: create_data.trim_batch(bodies, max_length))]:
+        start = time.time()
+        fn()
+        print("%-10s %10.3f" % (name, time.time() - start))
+
+
+def _synthetic_comments(num_comments, seed):
+    """Creates v1 comments, with bodies from `_synthetic_bodies`."""
+    rng = random.Random(seed)
+    bodies = _synthetic_bodies(num_comments, 100, seed)
+    return [
+        create_data.Comment(
+            id="d{:06x}".format(i),
+            thread_id="t{:05x}".format(i // 100),
+            parent_id="d{:06x}".format(max(0, i - rng.randint(1, 10))),
+            body=body,
+            body_is_trimmed=False,
+            author="author{}".format(rng.randint(0, 1000)),
+            subreddit="subreddit{}".format(rng.randint(0, 10)),
+        )
+        for i, body in enumerate(bodies)
+    ]
+
+
+@_cli.command(name="coder")
+@click.option("--num_comments", type=int, default=100000)
+@click.option("--seed", type=int, default=0)
+def _coder(num_comments, seed):
+    """Compare the comment coders with pickling."""
+    comments = _synthetic_comments(num_comments, seed)
+    v2_comments = [
+        create_data_v2.Comment(
+            id=comment.id,
+            thread_id=comment.thread_id,
+            parent_id=comment.parent_id,
+            body=comment.body,
+            author=comment.author,
+            subreddit=comment.subreddit,
+        )
+        for comment in comments
+    ]
+    # Before the coders, v2 comments were dicts.
+    v2_dicts = [dict(comment._asdict()) for comment in v2_comments]
+
+    print("%-22s %14s %14s %14s" % (
+        "coder", "bytes/comment", "encode (k/s)", "decode (k/s)"))
+    for name, coder, values in [
+            ("v1 pickle", beam.coders.PickleCoder(), comments),
+            ("v1 fast primitives", beam.coders.FastPrimitivesCoder(),
+             comments),
+            ("v1 comment coder", create_data._CommentCoder(), comments),
+            ("v2 pickled dict", beam.coders.PickleCoder(), v2_dicts),
+            ("v2 comment coder", create_data_v2._CommentCoder(),
+             v2_comments)]:
+        start = time.time()
+        encoded = [coder.encode(value) for value in values]
+        encode_time = time.time() - start
+        start = time.time()
+        decoded = [coder.decode(value) for value in encoded]
+        decode_time = time.time() - start
+        assert decoded == values
+        print("%-22s %14.1f %14.1f %14.1f" % (
+            name,
+            sum(len(value) for value in encoded) / float(len(values)),
+            len(values) / encode_time / 1000,
+            len(values) / decode_time / 1000))
+
+
+@_cli.command(name="tree_size")
+@click.option("--num_comments", type=int, default=1000)
+def _tree_size(num_comments):
+    """Compare the TF and TREE output sizes of create_data_v2.py."""
+    threads = []
+    for file_name in ["reddit/testdata/simple_thread.json",
+                      "reddit/testdata/thread.json"]:
+        with open(file_name) as f:
+            threads.append((file_name, [
+                create_data_v2.normalise_comment(comment)
+                for comment in json.loads(f.read())]))
+    for shape in ["wide", "deep", "bushy"]:
+        threads.append(("{} ({} comments)".format(shape, num_comments), [
+            create_data_v2.Comment(
+                id=comment.id,
+                thread_id=comment.thread_id,
+                parent_id=comment.parent_id,
+                body="a comment body of about fifty characters, like this",
+                author=comment.author,
+                subreddit=comment.subreddit,
+            )
+            for comment in _synthetic_thread(shape, num_comments).values()
+        ]))
+
+    print("%-40s %12s %12s %8s" % (
+        "thread", "TF bytes", "TREE bytes", "ratio"))
+    for name, comments in threads:
+        tf_bytes = sum(
+            len(create_data_v2._features_to_serialized_tf_example(example))
+            for example in create_data_v2.create_examples(
+                comments, skip_single_comment=False, detect_lang=False))
+        tree_bytes = len(create_data_v2._tree_to_serialized_tf_example(
+            create_data_v2.create_tree_example(comments)))
+        print("%-40s %12d %12d %8.2f" % (
+            name, tf_bytes, tree_bytes, tf_bytes / float(tree_bytes)))
+
+
+@_cli.command(name="lang_calls")
+@click.option("--num_comments", type=int, default=1000)
+def _lang_calls(num_comments):
+    """Count language detector calls per thread in create_data_v2.py."""
+    get_language = create_data_v2.cld3.get_language
+    num_chars = [0]
+
+    def _counting_get_language(text):
+        num_chars[0] += len(text)
+        return get_language(text)
+
+    print("%-8s %-8s %8s %10s %12s %10s" % (
+        "shape", "level", "paths", "calls", "characters", "time (s)"))
+    for shape in ["wide", "deep", "bushy"]:
+        bodies = _synthetic_bodies(num_comments, 100, seed=0)
+        comments = [
+            comment._replace(body=body)
+            for comment, body in zip(
+                _synthetic_thread(shape, num_comments).values(), bodies)
+        ]
+        for level in [create_data_v2._PATH_LANG_DETECTION,
+                      create_data_v2._COMMENT_LANG_DETECTION]:
+            num_chars[0] = 0
+            with mock.patch.object(
+                    create_data_v2.cld3, "get_language",
+                    side_effect=_counting_get_language) as counter:
+                start = time.time()
+                num_paths = len(list(create_data_v2.create_examples(
+                    [create_data_v2.Comment(
+                        id=comment.id,
+                        thread_id=comment.thread_id,
+                        parent_id=comment.parent_id,
+                        body=comment.body,
+                        author=comment.author,
+                        subreddit=comment.subreddit,
+                    ) for comment in comments],
+                    skip_single_comment=False,
+                    detect_lang=True,
+                    lang_detection_level=level,
+                )))
+                elapsed = time.time() - start
+            print("%-8s %-8s %8d %10d %12d %10.3f" % (
+                shape, level, num_paths, counter.call_count, num_chars[0],
+                elapsed))
+
+
+if __name__ == "__main__":
+    _cli()
@@ -9,21 +9,37 @@ import hashlib
 import json
 import logging
 import os
+import random
 import re
-import uuid
+import sys
 from collections import defaultdict, namedtuple
 from functools import partial
+from typing import Tuple
 
 import apache_beam as beam
 import tensorflow as tf
 from apache_beam import pvalue
-from apache_beam.io import BigQuerySource, Read
+from apache_beam.coders import coder_impl
+from apache_beam.io import BigQuerySource, Read, ReadFromBigQuery
 from apache_beam.io.textio import WriteToText
 from apache_beam.io.tfrecordio import WriteToTFRecord
+from apache_beam.metrics import Metrics, MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
 
+from tools import shuffle
+
 _TF_FORMAT = "TF"
 _JSON_FORMAT = "JSON"
+_EXPORT_READ = "EXPORT"
+_DIRECT_READ = "DIRECT_READ"
+_BYTES_READ_COUNTER = "bigquery_bytes_read"
+_BYTES_SAVED_COUNTER = "bigquery_bytes_saved"
+
+# The BigQuery columns used by `normalise_comment`, and `created_utc`, which
+# `_RestrictRowsFn` checks against --min_created_utc and --max_created_utc.
+_SELECTED_FIELDS = [
+    "id", "link_id", "parent_id", "body", "author", "subreddit", "score",
+    "created_utc"]
 
 
 def _parse_args(argv=None):
@@ -75,6 +91,14 @@ def _parse_args(argv=None):
         default=9,
         help="Minimum length of comments to include.",
     )
+    parser.add_argument(
+        "--skeleton_comments",
+        action="store_true",
+        help="Replace comments that can not be a context or a response with "
+             "a skeleton, without a body, before grouping comments by "
+             "thread. They still link their replies to the thread, but are "
+             "not used as extra contexts.",
+    )
     parser.add_argument(
         "--train_split",
         default=0.9, type=float,
@@ -92,9 +116,210 @@ def _parse_args(argv=None):
         type=_positive_int,
         help="The number of shards for the train set.",
     )
+    parser.add_argument(
+        "--hot_thread_threshold",
+        type=_positive_int,
+        default=None,
+        help="If set, threads with more comments than this are split into "
+             "partitions of replies which are processed in parallel, rather "
+             "than as a single element.",
+    )
+    parser.add_argument(
+        "--hot_thread_partition_size",
+        type=_positive_int,
+        default=10000,
+        help="The approximate number of comments in each partition of a "
+             "thread split by --hot_thread_threshold.",
+    )
+    parser.add_argument(
+        "--max_paths_per_thread",
+        type=_positive_int,
+        default=None,
+        help="If set, at most this many linear paths are sampled from "
+             "each thread, or each partition of a hot thread.",
+    )
+    parser.add_argument(
+        "--max_examples_per_thread",
+        type=_positive_int,
+        default=None,
+        help="If set, at most this many examples are sampled from each "
+             "thread, or each partition of a hot thread.",
+    )
+    parser.add_argument(
+        "--max_children",
+        type=_positive_int,
+        default=None,
+        help="If set, linear paths only follow the replies to each comment "
+             "with the highest this many scores.",
+    )
+    parser.add_argument(
+        "--drop_negative_scores",
+        action="store_true",
+        help="Do not follow comments with a negative score, or their "
+             "replies.",
+    )
+    parser.add_argument(
+        "--sampling_seed",
+        default=0, type=int,
+        help="The seed for --max_paths_per_thread and "
+             "--max_examples_per_thread, which is combined with the thread "
+             "id.",
+    )
+    shuffle.add_arguments(parser)
+    parser.add_argument(
+        "--bigquery_read_method",
+        choices=[_EXPORT_READ, _DIRECT_READ],
+        default=_EXPORT_READ,
+        help="How to read the reddit table. 'EXPORT' exports the whole table "
+             "to files first. 'DIRECT_READ' uses the BigQuery Storage Read "
+             "API, which only reads the columns used by the pipeline, and "
+             "applies the row restrictions in BigQuery.",
+    )
+    parser.add_argument(
+        "--subreddits",
+        help="A comma separated list of subreddits to read comments from. "
+             "By default all subreddits are read.",
+    )
+    parser.add_argument(
+        "--min_created_utc",
+        type=int,
+        help="If set, only read comments created at or after this unix "
+             "timestamp.",
+    )
+    parser.add_argument(
+        "--max_created_utc",
+        type=int,
+        help="If set, only read comments created before this unix timestamp.",
+    )
+    parser.add_argument(
+        "--max_body_length",
+        type=_positive_int,
+        help="If set, only read comments with at most this many characters. "
+             "Longer comments are removed from their threads altogether, "
+             "rather than only being skipped as contexts and responses.",
+    )
     return parser.parse_known_args(argv)
 
 
+def _row_restriction(subreddits=None, min_created_utc=None,
+                     max_created_utc=None, max_body_length=None):
+    """Creates a BigQuery row restriction from the read flags.
+
+    Returns None if there is nothing to restrict.
+    """
+    restrictions = []
+    if subreddits:
+        restrictions.append("subreddit IN ({})".format(", ".join(
+            json.dumps(subreddit) for subreddit in subreddits)))
+    if min_created_utc is not None:
+        restrictions.append("created_utc >= {}".format(min_created_utc))
+    if max_created_utc is not None:
+        restrictions.append("created_utc < {}".format(max_created_utc))
+    if max_body_length is not None:
+        restrictions.append("LENGTH(body) <= {}".format(max_body_length))
+    return " AND ".join(restrictions) or None
+
+
+def _estimate_value_bytes(value):
+    """Estimates the size of a BigQuery value, as BigQuery counts it."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, bytes):
+        return len(value)
+    return 2 + len(value.encode("utf-8"))
+
+
+class _RestrictRowsFn(beam.DoFn):
+    """Applies the column projection and row restriction of a direct read.
+
+    With `--bigquery_read_method=DIRECT_READ` BigQuery has already applied
+    them, and this only counts the bytes read. Otherwise this applies them
+    to the exported or in-memory rows, which is also how tests fake the
+    direct read, and counts the bytes a direct read would save.
+    """
+
+    def __init__(self, subreddits=None, min_created_utc=None,
+                 max_created_utc=None, max_body_length=None):
+        super(_RestrictRowsFn, self).__init__()
+        self._subreddits = set(subreddits) if subreddits else None
+        self._min_created_utc = min_created_utc
+        self._max_created_utc = max_created_utc
+        self._max_body_length = max_body_length
+        self._bytes_read = Metrics.counter(
+            self.__class__, _BYTES_READ_COUNTER)
+        self._bytes_saved = Metrics.counter(
+            self.__class__, _BYTES_SAVED_COUNTER)
+
+    def process(self, row):
+        row_bytes = sum(_estimate_value_bytes(value) for value in row.values())
+        if not self._matches(row):
+            self._bytes_saved.inc(row_bytes)
+            return
+        selected_row = {field: row.get(field) for field in _SELECTED_FIELDS}
+        selected_bytes = sum(
+            _estimate_value_bytes(value) for value in selected_row.values())
+        self._bytes_read.inc(selected_bytes)
+        self._bytes_saved.inc(row_bytes - selected_bytes)
+        yield selected_row
+
+    def _matches(self, row):
+        """Whether the row matches the row restriction."""
+        if self._subreddits and row['subreddit'] not in self._subreddits:
+            return False
+        if (self._min_created_utc is not None
+                or self._max_created_utc is not None):
+            if row.get('created_utc') is None:
+                return False
+            created_utc = int(row['created_utc'])
+            if (self._min_created_utc is not None
+                    and created_utc < self._min_created_utc):
+                return False
+            if (self._max_created_utc is not None
+                    and created_utc >= self._max_created_utc):
+                return False
+        if (self._max_body_length is not None
+                and len(row['body']) > self._max_body_length):
+            return False
+        return True
+
+
+def _log_direct_read_estimate(reddit_table, row_restriction):
+    """Logs the bytes a direct read scans, using a BigQuery dry run."""
+    from google.cloud import bigquery
+
+    client = bigquery.Client()
+    table_name = reddit_table.replace(":", ".")
+    table = client.get_table(table_name)
+    query = "SELECT {} FROM `{}`".format(
+        ", ".join(_SELECTED_FIELDS), table_name)
+    if row_restriction:
+        query += " WHERE " + row_restriction
+    job = client.query(query, job_config=bigquery.QueryJobConfig(
+        dry_run=True, use_query_cache=False))
+    logging.info(
+        "The direct read scans %i of the %i bytes in %s, saving %i bytes.",
+        job.total_bytes_processed, table.num_bytes, reddit_table,
+        table.num_bytes - job.total_bytes_processed)
+
+
+def _log_bytes_read(result):
+    """Logs the bytes counted by `_RestrictRowsFn`."""
+    bytes_counted = {}
+    for counter_name in [_BYTES_READ_COUNTER, _BYTES_SAVED_COUNTER]:
+        counters = result.metrics().query(
+            MetricsFilter().with_name(counter_name))['counters']
+        bytes_counted[counter_name] = sum(
+            counter.result for counter in counters)
+    logging.info(
+        "Read %i bytes of comments, a direct read saves %i bytes.",
+        bytes_counted[_BYTES_READ_COUNTER],
+        bytes_counted[_BYTES_SAVED_COUNTER])
+
+
 # Represent a reddit comment.
 Comment = namedtuple(
     "Comment",
@@ -106,10 +331,101 @@ Comment = namedtuple(
         "body_is_trimmed",
         "author",
         "subreddit",
-    ]
+        "score",
+    ],
+    defaults=(None,),
 )
 
 
+def _write_text(stream, text):
+    """Writes optional text as a varint length prefix and UTF-8 bytes.
+
+    The prefix is the length plus one, so that 0 can stand for None.
+    """
+    if text is None:
+        stream.write_var_int64(0)
+        return
+    encoded = text.encode("utf-8")
+    stream.write_var_int64(len(encoded) + 1)
+    stream.write(encoded)
+
+
+def _read_text(stream):
+    """Reads text written by `_write_text`."""
+    length = stream.read_var_int64()
+    if length == 0:
+        return None
+    return stream.read(length - 1).decode("utf-8")
+
+
+def _write_score(stream, score):
+    """Writes an optional score as a presence byte and a varint."""
+    if score is None:
+        stream.write_byte(0)
+        return
+    stream.write_byte(1)
+    stream.write_var_int64(score)
+
+
+def _read_score(stream):
+    """Reads a score written by `_write_score`."""
+    if not stream.read_byte():
+        return None
+    return stream.read_var_int64()
+
+
+def _intern(text):
+    return None if text is None else sys.intern(text)
+
+
+class _CommentCoder(beam.coders.Coder):
+    """A compact, deterministic Beam coder for `Comment`.
+
+    The text fields are written in order with `_write_text`, followed by a
+    byte for `body_is_trimmed` and the score, so the field names are not
+    repeated in every encoded comment as they are when pickling. The thread
+    ids and subreddits are interned when decoding, so the comments of a
+    thread share them.
+    """
+
+    def encode(self, comment):
+        stream = coder_impl.create_OutputStream()
+        for text in (comment.id, comment.thread_id, comment.parent_id,
+                     comment.body, comment.author, comment.subreddit):
+            _write_text(stream, text)
+        stream.write_byte(1 if comment.body_is_trimmed else 0)
+        _write_score(stream, comment.score)
+        return stream.get()
+
+    def decode(self, encoded):
+        stream = coder_impl.create_InputStream(encoded)
+        comment_id = _read_text(stream)
+        thread_id = _intern(_read_text(stream))
+        parent_id = _read_text(stream)
+        body = _read_text(stream)
+        author = _read_text(stream)
+        subreddit = _intern(_read_text(stream))
+        return Comment(
+            id=comment_id,
+            thread_id=thread_id,
+            parent_id=parent_id,
+            body=body,
+            body_is_trimmed=bool(stream.read_byte()),
+            author=author,
+            subreddit=subreddit,
+            score=_read_score(stream),
+        )
+
+    def is_deterministic(self):
+        return True
+
+    def to_type_hint(self):
+        return Comment
+
+
+beam.coders.registry.register_coder(Comment, _CommentCoder)
+
+
 def normalise_comment(comment, max_length):
     """Create a _Comment object from a row in the BigQuery table."""
     return Comment(
@@ -120,9 +436,15 @@ def normalise_comment(comment, max_length):
         body_is_trimmed=len(comment['body']) > max_length,
         author=comment['author'],
         subreddit=comment['subreddit'],
+        score=_normalise_score(comment.get('score')),
     )
 
 
+def _normalise_score(raw_score):
+    """Scores are integers, or strings in the exported tables."""
+    return None if raw_score is None else int(raw_score)
+
+
 def _normalise_id(raw_id):
     """Reddit IDs start with t1_, t2_, etc. which need to be stripped."""
     return re.sub("^t[0-9]_", "", raw_id)
@@ -133,17 +455,28 @@ def trim(text, max_length):
     if len(text) <= max_length:
         return text
 
-    text = text[:max_length + 1]
+    # Cut at the last boundary between an alphanumeric character and a
+    # non-alphanumeric character, before the first character that does
+    # not fit. This scans back over a single run of characters, rather
+    # than shortening the text one character at a time.
+    end = max_length
+    is_alnum = text[end].isalnum()
+    while end > 0 and text[end - 1].isalnum() == is_alnum:
+        end -= 1
+    return text[:end]
 
-    # Trim until the last two characters are the boundary between an
-    # alphanumeric character, and a non-alphanumeric character.
-    while len(text) > 1 and (text[-1].isalnum() == text[-2].isalnum()):
-        text = text[:-1]
 
-    return text[:-1]
+def trim_batch(texts, max_length):
+    """Trims a list of texts with `trim`, returning a new list."""
+    return [
+        text if len(text) <= max_length else trim(text, max_length)
+        for text in texts
+    ]
 
 
 def _should_skip(comment, min_length):
+    if comment.body is None:
+        return True
     if comment.body_is_trimmed:
         return True
     if comment.body in {"[deleted]", "[removed]"}:
@@ -153,13 +486,64 @@ def _should_skip(comment, min_length):
     return False
 
 
-def create_examples(thread, parent_depth, min_length):
-    """Creates serialized tensorflow examples from a reddit thread."""
+def _skeleton_comment(comment, min_length):
+    """Replaces a comment that `_should_skip` rejects with a skeleton.
+
+    The skeleton only keeps what is needed to link its replies to the
+    thread, so that less data is shuffled when grouping by thread.
+    """
+    if not _should_skip(comment, min_length):
+        return comment
+    return Comment(
+        id=comment.id,
+        thread_id=comment.thread_id,
+        parent_id=comment.parent_id,
+        body=None,
+        body_is_trimmed=comment.body_is_trimmed,
+        author=None,
+        subreddit=None,
+        score=comment.score,
+    )
+
+
+def create_examples(thread, parent_depth, min_length, context_ids=(),
+                    max_paths_per_thread=None, max_examples_per_thread=None,
+                    sampling_seed=0, max_children=None,
+                    drop_negative_scores=False):
+    """Creates serialized tensorflow examples from a reddit thread.
+
+    Comments in `context_ids` are only used as (extra) contexts, and never
+    as responses. This is used for partitions of hot threads, which carry
+    the ancestors of their top comments from other partitions.
+
+    If `max_paths_per_thread` or `max_examples_per_thread` are set, at
+    most that many linear paths or examples are sampled from the thread,
+    with a seed from `sampling_seed` and the thread id.
+
+    `max_children` and `drop_negative_scores` prune the replies followed by
+    the linear paths, see `linear_path_windows`.
+    """
     id_to_comment = {comment.id: comment for comment in list(thread)}
+    windows = (
+        window for window in linear_path_windows(
+            id_to_comment, parent_depth, max_children=max_children,
+            drop_negative_scores=drop_negative_scores)
+        if window[0] not in context_ids)
+    if max_paths_per_thread or max_examples_per_thread:
+        rng = _thread_random(id_to_comment, sampling_seed)
+    if max_paths_per_thread:
+        windows = _reservoir_sample(windows, max_paths_per_thread, rng)
+    examples = _create_window_examples(id_to_comment, windows, min_length)
+    if max_examples_per_thread:
+        examples = _reservoir_sample(examples, max_examples_per_thread, rng)
+    return examples
 
-    for linear_path in linear_paths(id_to_comment, parent_depth):
-        response = id_to_comment[linear_path[-1]]
-        context = id_to_comment[linear_path[-2]]  # guaranteed to exist.
+
+def _create_window_examples(id_to_comment, windows, min_length):
+    """Creates an example from each window of `linear_path_windows`."""
+    for response_id, context_id, extra_context_ids in windows:
+        response = id_to_comment[response_id]
+        context = id_to_comment[context_id]
 
         if (_should_skip(response, min_length)
                 or _should_skip(context, min_length)):
@@ -173,19 +557,41 @@ def create_examples(thread, parent_depth, min_length):
         example['context'] = context.body
         example['response'] = response.body
 
-        for i in range(parent_depth - 1):
-            # Extra contexts start at index -3.
-            index = -3 - i
-            try:
-                context_i = linear_path[index]
-            except IndexError:
+        for i, context_i in enumerate(extra_context_ids):
+            extra_context = id_to_comment[context_i]
+            if extra_context.body is None:
+                # Skeleton comments have no body, so the extra contexts
+                # stop at the first one.
                 break
-
-            example['context/{}'.format(i)] = id_to_comment[context_i].body
+            example['context/{}'.format(i)] = extra_context.body
 
         yield example
 
 
+def _thread_random(id_to_comment, seed):
+    """Returns a random number generator seeded by `seed` and the thread."""
+    for comment in id_to_comment.values():
+        return random.Random("{}/{}".format(seed, comment.thread_id))
+    return random.Random(seed)
+
+
+def _reservoir_sample(values, sample_size, rng):
+    """Samples at most `sample_size` of the values, in their original order.
+
+    This is reservoir sampling, so only the sample is held in memory.
+    """
+    reservoir = []
+    for i, value in enumerate(values):
+        if i < sample_size:
+            reservoir.append((i, value))
+            continue
+        j = rng.randint(0, i)
+        if j < sample_size:
+            reservoir[j] = (i, value)
+    reservoir.sort(key=lambda indexed_value: indexed_value[0])
+    return [value for _, value in reservoir]
+
+
 def _features_to_serialized_tf_example(features):
     """Convert a string dict to a serialized TF example.
 
@@ -203,45 +609,317 @@ def linear_paths(id_to_comment, parent_depth):
 
     Each linear path is guaranteed to have at least two comments in it.
     """
-    paths = []
-    seen_ids = set()
+    for response_id, context_id, extra_context_ids in linear_path_windows(
+            id_to_comment, parent_depth):
+        path = [response_id, context_id]
+        path.extend(extra_context_ids)
+        path.reverse()
+        yield path
+
+
+def linear_path_windows(id_to_comment, parent_depth, max_children=None,
+                        drop_negative_scores=False):
+    """Streams the linear paths of the thread as windows ending in a reply.
+
+    Comments are visited breadth first, in the same order as `linear_paths`.
+    Instead of copying a path for every comment, each visited comment only
+    records a pointer to its parent, so the paths share their prefixes and
+    memory stays proportional to the size of the thread.
+
+    If `max_children` is set, only the replies to each comment (or the top
+    comments of the thread) with the highest `max_children` scores are
+    visited. With `drop_negative_scores`, comments with a negative score,
+    and their replies, are not visited.
+
+    Yields:
+        (response_id, context_id, extra_context_ids) tuples, where
+        `extra_context_ids` lazily walks up to `parent_depth - 1` further
+        ancestors, starting from the context's parent.
+    """
+    parent_of = {}
+    frontier = []
     id_to_children = defaultdict(list)
     for comment_id, comment in id_to_comment.items():
         id_to_children[comment.parent_id].append(comment_id)
-        if comment.parent_id not in id_to_comment:
-            paths.append([comment_id])
-            seen_ids.add(comment_id)
-
-    while paths:
-        new_paths = []
-        for path in paths:
-            last_id = path[-1]
-            for child_id in id_to_children[last_id]:
-                if child_id in seen_ids:
+    if max_children or drop_negative_scores:
+        id_to_children = _prune_children(
+            id_to_children,
+            {comment_id: comment.score
+             for comment_id, comment in id_to_comment.items()},
+            max_children, drop_negative_scores)
+    root_ids = set()
+    for parent_id, child_ids in id_to_children.items():
+        if parent_id not in id_to_comment:
+            root_ids.update(child_ids)
+    for comment_id in id_to_comment:
+        if comment_id in root_ids:
+            frontier.append(comment_id)
+            parent_of[comment_id] = None
+
+    while frontier:
+        new_frontier = []
+        for parent_id in frontier:
+            for child_id in id_to_children[parent_id]:
+                if child_id in parent_of:
                     # Prevent infinite loops.
                     continue
-                seen_ids.add(child_id)
-                new_path = path[-parent_depth:] + [child_id]
-                new_paths.append(new_path)
-                yield new_path
-        paths = new_paths
+                parent_of[child_id] = parent_id
+                new_frontier.append(child_id)
+                yield child_id, parent_id, _ancestors(
+                    parent_of, parent_id, parent_depth - 1)
+        frontier = new_frontier
+
+
+def _prune_children(id_to_children, id_to_score, max_children,
+                    drop_negative_scores):
+    """Keeps the replies to each comment with the highest scores.
+
+    The kept replies stay in their original order. Comments without a score
+    count as a score of 0.
+    """
+    pruned = defaultdict(list)
+    for parent_id, child_ids in id_to_children.items():
+        scores = {
+            child_id: id_to_score[child_id] or 0 for child_id in child_ids}
+        if drop_negative_scores:
+            child_ids = [
+                child_id for child_id in child_ids if scores[child_id] >= 0]
+        if max_children and len(child_ids) > max_children:
+            kept_ids = set(sorted(
+                child_ids, key=lambda child_id: -scores[child_id]
+            )[:max_children])
+            child_ids = [
+                child_id for child_id in child_ids if child_id in kept_ids]
+        pruned[parent_id] = child_ids
+    return pruned
 
 
-def _shuffle(pcollection):
-    """Shuffles the input pcollection."""
-    pcollection |= "add random key" >> beam.Map(
-        lambda value: (uuid.uuid4(), value))
-    pcollection |= "group by key" >> beam.GroupByKey()
-    pcollection |= "get shuffled values" >> beam.FlatMap(lambda t: t[1])
-    return pcollection
+def _ancestors(parent_of, comment_id, max_ancestors):
+    """Yields at most `max_ancestors` ancestors of a comment, nearest first."""
+    for _ in range(max_ancestors):
+        comment_id = parent_of[comment_id]
+        if comment_id is None:
+            return
+        yield comment_id
+
+
+def _plan_thread_partitions(comment_links, parent_depth, partition_size,
+                            max_children=None, drop_negative_scores=False):
+    """Splits a thread into partitions of roughly `partition_size` comments.
+
+    Partitions are sibling subtrees, grouped bottom up so that each one holds
+    between `partition_size` and twice as many comments. The comments are
+    visited in the same order as `linear_path_windows`, so comments that are
+    not on any linear path are left out.
+
+    The replies are pruned by `max_children` and `drop_negative_scores` here,
+    over the whole thread, as each partition only has some of the replies
+    to a comment. Pruning a partition again keeps all of its replies.
+
+    Args:
+        comment_links: (comment_id, parent_id, score) tuples for the thread.
+        parent_depth: how many parent comments are considered.
+        partition_size: the target number of comments per partition.
+        max_children: if set, only the replies to each comment with the
+            highest this many scores are kept.
+        drop_negative_scores: whether to drop comments with a negative
+            score, and their replies.
+
+    Returns:
+        a list of (comment_id, partition, is_context) tuples. Every comment
+        appears once with `is_context=False`. The parent of a partition's top
+        comments, and its ancestors up to `parent_depth` comments in total,
+        also appear with `is_context=True`, so the partition can build the
+        same examples as the whole thread.
+    """
+    id_to_parent = {}
+    id_to_score = {}
+    for comment_id, parent_id, score in comment_links:
+        id_to_parent[comment_id] = parent_id
+        id_to_score[comment_id] = score
+    id_to_children = defaultdict(list)
+    for comment_id, parent_id in id_to_parent.items():
+        id_to_children[parent_id].append(comment_id)
+    if max_children or drop_negative_scores:
+        id_to_children = _prune_children(
+            id_to_children, id_to_score, max_children, drop_negative_scores)
+    root_ids = set()
+    for parent_id, child_ids in id_to_children.items():
+        if parent_id not in id_to_parent:
+            root_ids.update(child_ids)
+    roots = [
+        comment_id for comment_id in id_to_parent if comment_id in root_ids]
+
+    # The roots are grouped as children of a virtual `None` node.
+    parent_of = {comment_id: None for comment_id in roots}
+    tree_children = {None: roots}
+    order = list(roots)
+    frontier = roots
+    while frontier:
+        new_frontier = []
+        for parent_id in frontier:
+            tree_children[parent_id] = []
+            for child_id in id_to_children[parent_id]:
+                if child_id in parent_of:
+                    continue
+                parent_of[child_id] = parent_id
+                tree_children[parent_id].append(child_id)
+                new_frontier.append(child_id)
+        order.extend(new_frontier)
+        frontier = new_frontier
+
+    # Close groups of sibling subtrees bottom up, once they are big enough.
+    partition_parents = []
+    top_to_partition = {}
+    open_size = {}
+    for comment_id in reversed([None] + order):
+        group = []
+        group_size = 0
+        for child_id in tree_children[comment_id]:
+            group.append(child_id)
+            group_size += open_size[child_id]
+            if group_size >= partition_size or (
+                    comment_id is None and child_id == roots[-1]):
+                for top_id in group:
+                    top_to_partition[top_id] = len(partition_parents)
+                partition_parents.append(comment_id)
+                group = []
+                group_size = 0
+        open_size[comment_id] = 1 + group_size
+
+    assignments = []
+    comment_to_partition = {}
+    for comment_id in order:
+        partition = top_to_partition.get(comment_id)
+        if partition is None:
+            partition = comment_to_partition[parent_of[comment_id]]
+        comment_to_partition[comment_id] = partition
+        assignments.append((comment_id, partition, False))
+
+    for partition, parent_id in enumerate(partition_parents):
+        if parent_id is None:
+            continue
+        assignments.append((parent_id, partition, True))
+        for ancestor_id in _ancestors(parent_of, parent_id, parent_depth - 1):
+            assignments.append((ancestor_id, partition, True))
+    return assignments
+
+
+def _partition_hot_thread(thread, parent_depth, partition_size,
+                          max_children=None, drop_negative_scores=False):
+    """Keys the comment ids of a hot thread by their partitions."""
+    thread_id, comment_links = thread
+    for comment_id, partition, is_context in _plan_thread_partitions(
+            comment_links, parent_depth, partition_size,
+            max_children=max_children,
+            drop_negative_scores=drop_negative_scores):
+        yield (thread_id, comment_id), (partition, is_context)
+
+
+def _key_comment_by_partitions(keyed_comment_partitions):
+    """Keys a comment by each of the thread partitions it belongs to."""
+    (thread_id, _), grouped = keyed_comment_partitions
+    comments = list(grouped['comments'])
+    if not comments:
+        return
+    comment = comments[-1]
+    for partition, is_context in grouped['partitions']:
+        yield (thread_id, partition), (comment, is_context)
+
+
+def _create_partition_examples(partition, parent_depth, min_length,
+                               max_paths_per_thread=None,
+                               max_examples_per_thread=None,
+                               sampling_seed=0):
+    """Creates examples from a partition of a hot thread.
+
+    The replies were already pruned when the partitions were planned, see
+    `_plan_thread_partitions`.
+    """
+    thread = []
+    context_ids = set()
+    for comment, is_context in partition:
+        thread.append(comment)
+        if is_context:
+            context_ids.add(comment.id)
+    return create_examples(
+        thread, parent_depth, min_length, context_ids=context_ids,
+        max_paths_per_thread=max_paths_per_thread,
+        max_examples_per_thread=max_examples_per_thread,
+        sampling_seed=sampling_seed)
+
+
+class _HotThreadSplitFn(beam.DoFn):
+    """Separates the comments of hot threads from the other comments."""
+
+    HOT_TAG = "hot"
+    ORDINARY_TAG = "ordinary"
+
+    def process(self, comment, hot_thread_sizes):
+        if comment.thread_id in hot_thread_sizes:
+            yield pvalue.TaggedOutput(self.HOT_TAG, comment)
+        else:
+            yield pvalue.TaggedOutput(self.ORDINARY_TAG, comment)
+
+
+def _split_hot_threads(comments, hot_thread_threshold, partition_size,
+                       parent_depth, max_children=None,
+                       drop_negative_scores=False):
+    """Splits threads with too many comments into partitions of replies.
+
+    A single huge thread would otherwise be one element after grouping by
+    thread id, and hold a worker for its whole duration.
+
+    Returns:
+        the comments of the ordinary threads, and a PCollection of
+        (thread_id, partition) pairs for the hot threads, where each partition
+        is an iterable of (comment, is_context) pairs.
+    """
+    thread_sizes = comments | "Count comments per thread" >> (
+        beam.Map(lambda comment: (comment.thread_id, 1))
+        | beam.CombinePerKey(sum))
+    hot_thread_sizes = thread_sizes | "Find hot threads" >> beam.Filter(
+        lambda thread_size: thread_size[1] > hot_thread_threshold)
+
+    comments = comments | "Split hot threads" >> beam.ParDo(
+        _HotThreadSplitFn(), pvalue.AsDict(hot_thread_sizes)
+    ).with_outputs(_HotThreadSplitFn.HOT_TAG, _HotThreadSplitFn.ORDINARY_TAG)
+    hot_comments = comments[_HotThreadSplitFn.HOT_TAG]
+
+    partitions = hot_comments | "Plan hot thread partitions" >> (
+        beam.Map(lambda comment: (
+            comment.thread_id,
+            (comment.id, comment.parent_id, comment.score)))
+        | "Group comment links by thread ID" >> beam.GroupByKey()
+        | beam.FlatMap(
+            partial(_partition_hot_thread,
+                    parent_depth=parent_depth,
+                    partition_size=partition_size,
+                    max_children=max_children,
+                    drop_negative_scores=drop_negative_scores)))
+    hot_comments |= "Key hot comments by ID" >> beam.Map(
+        lambda comment: ((comment.thread_id, comment.id), comment))
+
+    hot_partitions = (
+        {'comments': hot_comments, 'partitions': partitions}
+        | "Join hot comments with partitions" >> beam.CoGroupByKey()
+        | "Key hot comments by partition" >> beam.FlatMap(
+            _key_comment_by_partitions)
+        | "Group comments by partition" >> beam.GroupByKey()
+        | "Key partitions by thread ID" >> beam.Map(
+            lambda t: (t[0][0], t[1]))
+    )
+    return comments[_HotThreadSplitFn.ORDINARY_TAG], hot_partitions
 
 
 class _TrainTestSplitFn(beam.DoFn):
-    """Splits an input PCollection of examples into train and test.
+    """Splits a PCollection of (thread_id, thread) pairs into train and test.
 
     This uses the thread id to compute the split, so that examples from the
     same thread are in the same set. The split is deterministic based on
-    thread id, so that multiple runs produce the same result.
+    thread id, so that multiple runs produce the same result. Threads are
+    split before they are expanded into examples, so each thread id is only
+    hashed once.
     """
 
     TRAIN_TAG = "train"
@@ -252,17 +930,18 @@ class _TrainTestSplitFn(beam.DoFn):
         self._train_split = train_split
         self._num_buckets = num_buckets
 
-    def process(self, example):
-        split_value = self._split_value(example['thread_id'])
+    def process(self, keyed_thread):
+        thread_id, thread = keyed_thread
+        split_value = self._split_value(thread_id)
         split = (
             self.TRAIN_TAG if split_value < self._train_split else
             self.TEST_TAG)
-        yield pvalue.TaggedOutput(split, example)
+        yield pvalue.TaggedOutput(split, thread)
 
     def _split_value(self, thread_id):
         """Compute a value from 0 to 1 used to compute the split."""
         md5 = hashlib.md5()
-        md5.update(thread_id)
+        md5.update(thread_id.encode("utf-8"))
         md5_digest = int(md5.hexdigest(), 16)
         return (
             (1 + md5_digest % self._num_buckets)
@@ -284,35 +963,66 @@ def run(argv=None, comments=None):
     pipeline_options.view_as(SetupOptions).save_main_session = True
     p = beam.Pipeline(options=pipeline_options)
 
+    subreddits = args.subreddits.split(",") if args.subreddits else None
+    row_restriction = _row_restriction(
+        subreddits=subreddits,
+        min_created_utc=args.min_created_utc,
+        max_created_utc=args.max_created_utc,
+        max_body_length=args.max_body_length,
+    )
     if comments is not None:
         comments = p | ("Read in-memory comments") >> beam.Create(comments)
+    elif args.bigquery_read_method == _DIRECT_READ:
+        _log_direct_read_estimate(args.reddit_table, row_restriction)
+        comments = p | ("Read " + args.reddit_table) >> ReadFromBigQuery(
+            table=args.reddit_table,
+            method=ReadFromBigQuery.Method.DIRECT_READ,
+            selected_fields=_SELECTED_FIELDS,
+            row_restriction=row_restriction,
+        )
     else:
         comments = p | ("Read " + args.reddit_table) >> Read(
             BigQuerySource(args.reddit_table))
+    comments |= "Restrict rows" >> beam.ParDo(_RestrictRowsFn(
+        subreddits=subreddits,
+        min_created_utc=args.min_created_utc,
+        max_created_utc=args.max_created_utc,
+        max_body_length=args.max_body_length,
+    ))
 
     comments |= (
         "Normalise comments" >> beam.Map(
-            partial(normalise_comment, max_length=args.max_length)))
+            partial(normalise_comment, max_length=args.max_length)
+        ).with_output_types(Comment))
+    if args.skeleton_comments:
+        comments |= "Replace skipped comments with skeletons" >> beam.Map(
+            partial(_skeleton_comment, min_length=args.min_length)
+        ).with_output_types(Comment)
+
+    if args.hot_thread_threshold:
+        comments, hot_partitions = _split_hot_threads(
+            comments,
+            hot_thread_threshold=args.hot_thread_threshold,
+            partition_size=args.hot_thread_partition_size,
+            parent_depth=args.parent_depth,
+            max_children=args.max_children,
+            drop_negative_scores=args.drop_negative_scores,
+        )
 
     thread_id_to_comments = comments | (
         "Key by thread id" >> beam.Map(
-            lambda comment: (comment.thread_id, comment)))
+            lambda comment: (comment.thread_id, comment)
+        ).with_output_types(Tuple[str, Comment]))
     threads = thread_id_to_comments | (
         "Group comments by thread ID" >> beam.GroupByKey())
-    threads = threads | ("Get threads" >> beam.Map(lambda t: t[1]))
-
-    examples = threads | (
-        "Create {} examples".format(args.dataset_format) >> beam.FlatMap(
-            partial(create_examples,
-                    parent_depth=args.parent_depth,
-                    min_length=args.min_length,
-                    format=args.dataset_format,
-                    )))
-    examples = _shuffle(examples)
-
-    examples |= "split train and test" >> beam.ParDo(
+    threads |= "split train and test" >> beam.ParDo(
         _TrainTestSplitFn(train_split=args.train_split)
     ).with_outputs(_TrainTestSplitFn.TEST_TAG, _TrainTestSplitFn.TRAIN_TAG)
+    if args.hot_thread_threshold:
+        hot_partitions |= "split hot threads into train and test" >> (
+            beam.ParDo(_TrainTestSplitFn(train_split=args.train_split))
+            .with_outputs(
+                _TrainTestSplitFn.TEST_TAG, _TrainTestSplitFn.TRAIN_TAG))
 
     if args.dataset_format == _JSON_FORMAT:
         write_sink = WriteToText
@@ -327,7 +1037,38 @@ def run(argv=None, comments=None):
     for name, tag in [("train", _TrainTestSplitFn.TRAIN_TAG),
                       ("test", _TrainTestSplitFn.TEST_TAG)]:
 
-        serialized_examples = examples[tag] | (
+        examples = threads[tag] | (
+            "create {} {} examples".format(name, args.dataset_format)
+            >> beam.FlatMap(
+                partial(create_examples,
+                        parent_depth=args.parent_depth,
+                        min_length=args.min_length,
+                        max_paths_per_thread=args.max_paths_per_thread,
+                        max_examples_per_thread=args.max_examples_per_thread,
+                        sampling_seed=args.sampling_seed,
+                        max_children=args.max_children,
+                        drop_negative_scores=args.drop_negative_scores)))
+        if args.hot_thread_threshold:
+            hot_examples = hot_partitions[tag] | (
+                "create {} {} examples from hot threads".format(
+                    name, args.dataset_format)
+                >> beam.FlatMap(
+                    partial(_create_partition_examples,
+                            parent_depth=args.parent_depth,
+                            min_length=args.min_length,
+                            max_paths_per_thread=args.max_paths_per_thread,
+                            max_examples_per_thread=(
+                                args.max_examples_per_thread),
+                            sampling_seed=args.sampling_seed)))
+            examples = (examples, hot_examples) | (
+                "merge {} hot thread examples".format(name) >> beam.Flatten())
+        examples |= "shuffle {} examples".format(name) >> shuffle.shuffle(
+            shuffle_mode=args.shuffle_mode,
+            shuffle_seed=args.shuffle_seed,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+        )
+
+        serialized_examples = examples | (
             "serialize {} examples".format(name) >> beam.Map(serialize_fn))
         (
             serialized_examples | ("write " + name)
@@ -340,6 +1081,8 @@ def run(argv=None, comments=None):
 
     result = p.run()
     result.wait_until_finish()
+    _log_bytes_read(result)
+    shuffle.log_shuffle_bytes(result, args.shuffle_mode)
 
 
 if __name__ == "__main__":
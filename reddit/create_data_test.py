@@ -2,13 +2,18 @@
 
 import copy
 import json
+import random
 import shutil
 import tempfile
 import unittest
+from collections import defaultdict
 from glob import glob
 from os import path
 
+import apache_beam as beam
 import tensorflow as tf
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
 
 from reddit import create_data
 
@@ -262,6 +267,79 @@ class CreateDataTest(unittest.TestCase):
             create_data.trim("Matthew", 2)
         )
 
+    def test_trim_punctuation(self):
+        self.assertEqual(
+            "Hello, ",
+            create_data.trim("Hello, world... bye", 9)
+        )
+        self.assertEqual(
+            "Hello, world",
+            create_data.trim("Hello, world... bye", 13)
+        )
+
+    def test_trim_batch(self):
+        self.assertEqual(
+            ["Matthew", "Matthew ", ""],
+            create_data.trim_batch(
+                ["Matthew", "Matthew Henderson", "Hendersons"], 9)
+        )
+
+    def test_row_restriction(self):
+        self.assertIsNone(create_data._row_restriction())
+        self.assertEqual(
+            'subreddit IN ("AskReddit", "funny") AND created_utc >= 100 AND '
+            'created_utc < 200 AND LENGTH(body) <= 127',
+            create_data._row_restriction(
+                subreddits=["AskReddit", "funny"],
+                min_created_utc=100,
+                max_created_utc=200,
+                max_body_length=127,
+            )
+        )
+
+    def test_restrict_rows(self):
+        row = {
+            'id': "id", 'link_id': "t3_thread", 'parent_id': "t3_thread",
+            'body': "body", 'author': "author", 'subreddit': "funny",
+            'created_utc': "150", 'score': "1", 'gilded': "0",
+        }
+        selected_row = {
+            field: row[field] for field in create_data._SELECTED_FIELDS}
+        self.assertEqual(
+            [selected_row], list(create_data._RestrictRowsFn().process(row)))
+        self.assertEqual(
+            [selected_row],
+            list(create_data._RestrictRowsFn(
+                subreddits=["funny"], min_created_utc=150,
+                max_created_utc=151, max_body_length=4).process(row)))
+        for restrict_rows_fn in [
+                create_data._RestrictRowsFn(subreddits=["AskReddit"]),
+                create_data._RestrictRowsFn(min_created_utc=151),
+                create_data._RestrictRowsFn(max_created_utc=150),
+                create_data._RestrictRowsFn(max_body_length=3)]:
+            self.assertEqual([], list(restrict_rows_fn.process(row)))
+
+    def test_restrict_direct_read_rows(self):
+        # A direct read returns only the selected fields, which must include
+        # those the row restriction is checked on.
+        rows = [
+            {
+                'id': "id{}".format(i), 'link_id': "t3_thread",
+                'parent_id': "t3_thread", 'body': "body", 'author': "author",
+                'subreddit': "funny", 'created_utc': str(created_utc),
+                'score': "1",
+            } for i, created_utc in enumerate([99, 100, 150, 199, 200])]
+        self.assertEqual(
+            set(create_data._SELECTED_FIELDS), set(rows[0].keys()))
+        with TestPipeline() as p:
+            restricted_rows = (
+                p | beam.Create(rows)
+                | "Read rows" >> beam.ParDo(create_data._RestrictRowsFn(
+                    min_created_utc=100, max_created_utc=200))
+                | "Restrict rows" >> beam.ParDo(create_data._RestrictRowsFn(
+                    min_created_utc=100, max_created_utc=200)))
+            assert_that(restricted_rows, equal_to(rows[1:4]))
+
     def test_normalise_comment(self):
         comment = create_data.normalise_comment(
             {
@@ -297,6 +375,7 @@ class CreateDataTest(unittest.TestCase):
                 body_is_trimmed=True,
                 subreddit="EEEEE",
                 author="FFFFF",
+                score=1,
             )
         )
 
@@ -360,6 +439,214 @@ class CreateDataTest(unittest.TestCase):
             ["3", "4"],
         ], paths)
 
+    def test_linear_path_windows(self):
+        id_to_comment = {
+            "1": self._create_test_comment(id="1", parent_id="unseen"),
+            "2": self._create_test_comment(id="2", parent_id="1"),
+            "3": self._create_test_comment(id="3", parent_id="2"),
+            "4": self._create_test_comment(id="4", parent_id="3"),
+            "5": self._create_test_comment(id="5", parent_id="3"),
+        }
+        windows = [
+            (response_id, context_id, list(extra_context_ids))
+            for response_id, context_id, extra_context_ids in
+            create_data.linear_path_windows(id_to_comment, parent_depth=3)
+        ]
+        self.assertEqual([
+            ("2", "1", []),
+            ("3", "2", ["1"]),
+            ("4", "3", ["2", "1"]),
+            ("5", "3", ["2", "1"]),
+        ], windows)
+
+    def test_linear_path_windows_pruning(self):
+        scores = {"1": 5, "2": 1, "3": 3, "4": -1, "5": 2, "6": 4, "7": 0}
+        parents = {"1": "unseen", "2": "1", "3": "1", "4": "1", "5": "4",
+                   "6": "3", "7": "3"}
+        id_to_comment = {
+            comment_id: self._create_test_comment(
+                id=comment_id, parent_id=parents[comment_id])._replace(
+                    score=scores[comment_id])
+            for comment_id in sorted(scores)
+        }
+
+        def _responses(**kwargs):
+            return [
+                response_id for response_id, _, _ in
+                create_data.linear_path_windows(
+                    id_to_comment, parent_depth=3, **kwargs)]
+
+        self.assertEqual(["2", "3", "4", "6", "7", "5"], _responses())
+        self.assertEqual(
+            ["2", "3", "6", "7"], _responses(drop_negative_scores=True))
+        self.assertEqual(["3", "6"], _responses(max_children=1))
+        self.assertEqual(
+            ["2", "3", "6", "7"],
+            _responses(max_children=2, drop_negative_scores=True))
+
+    def test_plan_thread_partitions(self):
+        with open("reddit/testdata/thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data.normalise_comment(comment, max_length=127)
+            for comment in comments]
+        id_to_comment = {comment.id: comment for comment in comments}
+
+        partitions = defaultdict(list)
+        for comment_id, partition, is_context in (
+                create_data._plan_thread_partitions(
+                    [(comment.id, comment.parent_id, comment.score)
+                     for comment in comments],
+                    parent_depth=2, partition_size=2)):
+            partitions[partition].append(
+                (id_to_comment[comment_id], is_context))
+        self.assertGreater(len(partitions), 1)
+
+        partition_examples = []
+        for partition in partitions.values():
+            partition_examples.extend(create_data._create_partition_examples(
+                partition, parent_depth=2, min_length=1))
+        self.assertCountEqual(
+            list(create_data.create_examples(
+                comments, parent_depth=2, min_length=1)),
+            partition_examples)
+
+    def test_plan_thread_partitions_pruning(self):
+        # A wide thread, where the partitions split the replies to a comment.
+        rng = random.Random(0)
+        comments = [self._create_test_comment(id="0", parent_id="thread")]
+        for i in range(1, 200):
+            comments.append(self._create_test_comment(
+                id=str(i), parent_id=str(rng.randrange(i)),
+            )._replace(score=rng.randint(-5, 20)))
+        comments = [
+            comment._replace(body_is_trimmed=False) for comment in comments]
+        id_to_comment = {comment.id: comment for comment in comments}
+        num_examples = len(list(create_data.create_examples(
+            comments, parent_depth=2, min_length=1)))
+
+        for pruning in [{'max_children': 2},
+                        {'drop_negative_scores': True},
+                        {'max_children': 3, 'drop_negative_scores': True}]:
+            partitions = defaultdict(list)
+            for comment_id, partition, is_context in (
+                    create_data._plan_thread_partitions(
+                        [(comment.id, comment.parent_id, comment.score)
+                         for comment in comments],
+                        parent_depth=2, partition_size=2, **pruning)):
+                partitions[partition].append(
+                    (id_to_comment[comment_id], is_context))
+            self.assertGreater(len(partitions), 1)
+
+            partition_examples = []
+            for partition in partitions.values():
+                partition_examples.extend(
+                    create_data._create_partition_examples(
+                        partition, parent_depth=2, min_length=1))
+            examples = list(create_data.create_examples(
+                comments, parent_depth=2, min_length=1, **pruning))
+            self.assertLess(len(examples), num_examples)
+            self.assertCountEqual(examples, partition_examples)
+
+    def test_skeleton_comments(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data.normalise_comment(comment, max_length=5)
+            for comment in comments]
+        skeleton_comments = [
+            create_data._skeleton_comment(comment, min_length=4)
+            for comment in comments]
+
+        self.assertEqual(
+            [None, None],
+            [comment.body for comment in skeleton_comments
+             if comment.id in {"id-too-long", "id-too-short"}])
+        self.assertEqual(
+            list(create_data.create_examples(
+                comments, parent_depth=2, min_length=4)),
+            list(create_data.create_examples(
+                skeleton_comments, parent_depth=2, min_length=4)))
+
+    def test_skeleton_comments_stop_extra_contexts(self):
+        comments = [
+            create_data.Comment(
+                id=str(i), thread_id="thread", parent_id=str(i - 1),
+                body=body, body_is_trimmed=False, author="author",
+                subreddit="subreddit")
+            for i, body in enumerate(["AAAA", "[deleted]", "CCCC", "DDDD"])
+        ]
+        skeleton_comments = [
+            create_data._skeleton_comment(comment, min_length=4)
+            for comment in comments]
+        examples = list(create_data.create_examples(
+            comments, parent_depth=3, min_length=4))
+        skeleton_examples = list(create_data.create_examples(
+            skeleton_comments, parent_depth=3, min_length=4))
+
+        self.assertEqual(1, len(examples))
+        self.assertEqual("AAAA", examples[0]['context/1'])
+        self.assertEqual("[deleted]", examples[0]['context/0'])
+        del examples[0]['context/1']
+        del examples[0]['context/0']
+        self.assertEqual(examples, skeleton_examples)
+
+    def test_reservoir_sample(self):
+        rng = random.Random(0)
+        self.assertEqual(
+            [0, 1, 2], create_data._reservoir_sample(range(3), 5, rng))
+        sample = create_data._reservoir_sample(range(1000), 10, rng)
+        self.assertEqual(10, len(sample))
+        self.assertEqual(sorted(sample), sample)
+        self.assertEqual(
+            create_data._reservoir_sample(range(1000), 10, random.Random(1)),
+            create_data._reservoir_sample(range(1000), 10, random.Random(1)))
+
+    def test_create_examples_sampling(self):
+        comments = [
+            create_data.Comment(
+                id=str(i), thread_id="thread", parent_id=str((i - 1) // 2),
+                body="comment {}".format(i), body_is_trimmed=False,
+                author="author", subreddit="subreddit")
+            for i in range(100)
+        ]
+        examples = list(create_data.create_examples(
+            comments, parent_depth=3, min_length=4))
+        self.assertEqual(99, len(examples))
+
+        for kwargs in [{"max_paths_per_thread": 10},
+                       {"max_examples_per_thread": 10}]:
+            sampled = list(create_data.create_examples(
+                comments, parent_depth=3, min_length=4, **kwargs))
+            self.assertEqual(10, len(sampled))
+            self.assertEqual(
+                [example for example in examples if example in sampled],
+                sampled)
+            self.assertEqual(sampled, list(create_data.create_examples(
+                comments, parent_depth=3, min_length=4, **kwargs)))
+            self.assertNotEqual(sampled, list(create_data.create_examples(
+                comments, parent_depth=3, min_length=4, sampling_seed=1,
+                **kwargs)))
+
+    def test_comment_coder(self):
+        coder = beam.coders.registry.get_coder(create_data.Comment)
+        self.assertIsInstance(coder, create_data._CommentCoder)
+        self.assertTrue(coder.is_deterministic())
+        for comment in [
+                create_data.Comment(
+                    id="id", thread_id="thread", parent_id="parent",
+                    body=u"b\u00f6dy \U0001f600", body_is_trimmed=True,
+                    author="author", subreddit="subreddit"),
+                create_data.Comment(
+                    id="id", thread_id="thread", parent_id="parent",
+                    body=None, body_is_trimmed=False, author=None,
+                    subreddit=None),
+                create_data.Comment(
+                    id="id", thread_id="thread", parent_id="parent",
+                    body="body", body_is_trimmed=False, author="author",
+                    subreddit="subreddit", score=-12)]:
+            self.assertEqual(comment, coder.decode(coder.encode(comment)))
+
     def test_long_thread(self):
         """Check there is no issue with long threads (e.g. recursion limits)"""
         id_to_comment = {
@@ -2,13 +2,20 @@
 
 import copy
 import json
+import os
+import random
 import shutil
 import tempfile
 import unittest
+from collections import defaultdict
 from glob import glob
 from os import path
+from unittest import mock
 
+import apache_beam as beam
 import tensorflow as tf
+import zstandard
+from apache_beam.io import source_test_utils
 
 import create_data_v2
 
@@ -110,6 +117,148 @@ class CreateDataPipelineTest(unittest.TestCase):
         self.assertCountEqual(expected_train_examples_1+expected_train_examples_2, train_examples)
 
 
+    def test_run_hot_threads(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+
+        create_data_v2.run(argv=[
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--output_dir=" + self._temp_dir,
+            "--dataset_format=TF",
+            "--num_shards=1",
+            "--hot_thread_threshold=1",
+            "--hot_thread_partition_size=2",
+        ],
+                           comments=comments)
+
+        examples = self._read_examples("all-*")
+        expected_examples = [
+            self._create_example({
+                'subreddit': "subreddit-A",
+                'thread_id': "testthread",
+                'comments': comments_text,
+            }) for comments_text in [
+                "[submission]<sep>AAAA<sep>BBBB<sep>CCCC",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>EEEE",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD"
+                "<sep>too long to create an example",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>123",
+                "[submission]<sep>FFFF",
+            ]]
+        self.assertCountEqual(expected_examples, examples)
+
+    def test_run_tree(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+
+        create_data_v2.run(argv=[
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--output_dir=" + self._temp_dir,
+            "--dataset_format=TREE",
+            "--num_shards=1",
+        ],
+                           comments=comments)
+
+        trees = []
+        for file_name in glob(path.join(self._temp_dir, "all-*.tfrecord")):
+            for record in tf.data.TFRecordDataset(file_name):
+                trees.append(create_data_v2.parse_tree_example(record.numpy()))
+        self.assertEqual(1, len(trees))
+        self.assertEqual(
+            ["id-A", "id-B", "id-C", "id-D", "id-E", "id-too-long",
+             "id-too-short", "id-no-replies"],
+            trees[0]["ids"])
+        self.assertEqual([-1, 0, 1, 1, 3, 3, 3, -1], trees[0]["parents"])
+
+        expected_examples = [
+            {
+                'subreddit': "subreddit-A",
+                'thread_id': "testthread",
+                'comments': comments_text,
+            } for comments_text in [
+                "[submission]<sep>AAAA<sep>BBBB<sep>CCCC",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>EEEE",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD"
+                "<sep>too long to create an example",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>123",
+                "[submission]<sep>FFFF",
+            ]]
+        self.assertCountEqual(
+            expected_examples, list(create_data_v2.expand_tree(trees[0])))
+
+    def test_run_row_restriction(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+
+        # A thread in another subreddit, which is not read.
+        other_comments = []
+        for comment in comments:
+            other_comment = copy.copy(comment)
+            if other_comment["link_id"] == other_comment["parent_id"]:
+                other_comment["parent_id"] = "t3_otherthread"
+            other_comment["link_id"] = "t3_otherthread"
+            other_comment["subreddit"] = "subreddit-B"
+            other_comments.append(other_comment)
+
+        create_data_v2.run(
+            argv=[
+                "--runner=DirectRunner",
+                "--reddit_table=ignored",
+                "--output_dir=" + self._temp_dir,
+                "--dataset_format=TF",
+                "--num_shards=1",
+                "--bigquery_read_method=DIRECT_READ",
+                "--subreddits=subreddit-A",
+                "--max_body_length=4",
+            ],
+            comments=(comments + other_comments),
+        )
+
+        examples = self._read_examples("all-*")
+        expected_examples = [
+            self._create_example({
+                'subreddit': "subreddit-A",
+                'thread_id': "testthread",
+                'comments': comments_text,
+            }) for comments_text in [
+                "[submission]<sep>AAAA<sep>BBBB<sep>CCCC",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>EEEE",
+                "[submission]<sep>AAAA<sep>BBBB<sep>DDDD<sep>123",
+                "[submission]<sep>FFFF",
+            ]]
+        self.assertCountEqual(expected_examples, examples)
+
+    def test_run_direct_read_date_range(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+
+        # A direct read returns only the selected fields, which must include
+        # created_utc for the date range to be checked again.
+        rows = []
+        for i, comment in enumerate(comments):
+            comment = dict(comment, created_utc=str(100 + i), score="1")
+            rows.append(
+                {field: comment[field] for field in create_data_v2._SELECTED_FIELDS}
+            )
+
+        create_data_v2.run(
+            argv=[
+                "--runner=DirectRunner",
+                "--reddit_table=ignored",
+                "--output_dir=" + self._temp_dir,
+                "--dataset_format=TF",
+                "--num_shards=1",
+                "--bigquery_read_method=DIRECT_READ",
+                "--min_created_utc=100",
+                "--max_created_utc=200",
+            ],
+            comments=rows,
+        )
+
+        self.assertEqual(5, len(self._read_examples("all-*")))
+
     def test_run_json(self):
         with open("reddit/testdata/simple_thread.json") as f:
             comments = json.loads(f.read())
@@ -226,7 +375,7 @@ class CreateDataPipelineTest(unittest.TestCase):
             path.join(self._temp_dir, expected_file) for expected_file in
             ["en-00000-of-00002.tfrecord", "en-00001-of-00002.tfrecord", 
              "tr-00000-of-00002.tfrecord", "tr-00001-of-00002.tfrecord",
-             "other-00000-of-00002.tfrecord", "other-00001-of-00002.tfrecord"]
+             "so-00000-of-00001.tfrecord"]
         ], glob(path.join(self._temp_dir, "*")))
 
 
@@ -328,7 +477,7 @@ class CreateDataPipelineTest(unittest.TestCase):
             path.join(self._temp_dir, expected_file) for expected_file in
             ["en-00000-of-00002.json", "en-00001-of-00002.json", 
              "tr-00000-of-00002.json", "tr-00001-of-00002.json",
-             "other-00000-of-00002.json", "other-00001-of-00002.json"]
+             "so-00000-of-00001.json"]
         ], glob(path.join(self._temp_dir, "*")))
 
 
@@ -431,7 +580,7 @@ class CreateDataPipelineTest(unittest.TestCase):
             path.join(self._temp_dir, expected_file) for expected_file in
             ["en-00000-of-00002.tfrecord", "en-00001-of-00002.tfrecord", 
              "tr-00000-of-00002.tfrecord", "tr-00001-of-00002.tfrecord",
-             "other-00000-of-00002.tfrecord", "other-00001-of-00002.tfrecord"]
+             "so-00000-of-00001.tfrecord"]
         ], glob(path.join(self._temp_dir, "*")))
 
 
@@ -522,7 +671,7 @@ class CreateDataPipelineTest(unittest.TestCase):
             path.join(self._temp_dir, expected_file) for expected_file in
             ["en-00000-of-00002.json", "en-00001-of-00002.json", 
              "tr-00000-of-00002.json", "tr-00001-of-00002.json",
-             "other-00000-of-00002.json", "other-00001-of-00002.json"]
+             "so-00000-of-00001.json"]
         ], glob(path.join(self._temp_dir, "*")))
 
 
@@ -582,6 +731,192 @@ class CreateDataPipelineTest(unittest.TestCase):
         self.assertCountEqual(expected_train_examples_1+expected_train_examples_2, train_examples)
 
 
+    def test_run_min_language_count(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+
+        create_data_v2.run(argv=[
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--output_dir=" + self._temp_dir,
+            "--detect_lang=true",
+            "--min_language_count=2",
+            "--dataset_format=JSON",
+        ], comments=comments)
+
+        self.assertCountEqual(
+            ["en", "other"],
+            [path.basename(file_name).split("-")[0]
+             for file_name in glob(path.join(self._temp_dir, "*"))])
+        self.assertEqual(
+            ["so"],
+            [example['language']
+             for example in self._read_json_examples("other-*")])
+        self.assertEqual(
+            {"en"},
+            {example['language']
+             for example in self._read_json_examples("en-*")})
+
+    def test_run_pushshift_files(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        compressor = zstandard.ZstdCompressor()
+        file_name = path.join(self._temp_dir, "RC_2019-01.zst")
+        with open(file_name, "wb") as f:
+            for comment in comments:
+                f.write(compressor.compress(
+                    json.dumps(comment).encode("utf-8") + b"\n"))
+        output_dir = path.join(self._temp_dir, "output")
+
+        create_data_v2.run(argv=[
+            "--runner=DirectRunner",
+            "--pushshift_files=" + path.join(self._temp_dir, "RC_*.zst"),
+            "--output_dir=" + output_dir,
+            "--dataset_format=JSON",
+        ])
+
+        examples = []
+        for file_name in glob(path.join(output_dir, "all-*.json")):
+            with open(file_name) as f:
+                examples.extend(json.loads(line) for line in f)
+        self.assertCountEqual(
+            list(create_data_v2.create_examples(
+                [create_data_v2.normalise_comment(comment)
+                 for comment in comments], False, False)),
+            examples)
+
+    def test_run_incremental(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        # testthread and testthread2 are in shards 1 and 2 of 4.
+        other_thread_comments = []
+        for comment in comments:
+            comment = dict(comment, link_id="t3_testthread2")
+            if comment["parent_id"] == "t3_testthread":
+                comment["parent_id"] = "t3_testthread2"
+            other_thread_comments.append(comment)
+        argv = [
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--output_dir=" + self._temp_dir,
+            "--dataset_format=JSON",
+            "--num_shards=4",
+            "--incremental",
+        ]
+
+        create_data_v2.run(
+            argv=argv, comments=comments + other_thread_comments)
+        self.assertCountEqual(
+            ["all-00001-of-00004.json", "all-00002-of-00004.json"],
+            [path.basename(file_name)
+             for file_name in glob(path.join(self._temp_dir, "*.json"))])
+        self.assertEqual(
+            4, len(glob(path.join(self._temp_dir, "manifest", "*"))))
+        unchanged_file = path.join(self._temp_dir, "all-00001-of-00004.json")
+        unchanged_inode = os.stat(unchanged_file).st_ino
+
+        # A new reply in testthread2 only rewrites its shard.
+        new_comment = dict(
+            other_thread_comments[0], id="id-new", body="NEW",
+            parent_id="t1_id-A")
+        create_data_v2.run(
+            argv=argv,
+            comments=comments + other_thread_comments + [new_comment])
+        self.assertEqual(unchanged_inode, os.stat(unchanged_file).st_ino)
+
+        full_build_dir = path.join(self._temp_dir, "full")
+        create_data_v2.run(
+            argv=[
+                "--runner=DirectRunner",
+                "--reddit_table=ignored",
+                "--output_dir=" + full_build_dir,
+                "--dataset_format=JSON",
+            ],
+            comments=comments + other_thread_comments + [new_comment])
+        full_build_examples = []
+        for file_name in glob(path.join(full_build_dir, "all-*")):
+            with open(file_name) as f:
+                full_build_examples.extend(json.loads(line) for line in f)
+        self.assertCountEqual(
+            full_build_examples, self._read_json_examples("all-*"))
+
+    def test_run_incremental_failed_write(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        argv = [
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--output_dir=" + self._temp_dir,
+            "--dataset_format=JSON",
+            "--num_shards=4",
+            "--incremental",
+        ]
+        create_data_v2.run(argv=argv, comments=comments)
+        manifest_pattern = path.join(self._temp_dir, "manifest", "*")
+
+        def _read_manifest():
+            manifest = []
+            for file_name in glob(manifest_pattern):
+                with open(file_name) as f:
+                    manifest.extend(f)
+            return sorted(manifest)
+
+        manifest = _read_manifest()
+        self.assertEqual(4, len(glob(manifest_pattern)))
+        self.assertEqual(
+            [], glob(path.join(self._temp_dir, ".manifest-staging", "*")))
+
+        # The manifest is not replaced if the changed shards are not written.
+        new_comment = dict(
+            comments[0], id="id-new", body="NEW", parent_id="t1_id-A")
+        with mock.patch.object(
+                create_data_v2._WriteShardFn, "process",
+                side_effect=IOError("write failed")):
+            with self.assertRaises(Exception):
+                create_data_v2.run(
+                    argv=argv, comments=comments + [new_comment])
+        self.assertEqual(manifest, _read_manifest())
+
+        # So the next build still rewrites the shard.
+        create_data_v2.run(argv=argv, comments=comments + [new_comment])
+        self.assertNotEqual(manifest, _read_manifest())
+        self.assertIn(
+            "NEW", json.dumps(self._read_json_examples("all-*")))
+
+    def test_run_near_dedup(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        # A copy of the thread, which only differs in case and punctuation.
+        copied_comments = []
+        for comment in comments:
+            comment = dict(
+                comment, link_id="t3_testthread2", body=comment["body"].upper()
+                + "!!")
+            if comment["parent_id"] == "t3_testthread":
+                comment["parent_id"] = "t3_testthread2"
+            copied_comments.append(comment)
+        argv = [
+            "--runner=DirectRunner",
+            "--reddit_table=ignored",
+            "--dataset_format=JSON",
+            "--near_dedup_threshold=0.8",
+        ]
+
+        create_data_v2.run(
+            argv=argv + ["--output_dir=" + self._temp_dir],
+            comments=comments + copied_comments)
+        deduplicated_examples = self._read_json_examples("all-*")
+
+        expected_examples = list(create_data_v2.create_examples(
+            [create_data_v2.normalise_comment(comment)
+             for comment in comments], False, False))
+        self.assertEqual(len(expected_examples), len(deduplicated_examples))
+        self.assertCountEqual(
+            [example["comments"].lower()
+             for example in expected_examples],
+            [example["comments"].lower().replace("!!", "")
+             for example in deduplicated_examples])
+
     def _read_examples(self, pattern):
         examples = []
         for file_name in sorted(glob(path.join(self._temp_dir, pattern))):
@@ -658,13 +993,14 @@ class CreateDataTest(unittest.TestCase):
         })
         self.assertEqual(
             comment,
-            dict(
+            create_data_v2.Comment(
                 body="ABC EFG HIJ KLM NOP",
                 thread_id="BBBBB",
                 parent_id="CCCCC",
                 id="DDDDD",
                 subreddit="EEEEE",
                 author="FFFFF",
+                score=1,
             ))
 
     def test_generate_paths(self):
@@ -685,7 +1021,7 @@ class CreateDataTest(unittest.TestCase):
 
     @staticmethod
     def _create_test_comment(id, parent_id):
-        return dict(
+        return create_data_v2.Comment(
             body="body",
             thread_id="thread_id",
             parent_id=parent_id,
@@ -694,6 +1030,368 @@ class CreateDataTest(unittest.TestCase):
             author="author",
         )
 
+    def test_plan_thread_partitions(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data_v2.normalise_comment(comment) for comment in comments
+        ]
+        id_to_comment = {comment.id: comment for comment in comments}
+
+        partitions = {}
+        for comment_id, partition, _ in create_data_v2._plan_thread_partitions(
+                "testthread",
+                [(comment.id, comment.parent_id, comment.score)
+                 for comment in comments],
+                partition_size=2):
+            partitions.setdefault(partition, []).append(
+                id_to_comment[comment_id])
+        self.assertGreater(len(partitions), 1)
+
+        paths = []
+        for partition in partitions.values():
+            paths.extend(create_data_v2.generate_paths_for_thread(partition))
+        self.assertCountEqual(
+            list(create_data_v2.generate_paths_for_thread(comments)), paths)
+
+    def _wide_thread(self):
+        """Returns the comments of a thread with many replies per comment."""
+        rng = random.Random(0)
+        comments = []
+        for i in range(200):
+            parent_id = "thread_id" if i < 3 else str(rng.randrange(i))
+            comments.append(
+                self._create_test_comment(id=str(i), parent_id=parent_id)
+                ._replace(body="body {}".format(i), score=rng.randint(-5, 20)))
+        return comments
+
+    def _partition_examples(self, comments, partition_size, **kwargs):
+        """Returns the examples of a thread's partitions, and their number."""
+        id_to_comment = {comment.id: comment for comment in comments}
+        partitions = defaultdict(list)
+        for comment_id, partition, _ in create_data_v2._plan_thread_partitions(
+                "thread_id",
+                [(comment.id, comment.parent_id, comment.score)
+                 for comment in comments],
+                partition_size=partition_size,
+                **kwargs):
+            partitions[partition].append(id_to_comment[comment_id])
+        examples = []
+        for partition in partitions.values():
+            examples.extend(create_data_v2.create_examples(
+                partition, False, False, **kwargs))
+        return examples, len(partitions)
+
+    def test_plan_thread_partitions_pruning(self):
+        comments = self._wide_thread()
+        num_examples = len(list(
+            create_data_v2.create_examples(comments, False, False)))
+        for pruning in [{"max_children": 2},
+                        {"drop_negative_scores": True},
+                        {"max_children": 3, "drop_negative_scores": True}]:
+            examples = list(create_data_v2.create_examples(
+                comments, False, False, **pruning))
+            self.assertLess(len(examples), num_examples)
+            partition_examples, num_partitions = self._partition_examples(
+                comments, partition_size=2, **pruning)
+            self.assertGreater(num_partitions, 1)
+            self.assertCountEqual(examples, partition_examples)
+
+    def test_plan_thread_partitions_max_depth(self):
+        comments = self._wide_thread()
+        for kwargs in [{"max_depth": 2},
+                       {"max_depth": 4},
+                       {"max_depth": 3, "max_children": 3}]:
+            examples = list(create_data_v2.create_examples(
+                comments, False, False, **kwargs))
+            partition_examples, num_partitions = self._partition_examples(
+                comments, partition_size=2, **kwargs)
+            self.assertGreater(num_partitions, 1)
+            self.assertCountEqual(examples, partition_examples)
+
+    def test_skeleton_comments(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data_v2.normalise_comment(comment) for comment in comments
+        ]
+        comments[1] = comments[1]._replace(body="[deleted]")
+        comments[3] = comments[3]._replace(body="[removed]")
+        skeleton_comments = [
+            create_data_v2._skeleton_comment(comment) for comment in comments
+        ]
+
+        self.assertIsNone(skeleton_comments[1].body)
+        self.assertIsNone(skeleton_comments[3].body)
+        self.assertEqual(comments[2], skeleton_comments[2])
+        self.assertCountEqual(
+            list(create_data_v2.create_examples(comments, False, False)),
+            list(create_data_v2.create_examples(skeleton_comments, False, False)))
+
+    def test_comment_coder(self):
+        coder = beam.coders.registry.get_coder(create_data_v2.Comment)
+        self.assertIsInstance(coder, create_data_v2._CommentCoder)
+        self.assertTrue(coder.is_deterministic())
+        for comment in [
+            self._create_test_comment("id", "parent")._replace(
+                body="b\u00f6dy \U0001f600"),
+            self._create_test_comment("id", "parent")._replace(
+                body=None, author=None),
+            self._create_test_comment("id", "parent")._replace(score=-12),
+        ]:
+            self.assertEqual(comment, coder.decode(coder.encode(comment)))
+
+    def test_create_examples_comment_lang_detection(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data_v2.normalise_comment(comment) for comment in comments
+        ]
+
+        with mock.patch.object(
+                create_data_v2.cld3, "get_language",
+                wraps=create_data_v2.cld3.get_language) as get_language:
+            examples = list(create_data_v2.create_examples(
+                comments, False, True,
+                lang_detection_level=create_data_v2._COMMENT_LANG_DETECTION))
+        # Each comment is detected once, rather than once per path.
+        self.assertEqual(len(comments), get_language.call_count)
+        self.assertEqual(5, len(examples))
+        for example in examples:
+            self.assertIn("language", example)
+
+    def test_create_examples_comment_lang_detection_max_depth(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data_v2.normalise_comment(comment) for comment in comments
+        ]
+        lang_detector = mock.Mock()
+        lang_detector.predict.side_effect = lambda texts: ["xx"] * len(texts)
+
+        examples = list(create_data_v2.create_examples(
+            comments, False, True, lang_detector=lang_detector, max_depth=2,
+            lang_detection_level=create_data_v2._COMMENT_LANG_DETECTION))
+        # Only the comments of the paths are detected.
+        path_texts = {
+            text
+            for example in examples
+            for text in example["comments"].split("<sep>")[1:]
+        }
+        detected_texts = [
+            text
+            for call in lang_detector.predict.call_args_list
+            for text in call[0][0]
+        ]
+        self.assertCountEqual(path_texts, detected_texts)
+        self.assertLess(len(detected_texts), len(comments))
+
+    def test_path_language(self):
+        comments = [
+            self._create_test_comment("id-A", "thread")._replace(
+                body="This is a long English comment about the weather, "
+                     "which has been rainy all week."),
+            self._create_test_comment("id-B", "id-A")._replace(
+                body="Merhaba dunya"),
+        ]
+        comment_languages = create_data_v2._detect_comment_languages(
+            comments, create_data_v2._Cld3Detector(), batch_size=1)
+        self.assertEqual({"id-A", "id-B"}, set(comment_languages))
+        self.assertEqual(
+            "en",
+            create_data_v2._path_language(comments, comment_languages))
+
+    def test_create_examples_batched_lang_detection(self):
+        with open("reddit/testdata/simple_thread.json") as f:
+            comments = json.loads(f.read())
+        comments = [
+            create_data_v2.normalise_comment(comment) for comment in comments
+        ]
+        lang_detector = mock.Mock()
+        lang_detector.predict.side_effect = lambda texts: ["xx"] * len(texts)
+
+        examples = list(create_data_v2.create_examples(
+            comments, False, True, lang_detector=lang_detector,
+            lang_batch_size=2))
+        self.assertEqual(5, len(examples))
+        self.assertEqual(["xx"] * 5, [ex["language"] for ex in examples])
+        self.assertEqual(
+            [2, 2, 1],
+            [len(call[0][0]) for call in lang_detector.predict.call_args_list])
+
+        lang_detector.reset_mock()
+        list(create_data_v2.create_examples(
+            comments, False, True, lang_detector=lang_detector,
+            lang_detection_level=create_data_v2._COMMENT_LANG_DETECTION))
+        lang_detector.predict.assert_called_once()
+
+    def test_create_examples_fn_loads_detector_in_setup(self):
+        with mock.patch.dict(
+                create_data_v2._LANG_DETECTORS,
+                {create_data_v2._FASTTEXT_DETECTOR: mock.Mock()}) as detectors:
+            create_examples_fn = create_data_v2._CreateExamplesFn(
+                skip_single_comment=False,
+                detect_lang=True,
+                lang_detector=create_data_v2._FASTTEXT_DETECTOR,
+                lang_model_path="/models/lid.176.bin",
+                max_depth=0,
+                lang_detection_level=create_data_v2._PATH_LANG_DETECTION,
+                lang_batch_size=256,
+            )
+            detector_cls = detectors[create_data_v2._FASTTEXT_DETECTOR]
+            detector_cls.assert_not_called()
+            create_examples_fn.setup()
+            detector_cls.assert_called_once_with("/models/lid.176.bin")
+
+    def test_fasttext_requires_model_path(self):
+        with self.assertRaises(SystemExit):
+            create_data_v2._parse_args([
+                "--reddit_table", "project:dataset.table",
+                "--output_dir", "/tmp/output",
+                "--detect_lang=true",
+                "--lang_detector", "fasttext",
+            ])
+
+    def test_incremental_requires_num_shards(self):
+        with self.assertRaises(SystemExit):
+            create_data_v2._parse_args([
+                "--reddit_table", "project:dataset.table",
+                "--output_dir", "/tmp/output",
+                "--incremental",
+            ])
+
+    def test_near_dedup_not_with_tree(self):
+        with self.assertRaises(SystemExit):
+            create_data_v2._parse_args([
+                "--reddit_table", "project:dataset.table",
+                "--output_dir", "/tmp/output",
+                "--dataset_format=TREE",
+                "--near_dedup_threshold=0.8",
+            ])
+
+    def test_hot_threads_not_with_tree(self):
+        with self.assertRaises(SystemExit):
+            create_data_v2._parse_args([
+                "--reddit_table", "project:dataset.table",
+                "--output_dir", "/tmp/output",
+                "--dataset_format=TREE",
+                "--hot_thread_threshold=100",
+            ])
+
+    def test_thread_shard(self):
+        self.assertEqual(
+            [1, 2, 3],
+            [create_data_v2._thread_shard(thread_id, 4)
+             for thread_id in ["testthread", "testthread2", "testthread3"]])
+
+    def test_select_languages(self):
+        language_counts = [("en", 10), ("tr", 5), ("so", 1), ("de", 5)]
+        self.assertEqual(
+            {"en", "tr", "so", "de"},
+            create_data_v2._select_languages(language_counts))
+        self.assertEqual(
+            {"en", "tr", "de"},
+            create_data_v2._select_languages(
+                language_counts, min_language_count=5))
+        self.assertEqual(
+            {"en", "de"},
+            create_data_v2._select_languages(
+                language_counts, top_languages=2))
+
+    def test_key_by_language(self):
+        example = {"language": "so"}
+        self.assertEqual(
+            ("so", example), create_data_v2._key_by_language(example))
+        self.assertEqual(
+            ("other", example),
+            create_data_v2._key_by_language(example, {"en", "tr"}))
+
+    def test_pushshift_source_splits(self):
+        rows = [{"id": str(i), "body": "b" * (i % 37)} for i in range(40)]
+        text = b"".join(json.dumps(row).encode("utf-8") + b"\n" for row in rows)
+        # Frames of 97 bytes, so most lines span a frame boundary.
+        compressor = zstandard.ZstdCompressor()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_name = path.join(temp_dir, "RC_2019-01.zst")
+        with open(file_name, "wb") as f:
+            for i in range(0, len(text), 97):
+                f.write(compressor.compress(text[i:i + 97]))
+
+        source = create_data_v2._PushshiftSource(file_name)
+        self.assertEqual(rows, source_test_utils.read_from_source(source))
+        splits = list(source.split(desired_bundle_size=50))
+        self.assertGreater(len(splits), 1)
+        source_test_utils.assert_sources_equal_reference_source(
+            (source, None, None),
+            [(split.source, split.start_position, split.stop_position)
+             for split in splits])
+        source_test_utils.assert_split_at_fraction_exhaustive(source)
+
+    def test_reservoir_sample(self):
+        rng = random.Random(0)
+        self.assertEqual(
+            [0, 1, 2], create_data_v2._reservoir_sample(range(3), 5, rng))
+        sample = create_data_v2._reservoir_sample(range(1000), 10, rng)
+        self.assertEqual(10, len(sample))
+        self.assertEqual(sorted(sample), sample)
+
+    def test_create_examples_sampling(self):
+        # A binary tree of comments, with 50 leaves.
+        comments = [
+            self._create_test_comment(
+                str(i), "thread" if i == 1 else str(i // 2))._replace(
+                    thread_id="thread", body="comment {}".format(i))
+            for i in range(1, 100)
+        ]
+        examples = list(create_data_v2.create_examples(comments, False, False))
+        self.assertEqual(50, len(examples))
+
+        for kwargs in [{"max_paths_per_thread": 10},
+                       {"max_examples_per_thread": 10}]:
+            sampled = list(create_data_v2.create_examples(
+                comments, False, False, **kwargs))
+            self.assertEqual(10, len(sampled))
+            self.assertEqual(
+                [example for example in examples if example in sampled],
+                sampled)
+            self.assertEqual(sampled, list(create_data_v2.create_examples(
+                comments, False, False, **kwargs)))
+            self.assertNotEqual(sampled, list(create_data_v2.create_examples(
+                comments, False, False, sampling_seed=1, **kwargs)))
+
+    def test_prune_children(self):
+        scores = {"1": 5, "2": 1, "3": 3, "4": -1, "5": 2, "6": 4, "7": 0}
+        parents = {"1": "thread", "2": "1", "3": "1", "4": "1", "5": "4",
+                   "6": "3", "7": "3"}
+        comments = [
+            self._create_test_comment(comment_id, parents[comment_id])._replace(
+                thread_id="thread", body=comment_id,
+                score=scores[comment_id])
+            for comment_id in sorted(scores)
+        ]
+
+        def _paths(**kwargs):
+            return list(create_data_v2.generate_paths_for_thread(
+                comments, **kwargs))
+
+        self.assertEqual([
+            ["thread", "1", "2"],
+            ["thread", "1", "3", "6"],
+            ["thread", "1", "3", "7"],
+            ["thread", "1", "4", "5"],
+        ], _paths())
+        self.assertEqual([
+            ["thread", "1", "2"],
+            ["thread", "1", "3", "6"],
+            ["thread", "1", "3", "7"],
+        ], _paths(drop_negative_scores=True))
+        self.assertEqual(
+            [["thread", "1", "3", "6"]], _paths(max_children=1))
+
+        tree = create_data_v2.create_tree_example(comments, max_children=1)
+        self.assertEqual(["1", "3", "6"], tree["ids"])
+
     def test_dfs(self):
         root = 1
         children = {1:[2,3], 2:[5,6], 6:[7]}
@@ -701,6 +1399,20 @@ class CreateDataTest(unittest.TestCase):
         paths = dfs.get_all_paths(root)
         assert paths == [[1,2,5], [1,2,6,7], [1,3]]
 
+    def test_dfs_max_depth(self):
+        children = {1: [2, 3], 2: [5, 6], 6: [7]}
+        dfs = create_data_v2.DFS(children, max_depth=2)
+        self.assertEqual([[1, 2, 5], [1, 2, 6], [1, 3]], dfs.get_all_paths(1))
+
+    def test_dfs_deep_thread(self):
+        """Check deep reply chains do not hit the recursion limit."""
+        children = {i: [i + 1] for i in range(5000)}
+        paths = create_data_v2.DFS(children).get_all_paths(0)
+        self.assertEqual([list(range(5001))], paths)
+
+        dfs = create_data_v2.DFS(children, max_depth=10)
+        self.assertEqual([list(range(11))], dfs.get_all_paths(0))
+
 
     def create_examples(self):
         with open("reddit/testdata/simple_thread.json") as f:
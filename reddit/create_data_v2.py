@@ -4,29 +4,94 @@ For usage see README.md.
 """
 
 import argparse
+import hashlib
 import json
 import logging
 import os
+import random
 import re
-from collections import defaultdict
+import sys
+import uuid
+from collections import defaultdict, namedtuple
 from functools import partial
+from typing import Tuple
 
 import apache_beam as beam
 import tensorflow as tf
 from apache_beam import pvalue
-from apache_beam.io import BigQuerySource, Read
-from apache_beam.io.textio import WriteToText
-from apache_beam.io.tfrecordio import WriteToTFRecord
+from apache_beam.coders import coder_impl
+from apache_beam.io import (
+    BigQuerySource,
+    Read,
+    ReadFromBigQuery,
+    filebasedsource,
+    fileio,
+)
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.io.textio import ReadFromText, WriteToText
+from apache_beam.io.tfrecordio import _TFRecordUtil
+from apache_beam.metrics import Metrics, MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
 import cld3
 
+from tools import near_dedup
+
 _TF_FORMAT = "TF"
 _JSON_FORMAT = "JSON"
+_TREE_FORMAT = "TREE"
+_PATH_LANG_DETECTION = "path"
+_COMMENT_LANG_DETECTION = "comment"
+_CLD3_DETECTOR = "cld3"
+_FASTTEXT_DETECTOR = "fasttext"
+_LANG_BATCH_SIZE = 256
+_ALL_LANGUAGES = "all"
+_OTHER_LANGUAGES = "other"
+_MANIFEST_DIR = "manifest"
+_MANIFEST_PREFIX = "manifest"
+_MANIFEST_SUFFIX = ".json"
+_INCREMENTAL_TEMP_DIR = ".incremental-temp"
+_MANIFEST_STAGING_DIR = ".manifest-staging"
+_THREADS_CHANGED_COUNTER = "incremental_threads_changed"
+_SHARDS_REWRITTEN_COUNTER = "incremental_shards_rewritten"
+_EXPORT_READ = "EXPORT"
+_DIRECT_READ = "DIRECT_READ"
+_BYTES_READ_COUNTER = "bigquery_bytes_read"
+_BYTES_SAVED_COUNTER = "bigquery_bytes_saved"
+
+# The zstd frame magic number, and the largest window of the Pushshift
+# dumps, which are compressed with `zstd --long=31`.
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_ZSTD_MAX_WINDOW_SIZE = 2**31
+_ZSTD_READ_SIZE = 2**20
+_ZSTD_CHECK_SIZE = 2**10
+
+# The BigQuery columns used by `normalise_comment`, and `created_utc`, which
+# `_RestrictRowsFn` checks against --min_created_utc and --max_created_utc.
+_SELECTED_FIELDS = [
+    "id",
+    "link_id",
+    "parent_id",
+    "body",
+    "author",
+    "subreddit",
+    "score",
+    "created_utc",
+]
 
 
 def _parse_args(argv=None):
     """Parse command line arguments."""
 
+    def _positive_int(value):
+        """Define a positive integer ArgumentParser type."""
+        value = int(value)
+        if value <= 0:
+            raise argparse.ArgumentTypeError(
+                "Value must be positive, {} was passed.".format(value)
+            )
+        return value
+
     def _nonnegative_int(value):
         """Define a non-negative integer ArgumentParser type."""
         value = int(value)
@@ -39,9 +104,13 @@ def _parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--reddit_table",
-        required=True,
         help="The BigQuery table to read comments from, in " "project:table format.",
     )
+    parser.add_argument(
+        "--pushshift_files",
+        help="A file pattern of Pushshift comment dumps, such as "
+        "/data/RC_2019-*.zst, to read instead of --reddit_table.",
+    )
     parser.add_argument(
         "--output_dir",
         required=True,
@@ -49,17 +118,28 @@ def _parse_args(argv=None):
     )
     parser.add_argument(
         "--dataset_format",
-        choices={_TF_FORMAT, _JSON_FORMAT},
+        choices={_TF_FORMAT, _JSON_FORMAT, _TREE_FORMAT},
         default="TF",
         help="The dataset format to write. 'TF' for serialized tensorflow "
         "examples in TFRecords. 'JSON' for text files with one JSON "
-        "object per line.",
+        "object per line. 'TREE' for serialized tensorflow examples in "
+        "TFRecords, with one example per thread holding its comments as a node "
+        "table.",
     )
     parser.add_argument(
         "--num_shards",
         default=0,
         type=_nonnegative_int,
-        help="The number of shards each dataset.",
+        help="The number of shards of each language. If 0, the number of "
+        "shards is chosen by the runner.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Write each thread to a shard chosen by its id, and a manifest of "
+        "the threads to --output_dir. Later builds to the same --output_dir "
+        "only rewrite the shards of threads which changed since the manifest. "
+        "Requires --num_shards.",
     )
     parser.add_argument(
         "--skip_single_comment",
@@ -71,10 +151,564 @@ def _parse_args(argv=None):
         "--detect_lang",
         default=False,
         type=bool,
-        help="Do language detection with fasttext lid.176.bin model.",
+        help="Detect the language of each example with --lang_detector.",
+    )
+    parser.add_argument(
+        "--lang_detector",
+        choices=[_CLD3_DETECTOR, _FASTTEXT_DETECTOR],
+        default=_CLD3_DETECTOR,
+        help="The language detector to use with --detect_lang. 'fasttext' "
+        "loads the model at --lang_model_path once per worker.",
+    )
+    parser.add_argument(
+        "--lang_model_path",
+        help="The path of the fastText language identification model, such as "
+        "lid.176.bin, on the workers.",
+    )
+    parser.add_argument(
+        "--lang_batch_size",
+        default=_LANG_BATCH_SIZE,
+        type=_positive_int,
+        help="The maximum number of texts passed to the language detector in "
+        "one call.",
+    )
+    parser.add_argument(
+        "--lang_detection_level",
+        choices=[_PATH_LANG_DETECTION, _COMMENT_LANG_DETECTION],
+        default=_PATH_LANG_DETECTION,
+        help="With --detect_lang, 'path' detects the language of the joined "
+        "text of each path. 'comment' detects the language of each comment "
+        "once per thread, and uses the length-weighted majority language of "
+        "the comments in a path.",
+    )
+    parser.add_argument(
+        "--min_language_count",
+        default=0,
+        type=_nonnegative_int,
+        help="With --detect_lang, languages with fewer examples than this are "
+        "written to the 'other' files.",
+    )
+    parser.add_argument(
+        "--top_languages",
+        default=0,
+        type=_nonnegative_int,
+        help="With --detect_lang, if positive, only this many of the most common "
+        "languages are written to their own files, and the rest are written to "
+        "the 'other' files.",
+    )
+    parser.add_argument(
+        "--near_dedup_threshold",
+        default=0,
+        type=float,
+        help="If positive, remove examples whose context and response both have "
+        "about this Jaccard similarity to those of another example, ignoring case "
+        "and punctuation. Near duplicates are found with MinHash LSH.",
+    )
+    parser.add_argument(
+        "--max_depth",
+        default=0,
+        type=_nonnegative_int,
+        help="If positive, dialogue paths stop at this many comments below the "
+        "submission, and deeper replies are not used.",
+    )
+    parser.add_argument(
+        "--max_children",
+        default=0,
+        type=_nonnegative_int,
+        help="If positive, dialogue paths only follow the replies to each "
+        "comment with the highest this many scores.",
+    )
+    parser.add_argument(
+        "--drop_negative_scores",
+        action="store_true",
+        help="Do not follow comments with a negative score, or their replies.",
+    )
+    parser.add_argument(
+        "--max_paths_per_thread",
+        default=0,
+        type=_nonnegative_int,
+        help="If positive, at most this many dialogue paths are sampled from "
+        "each thread, or each partition of a hot thread.",
+    )
+    parser.add_argument(
+        "--max_examples_per_thread",
+        default=0,
+        type=_nonnegative_int,
+        help="If positive, at most this many examples are sampled from each "
+        "thread, or each partition of a hot thread.",
+    )
+    parser.add_argument(
+        "--sampling_seed",
+        default=0,
+        type=int,
+        help="The seed for --max_paths_per_thread and --max_examples_per_thread, "
+        "which is combined with the thread id.",
+    )
+    parser.add_argument(
+        "--skeleton_comments",
+        action="store_true",
+        help="Replace deleted and removed comments with a skeleton, without a "
+        "body, before grouping comments by thread.",
+    )
+    parser.add_argument(
+        "--hot_thread_threshold",
+        default=0,
+        type=_nonnegative_int,
+        help="If positive, threads with more comments than this are split "
+        "into partitions of replies which are processed in parallel, rather "
+        "than as a single element.",
+    )
+    parser.add_argument(
+        "--hot_thread_partition_size",
+        default=10000,
+        type=_positive_int,
+        help="The approximate number of comments in each partition of a "
+        "thread split by --hot_thread_threshold.",
+    )
+    parser.add_argument(
+        "--bigquery_read_method",
+        choices=[_EXPORT_READ, _DIRECT_READ],
+        default=_EXPORT_READ,
+        help="How to read the reddit table. 'EXPORT' exports the whole table "
+        "to files first. 'DIRECT_READ' uses the BigQuery Storage Read API, "
+        "which only reads the columns used by the pipeline, and applies the "
+        "row restrictions in BigQuery.",
+    )
+    parser.add_argument(
+        "--subreddits",
+        help="A comma separated list of subreddits to read comments from. By "
+        "default all subreddits are read.",
+    )
+    parser.add_argument(
+        "--min_created_utc",
+        type=int,
+        help="If set, only read comments created at or after this unix "
+        "timestamp.",
+    )
+    parser.add_argument(
+        "--max_created_utc",
+        type=int,
+        help="If set, only read comments created before this unix timestamp.",
+    )
+    parser.add_argument(
+        "--max_body_length",
+        type=_positive_int,
+        help="If set, only read comments with at most this many characters. "
+        "Longer comments are removed from their threads altogether.",
     )
 
-    return parser.parse_known_args(argv)
+    args, pipeline_args = parser.parse_known_args(argv)
+    if not args.reddit_table and not args.pushshift_files:
+        parser.error("One of --reddit_table or --pushshift_files is required.")
+    if args.incremental and not args.num_shards:
+        parser.error("--incremental requires --num_shards.")
+    if args.incremental and (
+        args.hot_thread_threshold or args.min_language_count or args.top_languages
+    ):
+        parser.error(
+            "--incremental can not be used with --hot_thread_threshold, "
+            "--min_language_count or --top_languages."
+        )
+    if args.dataset_format == _TREE_FORMAT and args.detect_lang:
+        parser.error("--detect_lang can not be used with --dataset_format=TREE.")
+    if args.dataset_format == _TREE_FORMAT and args.hot_thread_threshold:
+        # A hot thread would be written as several partial trees.
+        parser.error(
+            "--hot_thread_threshold can not be used with --dataset_format=TREE."
+        )
+    if args.dataset_format == _TREE_FORMAT and (
+        args.max_paths_per_thread or args.max_examples_per_thread
+    ):
+        parser.error(
+            "--max_paths_per_thread and --max_examples_per_thread can not be used "
+            "with --dataset_format=TREE."
+        )
+    if args.near_dedup_threshold > 0 and (
+        args.dataset_format == _TREE_FORMAT or args.incremental
+    ):
+        parser.error(
+            "--near_dedup_threshold can not be used with --dataset_format=TREE or "
+            "--incremental."
+        )
+    if args.lang_detector == _FASTTEXT_DETECTOR and not args.lang_model_path:
+        parser.error("--lang_detector=fasttext requires --lang_model_path.")
+    return args, pipeline_args
+
+
+def _row_restriction(
+    subreddits=None, min_created_utc=None, max_created_utc=None, max_body_length=None
+):
+    """Creates a BigQuery row restriction from the read flags.
+
+    Returns None if there is nothing to restrict.
+    """
+    restrictions = []
+    if subreddits:
+        restrictions.append(
+            "subreddit IN ({})".format(
+                ", ".join(json.dumps(subreddit) for subreddit in subreddits)
+            )
+        )
+    if min_created_utc is not None:
+        restrictions.append("created_utc >= {}".format(min_created_utc))
+    if max_created_utc is not None:
+        restrictions.append("created_utc < {}".format(max_created_utc))
+    if max_body_length is not None:
+        restrictions.append("LENGTH(body) <= {}".format(max_body_length))
+    return " AND ".join(restrictions) or None
+
+
+def _estimate_value_bytes(value):
+    """Estimates the size of a BigQuery value, as BigQuery counts it."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, bytes):
+        return len(value)
+    return 2 + len(value.encode("utf-8"))
+
+
+class _RestrictRowsFn(beam.DoFn):
+    """Applies the column projection and row restriction of a direct read.
+
+    With `--bigquery_read_method=DIRECT_READ` BigQuery has already applied
+    them, and this only counts the bytes read. Otherwise this applies them
+    to the exported or in-memory rows, which is also how tests fake the
+    direct read, and counts the bytes a direct read would save.
+    """
+
+    def __init__(
+        self,
+        subreddits=None,
+        min_created_utc=None,
+        max_created_utc=None,
+        max_body_length=None,
+    ):
+        super(_RestrictRowsFn, self).__init__()
+        self._subreddits = set(subreddits) if subreddits else None
+        self._min_created_utc = min_created_utc
+        self._max_created_utc = max_created_utc
+        self._max_body_length = max_body_length
+        self._bytes_read = Metrics.counter(self.__class__, _BYTES_READ_COUNTER)
+        self._bytes_saved = Metrics.counter(self.__class__, _BYTES_SAVED_COUNTER)
+
+    def process(self, row):
+        row_bytes = sum(_estimate_value_bytes(value) for value in row.values())
+        if not self._matches(row):
+            self._bytes_saved.inc(row_bytes)
+            return
+        selected_row = {field: row.get(field) for field in _SELECTED_FIELDS}
+        selected_bytes = sum(
+            _estimate_value_bytes(value) for value in selected_row.values()
+        )
+        self._bytes_read.inc(selected_bytes)
+        self._bytes_saved.inc(row_bytes - selected_bytes)
+        yield selected_row
+
+    def _matches(self, row):
+        """Whether the row matches the row restriction."""
+        if self._subreddits and row["subreddit"] not in self._subreddits:
+            return False
+        if self._min_created_utc is not None or self._max_created_utc is not None:
+            if row.get("created_utc") is None:
+                return False
+            created_utc = int(row["created_utc"])
+            if (
+                self._min_created_utc is not None
+                and created_utc < self._min_created_utc
+            ):
+                return False
+            if (
+                self._max_created_utc is not None
+                and created_utc >= self._max_created_utc
+            ):
+                return False
+        if (
+            self._max_body_length is not None
+            and len(row["body"]) > self._max_body_length
+        ):
+            return False
+        return True
+
+
+def _log_direct_read_estimate(reddit_table, row_restriction):
+    """Logs the bytes a direct read scans, using a BigQuery dry run."""
+    from google.cloud import bigquery
+
+    client = bigquery.Client()
+    table_name = reddit_table.replace(":", ".")
+    table = client.get_table(table_name)
+    query = "SELECT {} FROM `{}`".format(", ".join(_SELECTED_FIELDS), table_name)
+    if row_restriction:
+        query += " WHERE " + row_restriction
+    job = client.query(
+        query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    )
+    logging.info(
+        "The direct read scans %i of the %i bytes in %s, saving %i bytes.",
+        job.total_bytes_processed,
+        table.num_bytes,
+        reddit_table,
+        table.num_bytes - job.total_bytes_processed,
+    )
+
+
+def _log_bytes_read(result):
+    """Logs the bytes counted by `_RestrictRowsFn`."""
+    bytes_counted = {}
+    for counter_name in [_BYTES_READ_COUNTER, _BYTES_SAVED_COUNTER]:
+        counters = result.metrics().query(MetricsFilter().with_name(counter_name))[
+            "counters"
+        ]
+        bytes_counted[counter_name] = sum(counter.result for counter in counters)
+    logging.info(
+        "Read %i bytes of comments, a direct read saves %i bytes.",
+        bytes_counted[_BYTES_READ_COUNTER],
+        bytes_counted[_BYTES_SAVED_COUNTER],
+    )
+
+
+def _next_zstd_frame(f, offset):
+    """Returns the offset of the first zstd frame at or after offset, or None.
+
+    A match of the frame magic number is only accepted if a valid frame
+    header follows it, and the start of the frame can be decompressed.
+    """
+    f.seek(offset)
+    buffered = b""
+    buffered_offset = offset
+    while True:
+        data = f.read(_ZSTD_READ_SIZE)
+        buffered += data
+        search_from = 0
+        while True:
+            index = buffered.find(_ZSTD_MAGIC, search_from)
+            if index == -1:
+                break
+            if _is_zstd_frame(f, buffered_offset + index):
+                return buffered_offset + index
+            search_from = index + 1
+        if not data:
+            return None
+        # Keep a partial magic number at the end of the buffer.
+        keep = min(len(_ZSTD_MAGIC) - 1, len(buffered))
+        buffered_offset += len(buffered) - keep
+        buffered = buffered[-keep:]
+        f.seek(buffered_offset + len(buffered))
+
+
+def _is_zstd_frame(f, offset):
+    """Whether a zstd frame can be decompressed from offset."""
+    import zstandard
+
+    f.seek(offset)
+    data = f.read(_ZSTD_CHECK_SIZE)
+    try:
+        zstandard.get_frame_parameters(data)
+        _zstd_decompressor().decompressobj().decompress(data)
+    except zstandard.ZstdError:
+        return False
+    return True
+
+
+def _zstd_decompressor():
+    """Returns a decompressor for the long windows of the Pushshift dumps.
+
+    zstandard is only imported to read --pushshift_files, so it is not needed
+    to read from BigQuery.
+    """
+    import zstandard
+
+    return zstandard.ZstdDecompressor(max_window_size=_ZSTD_MAX_WINDOW_SIZE)
+
+
+def _iter_zstd_chunks(f, offset):
+    """Yields (frame offset, decompressed bytes) for the frames from offset."""
+    decompressor = _zstd_decompressor()
+    decompressobj = decompressor.decompressobj()
+    frame_offset = offset
+    read_offset = offset
+    f.seek(offset)
+    while True:
+        data = f.read(_ZSTD_READ_SIZE)
+        if not data:
+            return
+        while data:
+            chunk = decompressobj.decompress(data)
+            if chunk:
+                yield frame_offset, chunk
+            if not decompressobj.eof:
+                read_offset += len(data)
+                break
+            # The frame has ended, and the rest of the data is the next one.
+            unused_data = decompressobj.unused_data
+            read_offset += len(data) - len(unused_data)
+            frame_offset = read_offset
+            decompressobj = decompressor.decompressobj()
+            data = unused_data
+
+
+class _PushshiftSource(filebasedsource.FileBasedSource):
+    """Reads comments from Pushshift NDJSON dumps compressed with zstd.
+
+    The dumps are split by compressed byte ranges. Each range reads the zstd
+    frames which start in it, so ranges find the next frame with
+    `_next_zstd_frame`. A line which spans a frame boundary is read with the
+    earlier frame, by reading the next frame up to its first newline, and is
+    skipped when reading the later frame.
+
+    A file compressed as a single frame, which is what `zstd` writes, is only
+    read by the range holding its start. Multi-frame files, such as those
+    written by `pzstd`, are read in parallel.
+    """
+
+    def __init__(self, file_pattern, min_bundle_size=0):
+        super(_PushshiftSource, self).__init__(
+            file_pattern,
+            min_bundle_size=min_bundle_size,
+            compression_type=CompressionTypes.UNCOMPRESSED,
+            splittable=True,
+        )
+
+    def read_records(self, file_name, range_tracker):
+        with self.open_file(file_name) as f:
+            frame_start = _next_zstd_frame(f, range_tracker.start_position())
+            if frame_start is None or not range_tracker.try_claim(frame_start):
+                return
+            # Lines at the start of all but the first frame begin in an
+            # earlier frame, which reads them.
+            skipping = frame_start != _next_zstd_frame(f, 0)
+            finishing = False
+            claimed_frame = frame_start
+            pending = b""
+            for frame_offset, chunk in _iter_zstd_chunks(f, frame_start):
+                if frame_offset != claimed_frame:
+                    claimed_frame = frame_offset
+                    finishing = finishing or not range_tracker.try_claim(frame_offset)
+                if skipping:
+                    newline = chunk.find(b"\n")
+                    if newline == -1:
+                        continue
+                    if finishing:
+                        # The next line starts in a frame of another range.
+                        return
+                    chunk = chunk[newline + 1 :]
+                    skipping = False
+                if finishing:
+                    # Only read the line which spans into the frame.
+                    newline = chunk.find(b"\n")
+                    if newline == -1:
+                        pending += chunk
+                        continue
+                    line = pending + chunk[:newline]
+                    if line:
+                        yield json.loads(line)
+                    return
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    if line:
+                        yield json.loads(line)
+            if pending and not skipping:
+                yield json.loads(pending)
+
+
+# Represent a reddit comment.
+Comment = namedtuple(
+    "Comment",
+    ["id", "thread_id", "parent_id", "body", "author", "subreddit", "score"],
+    defaults=(None,),
+)
+
+
+def _write_text(stream, text):
+    """Writes optional text as a varint length prefix and UTF-8 bytes.
+
+    The prefix is the length plus one, so that 0 can stand for None.
+    """
+    if text is None:
+        stream.write_var_int64(0)
+        return
+    encoded = text.encode("utf-8")
+    stream.write_var_int64(len(encoded) + 1)
+    stream.write(encoded)
+
+
+def _read_text(stream):
+    """Reads text written by `_write_text`."""
+    length = stream.read_var_int64()
+    if length == 0:
+        return None
+    return stream.read(length - 1).decode("utf-8")
+
+
+def _write_score(stream, score):
+    """Writes an optional score as a presence byte and a varint."""
+    if score is None:
+        stream.write_byte(0)
+        return
+    stream.write_byte(1)
+    stream.write_var_int64(score)
+
+
+def _read_score(stream):
+    """Reads a score written by `_write_score`."""
+    if not stream.read_byte():
+        return None
+    return stream.read_var_int64()
+
+
+def _intern(text):
+    return None if text is None else sys.intern(text)
+
+
+class _CommentCoder(beam.coders.Coder):
+    """A compact, deterministic Beam coder for `Comment`.
+
+    The text fields are written in order with `_write_text`, followed by the
+    score, so the field names are not repeated in every encoded comment as
+    they are in a pickled dict.
+    The thread ids and subreddits are interned when decoding, so the
+    comments of a thread share them.
+    """
+
+    def encode(self, comment):
+        stream = coder_impl.create_OutputStream()
+        for text in (
+            comment.id,
+            comment.thread_id,
+            comment.parent_id,
+            comment.body,
+            comment.author,
+            comment.subreddit,
+        ):
+            _write_text(stream, text)
+        _write_score(stream, comment.score)
+        return stream.get()
+
+    def decode(self, encoded):
+        stream = coder_impl.create_InputStream(encoded)
+        return Comment(
+            id=_read_text(stream),
+            thread_id=_intern(_read_text(stream)),
+            parent_id=_read_text(stream),
+            body=_read_text(stream),
+            author=_read_text(stream),
+            subreddit=_intern(_read_text(stream)),
+            score=_read_score(stream),
+        )
+
+    def is_deterministic(self):
+        return True
+
+    def to_type_hint(self):
+        return Comment
+
+
+beam.coders.registry.register_coder(Comment, _CommentCoder)
 
 
 def normalise_comment(comment):
@@ -85,53 +719,239 @@ def normalise_comment(comment):
         """Reddit IDs start with t1_, t2_, etc. which need to be stripped."""
         return re.sub("^t[0-9]_", "", raw_id)
 
-    return dict(
+    return Comment(
         id=comment["id"],
         thread_id=_normalise_id(comment["link_id"]),
         parent_id=_normalise_id(comment["parent_id"]),
         body=comment["body"],
         author=comment["author"],
         subreddit=comment["subreddit"],
+        # Scores are integers, or strings in the exported tables.
+        score=None if comment.get("score") is None else int(comment["score"]),
     )
 
 
+def _skeleton_comment(comment):
+    """Replaces a deleted or removed comment with a skeleton.
+
+    The skeleton only keeps what is needed to link its replies to the thread,
+    and the subreddit, so that less data is shuffled when grouping by thread.
+    """
+    if comment.body not in ["[deleted]", "[removed]"]:
+        return comment
+    return comment._replace(body=None, author=None)
+
+
 class DFS:
     "Get all paths in a generic tree starting from the root"
 
-    def __init__(self, children):
-        self.paths = []
+    def __init__(self, children, max_depth=0):
         self.children = children
+        self.max_depth = max_depth
 
-    def _dfs(self, node, path):
-        path.append(node)
-        if node not in self.children:
-            self.paths.append(path)
-        else:
-            for child in self.children[node]:
-                self._dfs(child, path.copy())
+    def iter_paths(self, root):
+        """Yields the path from the root to each leaf, in depth first order.
+
+        This uses an explicit stack rather than recursion, so deep trees do
+        not hit the recursion limit. All paths share a single list, which is
+        truncated and extended as the traversal moves through the tree, so a
+        yielded path is only valid until the next one is requested. If
+        `max_depth` is positive, nodes deeper than `max_depth` below the root
+        are not visited, and paths end at that depth instead.
+        """
+        path = []
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del path[depth:]
+            path.append(node)
+            children = self.children.get(node)
+            if not children or (self.max_depth and depth >= self.max_depth):
+                yield path
+                continue
+            for child in reversed(children):
+                stack.append((child, depth + 1))
 
     def get_all_paths(self, root):
-        self._dfs(root, [])
-        return self.paths
+        return [list(path) for path in self.iter_paths(root)]
+
 
+def _thread_children(thread_comments, max_children=0, drop_negative_scores=False):
+    """Returns a dict from comment (or thread) id to the ids of its replies.
 
-def generate_paths_for_thread(thread_comments):
+    If max_children is positive, only the replies with the highest
+    max_children scores are kept. With drop_negative_scores, replies with a
+    negative score are dropped, so their subtrees are not traversed. The
+    kept replies stay in their original order, and comments without a score
+    count as a score of 0.
+    """
     children = defaultdict(list)
+    scores = {}
     for comment in thread_comments:
-        children[comment["parent_id"]].append(comment["id"])
-    reddit_dfs = DFS(children)
-    root = thread_comments[0]["thread_id"]
-    reddit_paths = reddit_dfs.get_all_paths(root)
-    return reddit_paths
+        children[comment.parent_id].append(comment.id)
+        scores[comment.id] = comment.score
+    if not max_children and not drop_negative_scores:
+        return children
+    return _prune_children(children, scores, max_children, drop_negative_scores)
 
 
-def create_examples(thread, skip_single_comment, detect_lang, ft_langmodel=None):
-    """Creates serialized tensorflow examples from a reddit thread."""
-    thread_comments = list(thread)
-    id_to_comment = {comment["id"]: comment for comment in thread_comments}
+def _prune_children(children, scores, max_children=0, drop_negative_scores=False):
+    """Prunes a dict from comment (or thread) id to the ids of its replies.
+
+    See `_thread_children`. `scores` maps each comment id to its score.
+    """
+    pruned = defaultdict(list)
+    for parent_id, child_ids in children.items():
+        if drop_negative_scores:
+            child_ids = [
+                child_id for child_id in child_ids if (scores[child_id] or 0) >= 0
+            ]
+        if max_children and len(child_ids) > max_children:
+            kept_ids = set(
+                sorted(child_ids, key=lambda child_id: -(scores[child_id] or 0))[
+                    :max_children
+                ]
+            )
+            child_ids = [child_id for child_id in child_ids if child_id in kept_ids]
+        pruned[parent_id] = child_ids
+    return pruned
+
+
+def generate_paths_for_thread(
+    thread_comments,
+    max_depth=0,
+    max_paths=0,
+    rng=None,
+    max_children=0,
+    drop_negative_scores=False,
+):
+    """Returns the paths from the submission to each leaf comment of a thread.
+
+    The paths are generated lazily, one list per path. If max_paths is
+    positive, at most max_paths of them are sampled with rng. max_children
+    and drop_negative_scores prune the replies, see `_thread_children`.
+    """
+    children = _thread_children(thread_comments, max_children, drop_negative_scores)
+    reddit_dfs = DFS(children, max_depth=max_depth)
+    root = thread_comments[0].thread_id
+    paths = (list(path) for path in reddit_dfs.iter_paths(root))
+    if max_paths:
+        paths = _reservoir_sample(paths, max_paths, rng)
+    return paths
+
+
+def _thread_random(thread_comments, seed):
+    """Returns a random number generator seeded by seed and the thread id."""
+    return random.Random("{}/{}".format(seed, thread_comments[0].thread_id))
+
+
+def _reservoir_sample(values, sample_size, rng):
+    """Samples at most sample_size of the values, in their original order.
+
+    This is reservoir sampling, so only the sample is held in memory.
+    """
+    reservoir = []
+    for i, value in enumerate(values):
+        if i < sample_size:
+            reservoir.append((i, value))
+            continue
+        j = rng.randint(0, i)
+        if j < sample_size:
+            reservoir[j] = (i, value)
+    reservoir.sort(key=lambda indexed_value: indexed_value[0])
+    return [value for _, value in reservoir]
+
+
+class _Cld3Detector(object):
+    """Detects languages with cld3."""
+
+    def __init__(self, model_path=None):
+        del model_path  # cld3 ships with its model.
+
+    def predict(self, texts):
+        """Returns the language code of each text."""
+        return [cld3.get_language(text).language for text in texts]
+
+
+class _FastTextDetector(object):
+    """Detects languages with a fastText model, such as lid.176.bin."""
+
+    _LABEL_PREFIX = "__label__"
+
+    def __init__(self, model_path):
+        import fasttext
+
+        self._model = fasttext.load_model(model_path)
+
+    def predict(self, texts):
+        """Returns the language code of each text, in a single model call."""
+        # fastText predicts a label per line, so texts can not have newlines.
+        labels, _ = self._model.predict([text.replace("\n", " ") for text in texts])
+        return [label[0][len(self._LABEL_PREFIX) :] for label in labels]
+
+
+_LANG_DETECTORS = {
+    _CLD3_DETECTOR: _Cld3Detector,
+    _FASTTEXT_DETECTOR: _FastTextDetector,
+}
+
+
+def _batches(values, batch_size):
+    """Yields lists of up to batch_size values."""
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _detect_comment_languages(comments, lang_detector, batch_size):
+    """Returns a dict from comment id to the language of its body.
+
+    Comments without a body are skipped.
+    """
+    comment_languages = {}
+    for batch in _batches(
+        (comment for comment in comments if comment.body is not None), batch_size
+    ):
+        languages = lang_detector.predict([comment.body for comment in batch])
+        for comment, language in zip(batch, languages):
+            comment_languages[comment.id] = language
+    return comment_languages
+
+
+def _path_language(path_comments, comment_languages):
+    """Returns the length-weighted majority language of the comments."""
+    language_weights = defaultdict(int)
+    for comment in path_comments:
+        language_weights[comment_languages[comment.id]] += len(comment.body)
+    return max(sorted(language_weights), key=language_weights.get)
+
+
+def _path_examples(
+    thread_comments,
+    skip_single_comment,
+    max_depth,
+    max_paths=0,
+    rng=None,
+    max_children=0,
+    drop_negative_scores=False,
+):
+    """Yields (example, path_comment_texts, path_comments) for each path."""
+    id_to_comment = {comment.id: comment for comment in thread_comments}
 
     # generate all dialogue paths
-    paths = generate_paths_for_thread(thread_comments)
+    paths = generate_paths_for_thread(
+        thread_comments,
+        max_depth=max_depth,
+        max_paths=max_paths,
+        rng=rng,
+        max_children=max_children,
+        drop_negative_scores=drop_negative_scores,
+    )
 
     # iterate each path to generate text dialogues
     for path in paths:
@@ -139,35 +959,450 @@ def create_examples(thread, skip_single_comment, detect_lang, ft_langmodel=None)
         if skip_single_comment and len(path) <= 2:
             continue
 
-        path_comment_texts = []
-        for i, comment_id in enumerate(path):
-            if i == 0:
-                comment_text = "[submission]"
-            else:
-                comment_text = id_to_comment[comment_id]["body"]
-
-            if comment_text not in ["[deleted]", "[removed]"]:
-                path_comment_texts.append(comment_text)
+        path_comment_texts = ["[submission]"]
+        path_comments = []
+        for comment_id in path[1:]:
+            comment = id_to_comment[comment_id]
+            if comment.body not in [None, "[deleted]", "[removed]"]:
+                path_comment_texts.append(comment.body)
+                path_comments.append(comment)
 
         # check again after removals; if it's a single comment skip
         if skip_single_comment and len(path_comment_texts) <= 2:
             continue
 
         example = {}
-        example["subreddit"] = thread_comments[0]["subreddit"]
-        example["thread_id"] = thread_comments[0]["thread_id"]
+        example["subreddit"] = thread_comments[0].subreddit
+        example["thread_id"] = thread_comments[0].thread_id
         example["comments"] = "<sep>".join(path_comment_texts)
-        if detect_lang:
-            text = " ".join(path_comment_texts)
-            # fasttext
-            # example['language'] = ft_langmodel.predict(text.replace(
-            #     "\n", " "))[0][0][9:]
-            # cld3
-            example["language"] = cld3.get_language(text).language
-            # # langdetect
-            # example['language'] = langdetect.detect(text)
+        yield example, path_comment_texts, path_comments
+
 
-        yield example
+def create_examples(
+    thread,
+    skip_single_comment,
+    detect_lang,
+    lang_detector=None,
+    max_depth=0,
+    lang_detection_level=_PATH_LANG_DETECTION,
+    lang_batch_size=_LANG_BATCH_SIZE,
+    max_paths_per_thread=0,
+    max_examples_per_thread=0,
+    sampling_seed=0,
+    max_children=0,
+    drop_negative_scores=False,
+):
+    """Creates serialized tensorflow examples from a reddit thread.
+
+    With detect_lang, languages are detected with lang_detector, which
+    defaults to cld3, in calls of up to lang_batch_size texts.
+
+    If max_paths_per_thread or max_examples_per_thread are positive, at most
+    that many paths or examples are sampled from the thread, with a seed from
+    sampling_seed and the thread id. Languages are only detected for the
+    sampled examples.
+
+    max_children and drop_negative_scores prune the replies which are
+    followed by the paths, see `_thread_children`.
+    """
+    thread_comments = list(thread)
+    rng = None
+    if max_paths_per_thread or max_examples_per_thread:
+        rng = _thread_random(thread_comments, sampling_seed)
+    path_examples = _path_examples(
+        thread_comments,
+        skip_single_comment,
+        max_depth,
+        max_paths=max_paths_per_thread,
+        rng=rng,
+        max_children=max_children,
+        drop_negative_scores=drop_negative_scores,
+    )
+    if max_examples_per_thread:
+        path_examples = _reservoir_sample(path_examples, max_examples_per_thread, rng)
+    if not detect_lang:
+        for example, _, _ in path_examples:
+            yield example
+        return
+
+    if lang_detector is None:
+        lang_detector = _Cld3Detector()
+
+    if lang_detection_level == _COMMENT_LANG_DETECTION:
+        # Only detect the languages of the comments of the emitted paths, not
+        # those which were pruned, sampled out or beyond max_depth.
+        path_examples = list(path_examples)
+        detected_comments = {
+            comment.id: comment
+            for _, _, path_comments in path_examples
+            for comment in path_comments
+        }.values()
+        comment_languages = _detect_comment_languages(
+            detected_comments, lang_detector, lang_batch_size
+        )
+
+    for batch in _batches(path_examples, lang_batch_size):
+        if lang_detection_level == _COMMENT_LANG_DETECTION:
+            # Paths without comments fall back to the submission placeholder.
+            path_texts = [
+                " ".join(path_comment_texts)
+                for _, path_comment_texts, path_comments in batch
+                if not path_comments
+            ]
+        else:
+            path_texts = [
+                " ".join(path_comment_texts) for _, path_comment_texts, _ in batch
+            ]
+        path_languages = iter(lang_detector.predict(path_texts) if path_texts else [])
+
+        for example, _, path_comments in batch:
+            if lang_detection_level == _COMMENT_LANG_DETECTION and path_comments:
+                example["language"] = _path_language(path_comments, comment_languages)
+            else:
+                example["language"] = next(path_languages)
+            yield example
+
+
+def create_tree_example(
+    thread, max_depth=0, max_children=0, drop_negative_scores=False
+):
+    """Creates a single example holding a whole reddit thread as a node table.
+
+    The comments reachable from the submission are listed in depth first
+    order, so every comment comes after its parent. `parents` holds the index
+    of each comment's parent, or -1 for replies to the submission. Unlike the
+    path examples, each comment body appears once. Use `expand_tree` to get
+    the path examples back. max_children and drop_negative_scores prune the
+    replies, see `_thread_children`.
+    """
+    thread_comments = list(thread)
+    children = _thread_children(thread_comments, max_children, drop_negative_scores)
+    id_to_comment = {comment.id: comment for comment in thread_comments}
+
+    tree = {
+        "subreddit": thread_comments[0].subreddit,
+        "thread_id": thread_comments[0].thread_id,
+        "ids": [],
+        "parents": [],
+        "bodies": [],
+        "authors": [],
+    }
+    stack = [
+        (child_id, -1, 1)
+        for child_id in reversed(children[thread_comments[0].thread_id])
+    ]
+    while stack:
+        comment_id, parent, depth = stack.pop()
+        comment = id_to_comment[comment_id]
+        index = len(tree["ids"])
+        tree["ids"].append(comment.id)
+        tree["parents"].append(parent)
+        tree["bodies"].append(comment.body)
+        tree["authors"].append(comment.author)
+        if max_depth and depth >= max_depth:
+            continue
+        for child_id in reversed(children.get(comment_id, ())):
+            stack.append((child_id, index, depth + 1))
+    return tree
+
+
+def expand_tree(tree, skip_single_comment=False):
+    """Yields the path examples of a tree created by `create_tree_example`.
+
+    These are the same as the examples `create_examples` creates from the
+    thread, without language detection. Paths are expanded one at a time.
+    """
+    num_children = [0] * len(tree["ids"])
+    for parent in tree["parents"]:
+        if parent >= 0:
+            num_children[parent] += 1
+
+    # A thread with no replies to the submission has a single path.
+    leaves = [i for i, count in enumerate(num_children) if count == 0] or [None]
+    for leaf in leaves:
+        path = []
+        node = leaf
+        while node is not None and node >= 0:
+            path.append(node)
+            node = tree["parents"][node]
+        if skip_single_comment and len(path) <= 1:
+            continue
+
+        path_comment_texts = ["[submission]"]
+        for node in reversed(path):
+            comment_text = tree["bodies"][node]
+            if comment_text not in [None, "[deleted]", "[removed]"]:
+                path_comment_texts.append(comment_text)
+        if skip_single_comment and len(path_comment_texts) <= 2:
+            continue
+
+        yield {
+            "subreddit": tree["subreddit"],
+            "thread_id": tree["thread_id"],
+            "comments": "<sep>".join(path_comment_texts),
+        }
+
+
+def _tree_to_serialized_tf_example(tree):
+    """Convert a tree from `create_tree_example` to a serialized TF example.
+
+    Missing bodies and authors are written as "[deleted]".
+    """
+    example = tf.train.Example()
+    features = example.features.feature
+    for feature_name in ["subreddit", "thread_id"]:
+        features[feature_name].bytes_list.value.append(
+            tree[feature_name].encode("utf-8")
+        )
+    for feature_name in ["ids", "bodies", "authors"]:
+        features[feature_name].bytes_list.value.extend(
+            ("[deleted]" if value is None else value).encode("utf-8")
+            for value in tree[feature_name]
+        )
+    features["parents"].int64_list.value.extend(tree["parents"])
+    return example.SerializeToString()
+
+
+def parse_tree_example(serialized_example):
+    """Parses a serialized TF example written with `--dataset_format=TREE`.
+
+    Returns:
+        a tree, as created by `create_tree_example`, which can be passed to
+        `expand_tree`.
+    """
+    example = tf.train.Example()
+    example.ParseFromString(serialized_example)
+    features = example.features.feature
+    tree = {
+        feature_name: features[feature_name].bytes_list.value[0].decode("utf-8")
+        for feature_name in ["subreddit", "thread_id"]
+    }
+    for feature_name in ["ids", "bodies", "authors"]:
+        tree[feature_name] = [
+            value.decode("utf-8") for value in features[feature_name].bytes_list.value
+        ]
+    tree["parents"] = list(features["parents"].int64_list.value)
+    return tree
+
+
+def _plan_thread_partitions(
+    thread_id,
+    comment_links,
+    partition_size,
+    max_depth=0,
+    max_children=0,
+    drop_negative_scores=False,
+):
+    """Splits a thread into partitions of roughly `partition_size` comments.
+
+    Partitions are sibling subtrees, grouped bottom up so that each one holds
+    between `partition_size` and twice as many comments. Comments that can
+    not be reached from the submission are left out.
+
+    `comment_links` are (comment_id, parent_id, score) tuples. The replies
+    are pruned by `max_children` and `drop_negative_scores` here, over the
+    whole thread, as each partition only has some of the replies to a
+    comment. Pruning a partition again keeps all of its replies. Likewise,
+    if `max_depth` is positive, comments deeper than `max_depth` below the
+    submission are left out, so an ancestor is never cut off as a leaf in
+    several partitions.
+
+    Returns:
+        a list of (comment_id, partition, is_context) tuples. Every comment
+        on a path to a leaf of its partition appears once with
+        `is_context=False`. The parent of a partition's top comments and all
+        of its ancestors also appear with `is_context=True`, so the partition
+        generates the same dialogue paths as the thread.
+    """
+    children = defaultdict(list)
+    scores = {}
+    for comment_id, parent_id, score in comment_links:
+        children[parent_id].append(comment_id)
+        scores[comment_id] = score
+    if max_children or drop_negative_scores:
+        children = _prune_children(
+            children, scores, max_children, drop_negative_scores
+        )
+
+    parent_of = {thread_id: None}
+    depths = {thread_id: 0}
+    order = [thread_id]
+    stack = [thread_id]
+    while stack:
+        parent_id = stack.pop()
+        if max_depth and depths[parent_id] >= max_depth:
+            continue
+        for child_id in children.get(parent_id, ()):
+            if child_id in parent_of:
+                continue
+            parent_of[child_id] = parent_id
+            depths[child_id] = depths[parent_id] + 1
+            order.append(child_id)
+            stack.append(child_id)
+    if len(order) == 1:
+        # Nothing replies to the submission, so the thread is not split.
+        return [(comment_id, 0, False) for comment_id, _, _ in comment_links]
+
+    # Close groups of sibling subtrees bottom up, once they are big enough.
+    # Children are always visited after their parent, so reversing the visit
+    # order gives every child's open size before its parent needs it.
+    partition_parents = []
+    top_to_partition = {}
+    open_size = {}
+    leaf_ids = set()
+    for comment_id in reversed(order):
+        tree_children = [
+            child_id for child_id in children.get(comment_id, ())
+            if parent_of.get(child_id) == comment_id
+        ]
+        if not tree_children:
+            leaf_ids.add(comment_id)
+        group = []
+        group_size = 0
+        for i, child_id in enumerate(tree_children):
+            group.append(child_id)
+            group_size += open_size[child_id]
+            if group_size >= partition_size or (
+                    comment_id == thread_id and i == len(tree_children) - 1):
+                for top_id in group:
+                    top_to_partition[top_id] = len(partition_parents)
+                partition_parents.append(comment_id)
+                group = []
+                group_size = 0
+        open_size[comment_id] = 1 + group_size
+
+    comment_to_partition = {}
+    for comment_id in order[1:]:
+        partition = top_to_partition.get(comment_id)
+        if partition is None:
+            partition = comment_to_partition[parent_of[comment_id]]
+        comment_to_partition[comment_id] = partition
+
+    # A comment whose replies all went to other partitions would look like a
+    # leaf in its own partition, so only keep comments that end a path there.
+    assignments = []
+    path_parent_ids = set()
+    for comment_id in reversed(order[1:]):
+        if comment_id not in leaf_ids and comment_id not in path_parent_ids:
+            continue
+        partition = comment_to_partition[comment_id]
+        assignments.append((comment_id, partition, False))
+        parent_id = parent_of[comment_id]
+        if comment_to_partition.get(parent_id) == partition:
+            path_parent_ids.add(parent_id)
+
+    used_partitions = {partition for _, partition, _ in assignments}
+    for partition, ancestor_id in enumerate(partition_parents):
+        if partition not in used_partitions:
+            continue
+        while ancestor_id != thread_id:
+            assignments.append((ancestor_id, partition, True))
+            ancestor_id = parent_of[ancestor_id]
+    return assignments
+
+
+def _partition_hot_thread(
+    thread, partition_size, max_depth=0, max_children=0, drop_negative_scores=False
+):
+    """Keys the comment ids of a hot thread by their partitions."""
+    thread_id, comment_links = thread
+    for comment_id, partition, _ in _plan_thread_partitions(
+        thread_id,
+        comment_links,
+        partition_size,
+        max_depth=max_depth,
+        max_children=max_children,
+        drop_negative_scores=drop_negative_scores,
+    ):
+        yield (thread_id, comment_id), partition
+
+
+def _key_comment_by_partitions(keyed_comment_partitions):
+    """Keys a comment by each of the thread partitions it belongs to."""
+    (thread_id, _), grouped = keyed_comment_partitions
+    comments = list(grouped["comments"])
+    if not comments:
+        return
+    for partition in grouped["partitions"]:
+        yield (thread_id, partition), comments[-1]
+
+
+class _HotThreadSplitFn(beam.DoFn):
+    """Separates the comments of hot threads from the other comments."""
+
+    HOT_TAG = "hot"
+    ORDINARY_TAG = "ordinary"
+
+    def process(self, comment, hot_thread_sizes):
+        if comment.thread_id in hot_thread_sizes:
+            yield pvalue.TaggedOutput(self.HOT_TAG, comment)
+        else:
+            yield pvalue.TaggedOutput(self.ORDINARY_TAG, comment)
+
+
+def _split_hot_threads(
+    comments,
+    hot_thread_threshold,
+    partition_size,
+    max_depth=0,
+    max_children=0,
+    drop_negative_scores=False,
+):
+    """Splits threads with too many comments into partitions of replies.
+
+    A single huge thread would otherwise be one element after grouping by
+    thread id, and hold a worker for its whole duration. Each partition
+    carries the ancestors of its comments, so `create_examples` produces the
+    same dialogue paths from the partitions as from the whole thread.
+
+    Returns:
+        the comments of the ordinary threads, and a PCollection of hot thread
+        partitions as iterables of comments.
+    """
+    thread_sizes = comments | "Count comments per thread" >> (
+        beam.Map(lambda comment: (comment.thread_id, 1))
+        | beam.CombinePerKey(sum)
+    )
+    hot_thread_sizes = thread_sizes | "Find hot threads" >> beam.Filter(
+        lambda thread_size: thread_size[1] > hot_thread_threshold
+    )
+
+    comments = comments | "Split hot threads" >> beam.ParDo(
+        _HotThreadSplitFn(), pvalue.AsDict(hot_thread_sizes)
+    ).with_outputs(_HotThreadSplitFn.HOT_TAG, _HotThreadSplitFn.ORDINARY_TAG)
+    hot_comments = comments[_HotThreadSplitFn.HOT_TAG]
+
+    partitions = hot_comments | "Plan hot thread partitions" >> (
+        beam.Map(
+            lambda comment: (
+                comment.thread_id,
+                (comment.id, comment.parent_id, comment.score),
+            )
+        )
+        | "Group comment links by thread ID" >> beam.GroupByKey()
+        | beam.FlatMap(
+            partial(
+                _partition_hot_thread,
+                partition_size=partition_size,
+                max_depth=max_depth,
+                max_children=max_children,
+                drop_negative_scores=drop_negative_scores,
+            )
+        )
+    )
+    hot_comments |= "Key hot comments by ID" >> beam.Map(
+        lambda comment: ((comment.thread_id, comment.id), comment)
+    )
+
+    hot_partitions = (
+        {"comments": hot_comments, "partitions": partitions}
+        | "Join hot comments with partitions" >> beam.CoGroupByKey()
+        | "Key hot comments by partition"
+        >> beam.FlatMap(_key_comment_by_partitions)
+        | "Group comments by partition" >> beam.GroupByKey()
+        | "Get partitions" >> beam.Map(lambda t: t[1])
+    )
+    return comments[_HotThreadSplitFn.ORDINARY_TAG], hot_partitions
 
 
 def _features_to_serialized_tf_example(features):
@@ -192,29 +1427,294 @@ def _features_to_serialized_tf_example(features):
 #     return pcollection
 
 
-class _LanguageSplitFn(beam.DoFn):
-    """Splits an input PCollection of examples into different languages.
-    If language detection is not enabled ALL_TAG will be used.
+class _CreateExamplesFn(beam.DoFn):
+    """Creates examples from threads, with a language detector per worker.
+
+    The detector model is loaded once in `setup`, rather than in the driver
+    or once per thread.
     """
 
-    ALL_TAG = "all"
-    EN_TAG = "en"
-    TR_TAG = "tr"
-    OTHER_TAG = "other"
+    def __init__(
+        self,
+        skip_single_comment,
+        detect_lang,
+        lang_detector,
+        lang_model_path,
+        max_depth,
+        lang_detection_level,
+        lang_batch_size,
+        max_paths_per_thread=0,
+        max_examples_per_thread=0,
+        sampling_seed=0,
+        max_children=0,
+        drop_negative_scores=False,
+    ):
+        self._skip_single_comment = skip_single_comment
+        self._detect_lang = detect_lang
+        self._lang_detector_name = lang_detector
+        self._lang_model_path = lang_model_path
+        self._max_depth = max_depth
+        self._lang_detection_level = lang_detection_level
+        self._lang_batch_size = lang_batch_size
+        self._max_paths_per_thread = max_paths_per_thread
+        self._max_examples_per_thread = max_examples_per_thread
+        self._sampling_seed = sampling_seed
+        self._max_children = max_children
+        self._drop_negative_scores = drop_negative_scores
+        self._lang_detector = None
 
-    def __init__(self, detect_lang):
-        self.detect_lang = detect_lang
+    def setup(self):
+        if self._detect_lang:
+            self._lang_detector = _LANG_DETECTORS[self._lang_detector_name](
+                self._lang_model_path
+            )
+
+    def process(self, thread):
+        return create_examples(
+            thread,
+            skip_single_comment=self._skip_single_comment,
+            detect_lang=self._detect_lang,
+            lang_detector=self._lang_detector,
+            max_depth=self._max_depth,
+            lang_detection_level=self._lang_detection_level,
+            lang_batch_size=self._lang_batch_size,
+            max_paths_per_thread=self._max_paths_per_thread,
+            max_examples_per_thread=self._max_examples_per_thread,
+            sampling_seed=self._sampling_seed,
+            max_children=self._max_children,
+            drop_negative_scores=self._drop_negative_scores,
+        )
+
+
+def _select_languages(language_counts, min_language_count=0, top_languages=0):
+    """Returns the languages which are written to their own files.
+
+    Args:
+        language_counts: a list of (language, number of examples) pairs.
+        min_language_count: if positive, languages with fewer examples are
+            not selected.
+        top_languages: if positive, only this many of the most common
+            languages are selected.
+    """
+    language_counts = sorted(
+        language_counts,
+        key=lambda language_count: (-language_count[1], language_count[0]),
+    )
+    if top_languages:
+        language_counts = language_counts[:top_languages]
+    return {
+        language
+        for language, count in language_counts
+        if count >= min_language_count
+    }
+
+
+def _key_by_language(example, selected_languages=None):
+    """Keys an example by the files it is written to.
+
+    Examples in languages which are not selected are written to 'other'.
+    """
+    language = example["language"]
+    if selected_languages is not None and language not in selected_languages:
+        language = _OTHER_LANGUAGES
+    return language, example
+
+
+class _KeyedTextSink(fileio.TextSink):
+    """Writes the values of (destination, text) pairs as lines."""
+
+    def write(self, record):
+        super(_KeyedTextSink, self).write(record[1])
 
-    def process(self, example):
-        if self.detect_lang:
-            if example["language"] == "en":
-                yield pvalue.TaggedOutput(self.EN_TAG, example)
-            elif example["language"] == "tr":
-                yield pvalue.TaggedOutput(self.TR_TAG, example)
-            else:
-                yield pvalue.TaggedOutput(self.OTHER_TAG, example)
-        else:
-            yield pvalue.TaggedOutput(self.ALL_TAG, example)
+
+class _KeyedTFRecordSink(fileio.TextSink):
+    """Writes the values of (destination, bytes) pairs as TFRecords."""
+
+    def write(self, record):
+        _TFRecordUtil.write_record(self._fh, record[1])
+
+
+def _example_texts(example):
+    """Returns the context and response of an example, for near duplicate removal.
+
+    The context is every comment of the path but the last, which is the response.
+    """
+    comments = example["comments"].split("<sep>")
+    return "<sep>".join(comments[:-1]), comments[-1]
+
+
+def _thread_shard(thread_id, num_shards):
+    """Returns the output shard of a thread in an incremental build."""
+    return int(hashlib.md5(thread_id.encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def _shard_file_name(destination, shard, num_shards, file_name_suffix):
+    """Returns the name of a file written by `fileio.destination_prefix_naming`."""
+    return "{}-{:05d}-of-{:05d}{}".format(
+        destination, shard, num_shards, file_name_suffix
+    )
+
+
+def _manifest_entry(thread_id, thread, num_shards):
+    """Returns the manifest entry of a thread, as (thread_id, (hash, shard)).
+
+    The hash covers every field of every comment, so it changes when the
+    thread gains, loses or edits comments.
+    """
+    content = json.dumps(
+        [list(comment) for comment in sorted(thread, key=lambda c: c.id)]
+    )
+    content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+    return thread_id, (content_hash, _thread_shard(thread_id, num_shards))
+
+
+def _read_manifest(p, output_dir, num_shards):
+    """Reads the manifest of the previous incremental build in output_dir.
+
+    Returns a PCollection of manifest entries, which is empty for the first
+    build.
+    """
+    manifest_pattern = os.path.join(output_dir, _MANIFEST_DIR, _MANIFEST_PREFIX + "*")
+    manifest_files = [
+        metadata.path
+        for metadata in FileSystems.match([manifest_pattern])[0].metadata_list
+    ]
+    if not manifest_files:
+        return p | "Create empty manifest" >> beam.Create([])
+    manifest_suffix = "-of-{:05d}{}".format(num_shards, _MANIFEST_SUFFIX)
+    if not all(file_name.endswith(manifest_suffix) for file_name in manifest_files):
+        raise ValueError(
+            "The previous build in {} used a different --num_shards.".format(output_dir)
+        )
+    return (
+        p
+        | "Read previous manifest" >> ReadFromText(manifest_pattern)
+        | "Parse previous manifest" >> beam.Map(json.loads)
+        | "Key previous manifest"
+        >> beam.Map(lambda entry: (entry[0], tuple(entry[1])))
+    )
+
+
+class _ChangedShardsFn(beam.DoFn):
+    """Yields the shards to rewrite for a thread, given its manifest entries.
+
+    A thread which is new, changed or deleted since the previous build marks
+    its shards as changed.
+    """
+
+    def __init__(self):
+        self._threads_changed = Metrics.counter(
+            self.__class__, _THREADS_CHANGED_COUNTER
+        )
+
+    def process(self, element):
+        _, entries = element
+        current = list(entries["current"])
+        previous = list(entries["previous"])
+        if current == previous:
+            return
+        self._threads_changed.inc()
+        for _, shard in current + previous:
+            yield shard
+
+
+class _WriteShardFn(beam.DoFn):
+    """Rewrites the files of a shard of an incremental build.
+
+    The new files of each destination are written to a temporary directory.
+    Then the files the shard had in the previous build are deleted, and the
+    new files are moved into place.
+    """
+
+    def __init__(self, output_dir, num_shards, file_name_suffix, sink):
+        self._output_dir = output_dir
+        self._num_shards = num_shards
+        self._file_name_suffix = file_name_suffix
+        self._sink = sink
+        self._shards_rewritten = Metrics.counter(
+            self.__class__, _SHARDS_REWRITTEN_COUNTER
+        )
+
+    def process(self, element):
+        shard, grouped = element
+        temp_dir = FileSystems.join(self._output_dir, _INCREMENTAL_TEMP_DIR)
+        files = {}
+        for destination, serialized_example in grouped["examples"]:
+            if destination not in files:
+                file_name = _shard_file_name(
+                    destination, shard, self._num_shards, self._file_name_suffix
+                )
+                temp_path = FileSystems.join(
+                    temp_dir, "{}-{}".format(uuid.uuid4().hex, file_name)
+                )
+                file_handle = FileSystems.create(
+                    temp_path, compression_type=CompressionTypes.UNCOMPRESSED
+                )
+                sink = self._sink()
+                sink.open(file_handle)
+                files[destination] = (file_name, temp_path, file_handle, sink)
+            files[destination][3].write((destination, serialized_example))
+
+        for _, _, file_handle, sink in files.values():
+            sink.flush()
+            file_handle.close()
+
+        previous_pattern = FileSystems.join(
+            self._output_dir,
+            _shard_file_name("*", shard, self._num_shards, self._file_name_suffix),
+        )
+        previous_files = [
+            metadata.path
+            for metadata in FileSystems.match([previous_pattern])[0].metadata_list
+        ]
+        if previous_files:
+            FileSystems.delete(previous_files)
+        if files:
+            FileSystems.rename(
+                [temp_path for _, temp_path, _, _ in files.values()],
+                [
+                    FileSystems.join(self._output_dir, file_name)
+                    for file_name, _, _, _ in files.values()
+                ],
+            )
+        self._shards_rewritten.inc()
+        yield shard
+
+
+def _commit_manifest(unused_element, output_dir, staged_files, written_shards):
+    """Moves the manifest staged by an incremental build into place.
+
+    This runs after all the changed shards were written, which are passed as a
+    side input, so the manifest never has the hashes of shards which were not
+    rewritten. The staged files have the same names as the previous manifest,
+    which they replace.
+    """
+    del unused_element, written_shards
+    manifest_dir = FileSystems.join(output_dir, _MANIFEST_DIR)
+    if not FileSystems.exists(manifest_dir):
+        FileSystems.mkdirs(manifest_dir)
+    FileSystems.rename(
+        list(staged_files),
+        [
+            FileSystems.join(manifest_dir, os.path.basename(staged_file))
+            for staged_file in staged_files
+        ],
+    )
+
+
+def _log_incremental_build(result):
+    """Logs the counters of `_ChangedShardsFn` and `_WriteShardFn`."""
+    counted = {}
+    for counter_name in [_THREADS_CHANGED_COUNTER, _SHARDS_REWRITTEN_COUNTER]:
+        counters = result.metrics().query(MetricsFilter().with_name(counter_name))[
+            "counters"
+        ]
+        counted[counter_name] = sum(counter.result for counter in counters)
+    logging.info(
+        "%i threads changed since the previous build, %i shards were rewritten.",
+        counted[_THREADS_CHANGED_COUNTER],
+        counted[_SHARDS_REWRITTEN_COUNTER],
+    )
 
 
 def run(argv=None, comments=None):
@@ -231,37 +1731,78 @@ def run(argv=None, comments=None):
     pipeline_options.view_as(SetupOptions).save_main_session = True
 
     with beam.Pipeline(options=pipeline_options) as p:
-        # if args.detect_lang:
-        #     import fasttext
-        #     ft_langmodel = fasttext.load_model(
-        #         "/Users/keremturgutlu/Desktop/git/fastText/models/lid.176.bin")
-        # else:
-        #     ft_langmodel = None
-        ft_langmodel = None
-
         # print(args, pipeline_args)
         # raise Exception("stop")
 
+        subreddits = args.subreddits.split(",") if args.subreddits else None
+        row_restriction = _row_restriction(
+            subreddits=subreddits,
+            min_created_utc=args.min_created_utc,
+            max_created_utc=args.max_created_utc,
+            max_body_length=args.max_body_length,
+        )
+
         if comments is not None:
             comments = p | ("Read in-memory comments") >> beam.Create(comments)
 
+        elif args.pushshift_files:
+            comments = p | ("Read " + args.pushshift_files) >> Read(
+                _PushshiftSource(args.pushshift_files)
+            )
+
         elif "DirectRunner" in pipeline_args or "PortableRunner" in pipeline_args:
             with open("reddit/testdata/simple_thread.json") as f:
                 comments = json.loads(f.read())
             comments = p | ("Read in-memory comments") >> beam.Create(comments)
 
+        elif args.bigquery_read_method == _DIRECT_READ:
+            _log_direct_read_estimate(args.reddit_table, row_restriction)
+            comments = p | ("Read " + args.reddit_table) >> ReadFromBigQuery(
+                table=args.reddit_table,
+                method=ReadFromBigQuery.Method.DIRECT_READ,
+                selected_fields=_SELECTED_FIELDS,
+                row_restriction=row_restriction,
+            )
+
         else:
             comments = p | ("Read " + args.reddit_table) >> Read(
                 BigQuerySource(args.reddit_table)
             )
 
+        comments |= "Restrict rows" >> beam.ParDo(
+            _RestrictRowsFn(
+                subreddits=subreddits,
+                min_created_utc=args.min_created_utc,
+                max_created_utc=args.max_created_utc,
+                max_body_length=args.max_body_length,
+            )
+        )
+
         # Normalize and Create a _Comment:namedtuple  object from a row in the BigQuery table.
-        comments |= "Normalise comments" >> beam.Map(normalise_comment)
+        comments |= "Normalise comments" >> beam.Map(
+            normalise_comment
+        ).with_output_types(Comment)
+        if args.skeleton_comments:
+            comments |= "Replace deleted comments with skeletons" >> beam.Map(
+                _skeleton_comment
+            ).with_output_types(Comment)
+
+        if args.hot_thread_threshold:
+            comments, hot_partitions = _split_hot_threads(
+                comments,
+                hot_thread_threshold=args.hot_thread_threshold,
+                partition_size=args.hot_thread_partition_size,
+                max_depth=args.max_depth,
+                max_children=args.max_children,
+                drop_negative_scores=args.drop_negative_scores,
+            )
 
         # Create (thread_id,_Comment) : (k,v) pairs
         thread_id_to_comments = comments | (
             "Key by thread id"
-            >> beam.Map(lambda comment: (comment["thread_id"], comment))
+            >> beam.Map(
+                lambda comment: (comment.thread_id, comment)
+            ).with_output_types(Tuple[str, Comment])
         )
 
         # Group Comments by thread id
@@ -269,66 +1810,197 @@ def run(argv=None, comments=None):
             "Group comments by thread ID" >> beam.GroupByKey()
         )
 
+        if args.incremental:
+            manifest = threads | "Create manifest entries" >> beam.MapTuple(
+                lambda thread_id, thread: _manifest_entry(
+                    thread_id, thread, args.num_shards
+                )
+            )
+            changed_shards = (
+                {
+                    "current": manifest,
+                    "previous": _read_manifest(p, args.output_dir, args.num_shards),
+                }
+                | "Join manifests" >> beam.CoGroupByKey()
+                | "Get changed shards" >> beam.ParDo(_ChangedShardsFn())
+                | "Deduplicate changed shards" >> beam.Distinct()
+            )
+            threads |= "Keep threads of changed shards" >> beam.Filter(
+                lambda thread, shards: _thread_shard(thread[0], args.num_shards)
+                in shards,
+                shards=pvalue.AsDict(
+                    changed_shards
+                    | "Key changed shards" >> beam.Map(lambda shard: (shard, None))
+                ),
+            )
+            # The manifest is staged, and only replaces the previous manifest
+            # once the changed shards are written.
+            staged_manifest = (
+                manifest
+                | "Serialize manifest" >> beam.Map(json.dumps)
+                | "Stage manifest"
+                >> WriteToText(
+                    os.path.join(
+                        args.output_dir, _MANIFEST_STAGING_DIR, _MANIFEST_PREFIX
+                    ),
+                    file_name_suffix=_MANIFEST_SUFFIX,
+                    num_shards=args.num_shards,
+                )
+            )
+
         # Get threads
         threads = threads | ("Get threads" >> beam.Map(lambda t: t[1]))
+        if args.hot_thread_threshold:
+            threads = (threads, hot_partitions) | (
+                "Merge hot thread partitions" >> beam.Flatten()
+            )
 
         # Generate dialogue trees (examples) from threads
-        examples = threads | (
-            "Create {} examples".format(args.dataset_format)
-            >> beam.FlatMap(
-                partial(
-                    create_examples,
-                    skip_single_comment=args.skip_single_comment,
-                    detect_lang=args.detect_lang,
-                    ft_langmodel=ft_langmodel,
+        if args.dataset_format == _TREE_FORMAT:
+            examples = threads | (
+                "Create TREE examples"
+                >> beam.Map(
+                    partial(
+                        create_tree_example,
+                        max_depth=args.max_depth,
+                        max_children=args.max_children,
+                        drop_negative_scores=args.drop_negative_scores,
+                    )
+                )
+            )
+        else:
+            examples = threads | (
+                "Create {} examples".format(args.dataset_format)
+                >> beam.ParDo(
+                    _CreateExamplesFn(
+                        skip_single_comment=args.skip_single_comment,
+                        detect_lang=args.detect_lang,
+                        lang_detector=args.lang_detector,
+                        lang_model_path=args.lang_model_path,
+                        max_depth=args.max_depth,
+                        lang_detection_level=args.lang_detection_level,
+                        lang_batch_size=args.lang_batch_size,
+                        max_paths_per_thread=args.max_paths_per_thread,
+                        max_examples_per_thread=args.max_examples_per_thread,
+                        sampling_seed=args.sampling_seed,
+                        max_children=args.max_children,
+                        drop_negative_scores=args.drop_negative_scores,
+                    )
                 )
             )
-        )
 
         # examples = _shuffle(examples)
 
-        examples |= "split by language" >> beam.ParDo(
-            _LanguageSplitFn(args.detect_lang)
-        ).with_outputs(
-            _LanguageSplitFn.ALL_TAG,
-            _LanguageSplitFn.EN_TAG,
-            _LanguageSplitFn.TR_TAG,
-            _LanguageSplitFn.OTHER_TAG,
-        )
+        if args.near_dedup_threshold > 0:
+            examples = near_dedup.remove_near_duplicates(
+                examples, _example_texts, args.near_dedup_threshold
+            )
+
+        if args.detect_lang and (args.min_language_count or args.top_languages):
+            selected_languages = pvalue.AsSingleton(
+                examples
+                | "Get languages" >> beam.Map(lambda example: example["language"])
+                | "Count languages" >> beam.combiners.Count.PerElement()
+                | "Collect language counts" >> beam.combiners.ToList()
+                | "Select languages"
+                >> beam.Map(
+                    _select_languages,
+                    min_language_count=args.min_language_count,
+                    top_languages=args.top_languages,
+                )
+            )
+        else:
+            selected_languages = None
+
+        if args.detect_lang:
+            examples |= "Key by language" >> beam.Map(
+                _key_by_language, selected_languages=selected_languages
+            )
+        else:
+            examples |= "Key by dataset" >> beam.Map(
+                lambda example: (_ALL_LANGUAGES, example)
+            )
 
         if args.dataset_format == _JSON_FORMAT:
-            write_sink = WriteToText
+            sink = _KeyedTextSink
             file_name_suffix = ".json"
             serialize_fn = json.dumps
+        elif args.dataset_format == _TREE_FORMAT:
+            sink = _KeyedTFRecordSink
+            file_name_suffix = ".tfrecord"
+            serialize_fn = _tree_to_serialized_tf_example
         else:
             assert args.dataset_format == _TF_FORMAT
-            write_sink = WriteToTFRecord
+            sink = _KeyedTFRecordSink
             file_name_suffix = ".tfrecord"
             serialize_fn = _features_to_serialized_tf_example
 
-        if args.detect_lang:
-            dataset_tags = [
-                ("en", _LanguageSplitFn.EN_TAG),
-                ("tr", _LanguageSplitFn.TR_TAG),
-                ("other", _LanguageSplitFn.OTHER_TAG),
-            ]
+        if args.incremental:
+            # Only the changed shards are rewritten, including those which no
+            # longer have any examples.
+            shard_examples = examples | "Serialize examples" >> beam.MapTuple(
+                lambda destination, example: (
+                    _thread_shard(example["thread_id"], args.num_shards),
+                    (destination, serialize_fn(example)),
+                )
+            )
+            written_shards = (
+                {
+                    "examples": shard_examples,
+                    "changed": changed_shards
+                    | "Key changed shards to write"
+                    >> beam.Map(lambda shard: (shard, None)),
+                }
+                | "Group examples by shard" >> beam.CoGroupByKey()
+                | "Write changed shards"
+                >> beam.ParDo(
+                    _WriteShardFn(
+                        args.output_dir, args.num_shards, file_name_suffix, sink
+                    )
+                )
+            )
+            (
+                p
+                | "Create manifest commit" >> beam.Create([None])
+                | "Commit manifest"
+                >> beam.Map(
+                    _commit_manifest,
+                    output_dir=args.output_dir,
+                    staged_files=pvalue.AsList(staged_manifest),
+                    written_shards=pvalue.AsList(written_shards),
+                )
+            )
         else:
-            dataset_tags = [("all", _LanguageSplitFn.ALL_TAG)]
-
-        for name, tag in dataset_tags:
-            serialized_examples = examples[tag] | (
-                "serialize {} examples".format(name) >> beam.Map(serialize_fn)
+            serialized_examples = examples | "Serialize examples" >> beam.MapTuple(
+                lambda destination, example: (destination, serialize_fn(example))
             )
+
+            # All the languages are written by a single sink, to files named
+            # <language>-<shard>-of-<num shards>. With --num_shards every example
+            # is sharded, rather than being written by the worker that created it.
             (
                 serialized_examples
-                | ("write " + name)
-                >> write_sink(
-                    os.path.join(args.output_dir, name),
-                    file_name_suffix=file_name_suffix,
-                    num_shards=args.num_shards,
+                | "Write examples"
+                >> fileio.WriteToFiles(
+                    path=args.output_dir,
+                    destination=lambda record: record[0],
+                    sink=lambda destination: sink(),
+                    file_naming=fileio.destination_prefix_naming(file_name_suffix),
+                    shards=args.num_shards or None,
+                    max_writers_per_bundle=(
+                        0
+                        if args.num_shards
+                        else fileio.WriteToFiles.MAX_NUM_WRITERS_PER_BUNDLE
+                    ),
                 )
             )
 
+    if args.incremental:
+        _log_incremental_build(p.result)
+    if args.near_dedup_threshold > 0:
+        near_dedup.log_near_duplicates(p.result)
+    _log_bytes_read(p.result)
+
 
 if __name__ == "__main__":
     logging.getLogger().setLevel(logging.INFO)
@@ -0,0 +1,14 @@
+"""Packages the modules shared by the dataset scripts, for Dataflow workers.
+
+The scripts import the Beam stages in `tools`, such as `tools.shuffle`, so
+Dataflow jobs are run from the root of the repository with
+`--setup_file ./setup.py`.
+"""
+
+import setuptools
+
+setuptools.setup(
+    name="conversational-datasets",
+    version="0.0.1",
+    packages=["tools"],
+)
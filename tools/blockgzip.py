@@ -0,0 +1,83 @@
+"""Recompress text files as gzip files with many members.
+
+A gzip file can be a concatenation of independent gzip members, which
+`gunzip` and Beam's `ReadFromText` read as a single file. The dataset
+scripts can split such files into byte ranges which are read in parallel,
+for example with `amazon_qa/create_data.py --splittable_gzip`.
+
+Usage:
+
+To recompress a gzip or plain text file, with a member for about every
+megabyte of text:
+
+    python tools/blockgzip.py compress qa_Appliances.json.gz \
+        qa_Appliances.block.json.gz
+
+Members end at line boundaries. This can accept gs:// file paths, as well
+as local files.
+"""
+
+import gzip
+import zlib
+
+import click
+import tensorflow as tf
+
+
+def _open_text(path):
+    """Opens a file for reading bytes, decompressing it if it is gzipped."""
+    f = tf.io.gfile.GFile(path, "rb")
+    if f.read(2) == b"\x1f\x8b":
+        f.seek(0)
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    f.seek(0)
+    return f
+
+
+def _compress_member(data, compression_level):
+    """Compresses data as a single gzip member."""
+    compressor = zlib.compressobj(
+        compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@click.group()
+def _cli():
+    """Recompress text files as gzip files with many members."""
+    pass
+
+
+@_cli.command(name="compress")
+@click.argument("path", type=str, required=True, nargs=1)
+@click.argument("out", type=str, required=True, nargs=1)
+@click.option("--member_size", type=int, default=2 ** 20,
+              help="The number of uncompressed bytes in each member.")
+@click.option("--compression_level", type=int, default=6)
+def _compress(path, out, member_size, compression_level):
+    """Recompress a text file as gzip members of whole lines."""
+    num_members = 0
+    num_bytes = 0
+    with _open_text(path) as f, tf.io.gfile.GFile(out, "wb") as out_f:
+        lines = []
+        lines_size = 0
+        for line in f:
+            lines.append(line)
+            lines_size += len(line)
+            if lines_size >= member_size:
+                out_f.write(_compress_member(b"".join(lines),
+                                             compression_level))
+                num_members += 1
+                num_bytes += lines_size
+                lines = []
+                lines_size = 0
+        if lines:
+            out_f.write(_compress_member(b"".join(lines), compression_level))
+            num_members += 1
+            num_bytes += lines_size
+
+    print("Wrote %i bytes of text to %s, in %i gzip members." % (
+        num_bytes, out, num_members))
+
+
+if __name__ == "__main__":
+    _cli()
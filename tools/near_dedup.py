@@ -0,0 +1,220 @@
+"""A Beam stage to remove near duplicate examples with MinHash LSH.
+
+This is shared by the dataset scripts, for example
+`amazon_qa/create_data.py --near_dedup_threshold 0.8`. Two elements are
+near duplicates if each of their texts has about the given Jaccard
+similarity to the other's, after ignoring case and punctuation.
+
+Usage:
+
+    examples = near_dedup.remove_near_duplicates(
+        examples, texts_fn, threshold)
+    ...
+    near_dedup.log_near_duplicates(result)
+"""
+
+import hashlib
+import json
+import logging
+import re
+import zlib
+
+import apache_beam as beam
+import numpy as np
+from apache_beam.metrics import Metrics, MetricsFilter
+
+NEAR_DUPLICATES_COUNTER = "near_duplicates_removed"
+BUCKET_DUPLICATES_DISTRIBUTION = "near_duplicates_per_bucket"
+_NUM_PERMUTATIONS = 128
+_SHINGLE_SIZE = 5
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_LOW_30_BITS = (1 << 30) - 1
+_LOW_31_BITS = (1 << 31) - 1
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def fingerprint(element):
+    """Returns a 128 bit hash of a JSON serializable element."""
+    md5 = hashlib.md5()
+    md5.update(json.dumps(element, sort_keys=True).encode("utf-8"))
+    return md5.digest()
+
+
+def _shingles(text, shingle_size):
+    """Returns the character shingles of a text.
+
+    Case and punctuation are ignored, so texts which only differ in them have
+    the same shingles.
+    """
+    text = _NON_WORD_RE.sub(" ", text.lower()).strip()
+    if len(text) <= shingle_size:
+        return {text}
+    return {text[i:i + shingle_size]
+            for i in range(len(text) - shingle_size + 1)}
+
+
+def _lsh_parameters(threshold, num_permutations):
+    """Returns the LSH (bands, rows) for a Jaccard similarity threshold.
+
+    Two texts share a bucket with probability 1 - (1 - s^rows)^bands, for a
+    Jaccard similarity s. This chooses the bands and rows whose threshold,
+    (1 / bands)^(1 / rows), is closest to the given threshold.
+    """
+    return min(
+        ((bands, num_permutations // bands)
+         for bands in range(1, num_permutations + 1)),
+        key=lambda params: abs(
+            (1.0 / params[0]) ** (1.0 / params[1]) - threshold))
+
+
+def _permute(a, b, hashes):
+    """Returns (a * hashes + b) mod the Mersenne prime 2^61 - 1.
+
+    a and b are uint64 arrays of values below the prime, and hashes of 32 bit
+    values. The product of a 61 bit and a 32 bit value does not fit in 64
+    bits, so the high 30 bits of a are multiplied separately and reduced,
+    using 2^61 = 1 mod the prime, before they are shifted into place.
+    """
+    high = (a >> np.uint64(31)) * hashes % np.uint64(_MERSENNE_PRIME)
+    high = (
+        (high >> np.uint64(30))
+        + ((high & np.uint64(_LOW_30_BITS)) << np.uint64(31)))
+    low = (a & np.uint64(_LOW_31_BITS)) * hashes
+    return (high + low + b) % np.uint64(_MERSENNE_PRIME)
+
+
+class _MinHashBandsFn(beam.DoFn):
+    """Keys the fingerprint of each element by its LSH buckets.
+
+    The MinHash signatures of the texts of each element are split into
+    bands, and each band of all the signatures is hashed to a bucket.
+    Elements are likely to share a bucket if each of their texts is similar.
+    """
+
+    def __init__(self, texts_fn, threshold, seed=0):
+        super(_MinHashBandsFn, self).__init__()
+        self._texts_fn = texts_fn
+        self._bands, self._rows = _lsh_parameters(
+            threshold, _NUM_PERMUTATIONS)
+        self._seed = seed
+
+    def setup(self):
+        # Every worker must use the same permutations.
+        rng = np.random.RandomState(self._seed)
+        self._a = rng.randint(
+            1, _MERSENNE_PRIME, size=(_NUM_PERMUTATIONS, 1), dtype=np.uint64)
+        self._b = rng.randint(
+            0, _MERSENNE_PRIME, size=(_NUM_PERMUTATIONS, 1), dtype=np.uint64)
+
+    def _signature(self, text):
+        """Returns the MinHash signature of the shingles of a text."""
+        hashes = np.array([
+            zlib.crc32(shingle.encode("utf-8"))
+            for shingle in _shingles(text, _SHINGLE_SIZE)
+        ], dtype=np.uint64)
+        return (
+            _permute(self._a, self._b, hashes) & np.uint64(_MAX_HASH)
+        ).min(axis=1)
+
+    def process(self, element):
+        element_fingerprint, value = element
+        signatures = [
+            self._signature(text) for text in self._texts_fn(value)]
+        for band in range(self._bands):
+            md5 = hashlib.md5()
+            for signature in signatures:
+                md5.update(signature[
+                    band * self._rows:(band + 1) * self._rows].tobytes())
+            yield (band, md5.digest()[:8]), element_fingerprint
+
+
+class _BucketDuplicatesFn(beam.DoFn):
+    """Yields the fingerprints in an LSH bucket, except the smallest.
+
+    The sizes of the buckets with duplicates are recorded in the
+    `near_duplicates_per_bucket` distribution.
+    """
+
+    def __init__(self):
+        super(_BucketDuplicatesFn, self).__init__()
+        self._bucket_duplicates = Metrics.distribution(
+            self.__class__, BUCKET_DUPLICATES_DISTRIBUTION)
+
+    def process(self, element):
+        _, fingerprints = element
+        # The grouped values can be iterated twice, without holding a large
+        # bucket in memory.
+        smallest = min(fingerprints)
+        num_duplicates = 0
+        for element_fingerprint in fingerprints:
+            if element_fingerprint != smallest:
+                num_duplicates += 1
+                yield element_fingerprint
+        if num_duplicates:
+            self._bucket_duplicates.update(num_duplicates)
+
+
+class _DropNearDuplicatesFn(beam.DoFn):
+    """Drops the elements which were found to be near duplicates."""
+
+    def __init__(self):
+        super(_DropNearDuplicatesFn, self).__init__()
+        self._near_duplicates = Metrics.counter(
+            self.__class__, NEAR_DUPLICATES_COUNTER)
+
+    def process(self, element):
+        _, grouped = element
+        if list(grouped["duplicates"]):
+            self._near_duplicates.inc(len(list(grouped["elements"])))
+            return
+        for value in grouped["elements"]:
+            yield value
+
+
+def remove_near_duplicates(elements, texts_fn, threshold):
+    """Removes elements whose texts are near duplicates of another's.
+
+    texts_fn returns the texts of an element, which must all be near
+    duplicates for two elements to be. Near duplicates are found with MinHash
+    LSH: the elements of each LSH bucket other than the one with the smallest
+    fingerprint are removed. Only the 8 byte buckets and 16 byte fingerprints
+    are shuffled to find them, and no worker holds more than one bucket. As
+    the signatures are not compared, the threshold is only approximate.
+    """
+    keyed_elements = elements | "Key by fingerprint" >> beam.Map(
+        lambda element: (fingerprint(element), element))
+    duplicates = (
+        keyed_elements
+        | "Compute MinHash buckets" >> beam.ParDo(
+            _MinHashBandsFn(texts_fn, threshold))
+        | "Group MinHash buckets" >> beam.GroupByKey()
+        | "Get bucket duplicates" >> beam.ParDo(_BucketDuplicatesFn())
+        | "Deduplicate near duplicates" >> beam.Distinct()
+        | "Key near duplicates" >> beam.Map(
+            lambda element_fingerprint: (element_fingerprint, None))
+    )
+    return (
+        {"elements": keyed_elements, "duplicates": duplicates}
+        | "Join near duplicates" >> beam.CoGroupByKey()
+        | "Drop near duplicates" >> beam.ParDo(_DropNearDuplicatesFn())
+    )
+
+
+def log_near_duplicates(result):
+    """Logs the counters of `remove_near_duplicates`."""
+    metrics = result.metrics()
+    counters = metrics.query(
+        MetricsFilter().with_name(NEAR_DUPLICATES_COUNTER))["counters"]
+    distributions = metrics.query(
+        MetricsFilter().with_name(BUCKET_DUPLICATES_DISTRIBUTION)
+    )["distributions"]
+    num_buckets = sum(
+        distribution.result.count for distribution in distributions)
+    max_duplicates = max(
+        [distribution.result.max for distribution in distributions
+         if distribution.result.count] or [0])
+    logging.info(
+        "Removed %i near duplicates, from %i LSH buckets with at most %i "
+        "duplicates.", sum(counter.result for counter in counters),
+        num_buckets, max_duplicates)
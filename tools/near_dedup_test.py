@@ -0,0 +1,79 @@
+"""Tests for near_dedup.py."""
+
+import unittest
+
+import apache_beam as beam
+import numpy as np
+from apache_beam.metrics import MetricsFilter
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
+
+from tools import near_dedup
+
+
+def _qa_texts(qa_tuple):
+    return qa_tuple[1:]
+
+
+class RemoveNearDuplicatesTest(unittest.TestCase):
+    """Test `near_dedup.remove_near_duplicates`."""
+
+    _QA_TUPLES = [
+        ("1", "Does this fit a 2014 Honda Civic?",
+         "Yes, it fits my 2014 Civic perfectly."),
+        ("2", "does this fit a 2014 honda civic",
+         "yes it fits my 2014 civic perfectly!!"),
+        ("3", "Does this fit a 2014 Honda Civic...",
+         "YES - it fits my 2014 Civic perfectly."),
+        ("4", "Does this fit a 2015 Honda Accord?",
+         "No, it does not fit the Accord."),
+        ("5", "Is the battery included?",
+         "No, you need to buy two AA batteries."),
+    ]
+
+    def test_remove_near_duplicates(self):
+        p = TestPipeline()
+        qa_tuples = near_dedup.remove_near_duplicates(
+            p | beam.Create(self._QA_TUPLES), _qa_texts, threshold=0.8)
+        keep = sorted(
+            self._QA_TUPLES[:3], key=near_dedup.fingerprint)[0]
+        assert_that(
+            qa_tuples, equal_to([keep] + self._QA_TUPLES[3:]))
+        result = p.run()
+        result.wait_until_finish()
+
+        counters = result.metrics().query(MetricsFilter().with_name(
+            near_dedup.NEAR_DUPLICATES_COUNTER))['counters']
+        self.assertEqual(2, sum(counter.result for counter in counters))
+        distributions = result.metrics().query(MetricsFilter().with_name(
+            near_dedup.BUCKET_DUPLICATES_DISTRIBUTION))['distributions']
+        self.assertEqual(
+            2, max(distribution.result.max
+                   for distribution in distributions))
+
+    def test_shingles(self):
+        self.assertEqual(
+            near_dedup._shingles("Yes, it FITS!", 5),
+            near_dedup._shingles("yes it fits", 5))
+        self.assertEqual({"yes"}, near_dedup._shingles("Yes!", 5))
+
+    def test_lsh_parameters(self):
+        bands, rows = near_dedup._lsh_parameters(0.8, 128)
+        self.assertLessEqual(bands * rows, 128)
+        self.assertAlmostEqual(0.8, (1.0 / bands) ** (1.0 / rows), places=1)
+
+    def test_permute(self):
+        # The products of these do not fit in 64 bits.
+        a = np.array([[1], [(1 << 61) - 2], [(1 << 60) + 12345]],
+                     dtype=np.uint64)
+        b = np.array([[0], [(1 << 61) - 2], [987654321]], dtype=np.uint64)
+        hashes = np.array([0, 1, (1 << 32) - 1, 3141592653], dtype=np.uint64)
+        self.assertEqual(
+            [[(int(a_i) * int(hash_value) + int(b_i)) % ((1 << 61) - 1)
+              for hash_value in hashes]
+             for a_i, b_i in zip(a[:, 0], b[:, 0])],
+            near_dedup._permute(a, b, hashes).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
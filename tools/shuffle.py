@@ -0,0 +1,167 @@
+"""A Beam stage to shuffle examples before they are written.
+
+This is shared by the dataset scripts, which add its flags to their parser
+and shuffle their examples as set by `--shuffle_mode`.
+
+Usage:
+
+    shuffle.add_arguments(parser)
+    ...
+    examples |= "shuffle examples" >> shuffle.shuffle(
+        shuffle_mode=args.shuffle_mode,
+        shuffle_seed=args.shuffle_seed,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+    )
+    ...
+    shuffle.log_shuffle_bytes(result, args.shuffle_mode)
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+from functools import partial
+
+import apache_beam as beam
+from apache_beam.metrics import Metrics, MetricsFilter
+from apache_beam.transforms.window import GlobalWindows
+
+SHUFFLE_NONE = "none"
+SHUFFLE_SEEDED_GLOBAL = "seeded-global"
+SHUFFLE_LOCAL_BUFFER = "local-buffer"
+SHUFFLE_RESHUFFLE = "reshuffle"
+SHUFFLE_BYTES_COUNTER = "shuffle_bytes"
+
+
+def _positive_int(value):
+    """Define a positive integer ArgumentParser type."""
+    value = int(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            "Value must be positive, {} was passed.".format(value))
+    return value
+
+
+def add_arguments(parser):
+    """Adds the --shuffle_* flags to an ArgumentParser."""
+    parser.add_argument(
+        "--shuffle_mode",
+        choices=[SHUFFLE_NONE, SHUFFLE_SEEDED_GLOBAL, SHUFFLE_LOCAL_BUFFER,
+                 SHUFFLE_RESHUFFLE],
+        default=SHUFFLE_SEEDED_GLOBAL,
+        help="How to shuffle the examples before writing them. 'none' "
+             "writes them in the order they are created. 'seeded-global' "
+             "groups them by a hash of the example and --shuffle_seed, so "
+             "the shuffle can be reproduced. 'local-buffer' shuffles them "
+             "in a buffer of --shuffle_buffer_size examples on each worker, "
+             "without shuffling data between workers. 'reshuffle' uses "
+             "beam.Reshuffle.",
+    )
+    parser.add_argument(
+        "--shuffle_seed",
+        default=0, type=int,
+        help="The seed for the 'seeded-global' and 'local-buffer' shuffle "
+             "modes.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        default=10000, type=_positive_int,
+        help="The number of examples to shuffle at once in the "
+             "'local-buffer' shuffle mode.",
+    )
+
+
+@beam.ptransform_fn
+def shuffle(pcollection, shuffle_mode, shuffle_seed, shuffle_buffer_size):
+    """Shuffles the input pcollection, as set by --shuffle_mode.
+
+    The modes which shuffle data between workers count the encoded size of
+    the shuffled elements in the `shuffle_bytes` counter.
+    """
+    if shuffle_mode == SHUFFLE_NONE:
+        return pcollection
+
+    if shuffle_mode == SHUFFLE_LOCAL_BUFFER:
+        return pcollection | "shuffle in local buffer" >> beam.ParDo(
+            _LocalShuffleFn(shuffle_buffer_size, seed=shuffle_seed))
+
+    if shuffle_mode == SHUFFLE_RESHUFFLE:
+        pcollection |= "count shuffle bytes" >> beam.ParDo(
+            _CountShuffleBytesFn())
+        return pcollection | "reshuffle" >> beam.Reshuffle()
+
+    assert shuffle_mode == SHUFFLE_SEEDED_GLOBAL
+    pcollection |= "add seeded key" >> beam.Map(
+        partial(_key_by_seeded_hash, seed=shuffle_seed))
+    pcollection |= "count shuffle bytes" >> beam.ParDo(_CountShuffleBytesFn())
+    pcollection |= "group by key" >> beam.GroupByKey()
+    pcollection |= "get shuffled values" >> beam.FlatMap(lambda t: t[1])
+    return pcollection
+
+
+def _key_by_seeded_hash(example, seed):
+    """Keys an example by a hash of its content and the seed."""
+    md5 = hashlib.md5()
+    md5.update("{}:{}".format(
+        seed, json.dumps(example, sort_keys=True)).encode("utf-8"))
+    return int(md5.hexdigest()[:16], 16), example
+
+
+class _CountShuffleBytesFn(beam.DoFn):
+    """Counts the encoded size of elements which are about to be shuffled."""
+
+    def __init__(self):
+        super(_CountShuffleBytesFn, self).__init__()
+        self._coder = beam.coders.FastPrimitivesCoder()
+        self._shuffle_bytes = Metrics.counter(
+            self.__class__, SHUFFLE_BYTES_COUNTER)
+
+    def process(self, element):
+        self._shuffle_bytes.inc(self._coder.estimate_size(element))
+        yield element
+
+
+class _LocalShuffleFn(beam.DoFn):
+    """Shuffles elements in a bounded buffer, within each bundle.
+
+    Once the buffer is full, each new element takes the place of a random
+    element in the buffer, which is emitted. Elements are only mixed with
+    elements at most `buffer_size` apart in the same bundle, but no data is
+    shuffled between workers.
+    """
+
+    def __init__(self, buffer_size, seed):
+        super(_LocalShuffleFn, self).__init__()
+        self._buffer_size = buffer_size
+        self._seed = seed
+
+    def setup(self):
+        # Seeded once per instance, so each bundle is shuffled differently.
+        self._random = random.Random(self._seed)
+
+    def start_bundle(self):
+        self._buffer = []
+
+    def process(self, element):
+        if len(self._buffer) < self._buffer_size:
+            self._buffer.append(element)
+            return
+        i = self._random.randrange(self._buffer_size)
+        yield self._buffer[i]
+        self._buffer[i] = element
+
+    def finish_bundle(self):
+        self._random.shuffle(self._buffer)
+        for element in self._buffer:
+            yield GlobalWindows.windowed_value(element)
+        self._buffer = []
+
+
+def log_shuffle_bytes(result, shuffle_mode):
+    """Logs the number of bytes counted by `_CountShuffleBytesFn`."""
+    counters = result.metrics().query(
+        MetricsFilter().with_name(SHUFFLE_BYTES_COUNTER))['counters']
+    shuffle_bytes = sum(counter.result for counter in counters)
+    logging.info("Shuffle mode %s shuffled %i bytes.",
+                 shuffle_mode, shuffle_bytes)
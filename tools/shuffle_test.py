@@ -0,0 +1,87 @@
+"""Tests for shuffle.py."""
+
+import argparse
+import unittest
+
+import apache_beam as beam
+from apache_beam.metrics import MetricsFilter
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that, equal_to
+
+from tools import shuffle
+
+
+class ShuffleTest(unittest.TestCase):
+    """Test the shuffle modes."""
+
+    _EXAMPLES = [
+        {'context': str(i), 'response': str(i + 1)} for i in range(100)]
+
+    def test_add_arguments(self):
+        parser = argparse.ArgumentParser()
+        shuffle.add_arguments(parser)
+        args = parser.parse_args(["--shuffle_mode=local-buffer"])
+        self.assertEqual(shuffle.SHUFFLE_LOCAL_BUFFER, args.shuffle_mode)
+        self.assertEqual(0, args.shuffle_seed)
+        self.assertEqual(10000, args.shuffle_buffer_size)
+
+    def test_shuffle_modes(self):
+        for shuffle_mode in [
+                shuffle.SHUFFLE_NONE,
+                shuffle.SHUFFLE_SEEDED_GLOBAL,
+                shuffle.SHUFFLE_LOCAL_BUFFER,
+                shuffle.SHUFFLE_RESHUFFLE]:
+            with TestPipeline() as p:
+                examples = (
+                    p | beam.Create(self._EXAMPLES)
+                    | shuffle.shuffle(
+                        shuffle_mode=shuffle_mode,
+                        shuffle_seed=0,
+                        shuffle_buffer_size=10,
+                    )
+                )
+                assert_that(examples, equal_to(self._EXAMPLES))
+
+    def test_shuffle_bytes(self):
+        shuffle_bytes = {}
+        for shuffle_mode in [
+                shuffle.SHUFFLE_LOCAL_BUFFER,
+                shuffle.SHUFFLE_SEEDED_GLOBAL]:
+            p = TestPipeline()
+            (
+                p | beam.Create(self._EXAMPLES)
+                | shuffle.shuffle(
+                    shuffle_mode=shuffle_mode,
+                    shuffle_seed=0,
+                    shuffle_buffer_size=10,
+                )
+            )
+            result = p.run()
+            result.wait_until_finish()
+            counters = result.metrics().query(MetricsFilter().with_name(
+                shuffle.SHUFFLE_BYTES_COUNTER))['counters']
+            shuffle_bytes[shuffle_mode] = sum(
+                counter.result for counter in counters)
+        self.assertEqual(0, shuffle_bytes[shuffle.SHUFFLE_LOCAL_BUFFER])
+        self.assertGreater(shuffle_bytes[shuffle.SHUFFLE_SEEDED_GLOBAL], 0)
+
+    def test_local_shuffle_bundles(self):
+        # The bundles of a DoFn instance are not all shuffled the same way.
+        shuffle_fn = shuffle._LocalShuffleFn(buffer_size=10, seed=0)
+        shuffle_fn.setup()
+        bundles = []
+        for _ in range(2):
+            shuffle_fn.start_bundle()
+            bundle = []
+            for element in range(20):
+                bundle.extend(shuffle_fn.process(element))
+            bundle.extend(
+                windowed_value.value
+                for windowed_value in shuffle_fn.finish_bundle())
+            self.assertCountEqual(range(20), bundle)
+            bundles.append(bundle)
+        self.assertNotEqual(bundles[0], bundles[1])
+
+
+if __name__ == "__main__":
+    unittest.main()